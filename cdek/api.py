@@ -1,99 +1,523 @@
 # coding=utf-8
+import datetime
+import logging
+import socket
+import time
+import urllib
 import urlparse
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
 from xml.etree.ElementTree import tostring
 from xml.etree.ElementTree import ElementTree
+from xml.etree.ElementTree import iterparse
+from xml.etree.ElementTree import ParseError
+from multiprocessing.pool import ThreadPool
 
-from cdek.base import ResponseError, ResponseOrder, Response, ResponseStatus
+from cdek.base import ResponseError, ResponseOrder, Response, ResponseStatus, ResponseOrderCollection, XMLableObject
+from cdek.factory import CDEKRequestDeliveryObjectsFactory, CDEKStatusReportObjectsFactory
+from cdek.metrics import CallMetrics
+from cdek.writer import to_xml_bytes
 
+logger = logging.getLogger(__name__)
 
-class CDEKAPI(object):
+
+class CDEKAPIBase(object):
+    """
+    Общая часть синхронного и асинхронного клиентов: формирование запроса и разбор ответа шлюза
+    """
     _api_host = None
     _account = None
     _password = None
+    _serializer = None
+    _body_encoding = None
+    _status_history = None
+    _registry = None
+
+    SERIALIZER_ELEMENT_TREE = u'etree'
+    # Запрос строится деревом ElementTree, которое возвращается в Response.request_element
+
+    SERIALIZER_BYTES = u'bytes'
+    # Запрос пишется сразу в байты через cdek.writer без построения дерева, Response.request_element не заполняется
+
+    BODY_ENCODING_FORM = u'form'
+    # XML передается полем xml_request в application/x-www-form-urlencoded: каждый байт кириллицы становится
+    # трехсимвольной %-последовательностью
+
+    BODY_ENCODING_MULTIPART = u'multipart'
+    # XML передается полем xml_request в multipart/form-data как есть, без экранирования
 
-    def __init__(self, account, password, api_host=u'http://gw.edostavka.ru:11443'):
+    def __init__(self, account, password, api_host=u'http://gw.edostavka.ru:11443',
+                 serializer=SERIALIZER_ELEMENT_TREE, body_encoding=BODY_ENCODING_FORM, status_history=None,
+                 registry=None):
         """
         :param basestring account:
         :param basestring password:
         :param basestring api_host:
+        :param basestring serializer: SERIALIZER_ELEMENT_TREE или SERIALIZER_BYTES
+        :param basestring body_encoding: BODY_ENCODING_FORM или BODY_ENCODING_MULTIPART
+        :param cdek.history.StatusHistory status_history: Хранилище, в которое добавляются истории статусов из
+        ответов с show_history; None - истории не сохраняются и ResponseOrder.history не заполняется
+        :param cdek.registry.OrderRegistry registry: Реестр, в который записываются зарегистрированные заказы и их
+        статусы
         """
         self._account = account
         self._password = password
         self._api_host = api_host
+        self._serializer = serializer
+        self._body_encoding = body_encoding
+        self._status_history = status_history
+        self._registry = registry
+        self._hooks = []
 
-    def make_delivery_request(self, delivery_request, method_url=u'new_orders.php'):
+    def add_hook(self, hook):
         """
-        Производит запрос на регистрацию списка заказов на доставку
-        :param basestring method_url:
-        :param CDEKDeliveryRequest delivery_request:
+        Регистрирует обработчик замеров. После каждого вызова шлюза он получает CallMetrics с временем фаз, размерами
+        запроса и ответа и количеством заказов; без обработчиков замеры не производятся
+        :param callable hook: Например, cdek.metrics.MetricsRegistry
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    @property
+    def status_history(self):
+        """
+        Истории статусов всех заказов, полученных с show_history, для запросов по многим заказам сразу
+        :rtype: cdek.history.StatusHistory|None
+        """
+        return self._status_history
+
+    def _start_metrics(self, method_url, xml_object):
+        if not self._hooks:
+            return None
+        orders = getattr(xml_object, u'order', None)
+        if isinstance(orders, (list, tuple)):
+            order_count = len(orders)
+        else:
+            order_count = 0 if orders is None else 1
+        return CallMetrics(method_url, order_count)
+
+    def _finish_metrics(self, metrics, error=None):
+        if metrics is None:
+            return
+        metrics.error = error
+        for hook in self._hooks:
+            # Сбой хука не должен подменять ошибку запроса или прерывать обработку ответа
+            try:
+                hook(metrics)
+            except Exception:
+                logger.exception(u'Metrics hook %r failed', hook)
+
+    def _record_delivery(self, delivery_request, api_response):
+        if self._registry is not None:
+            self._registry.record_delivery(delivery_request, api_response)
+        return api_response
+
+    def _record_statuses(self, api_response):
+        if self._registry is not None:
+            self._registry.record_statuses(api_response.data)
+        return api_response
+
+    def _get_url(self, method_url):
+        return urlparse.urljoin(self._api_host, method_url)
+
+    def _to_xml_document(self, xml_element):
+        return tostring(xml_element, encoding='UTF-8').replace("'", "\"")
+
+    def _serialize(self, xml_object, tag_name, metrics=None):
+        if metrics is None:
+            if self._serializer == self.SERIALIZER_BYTES:
+                return None, to_xml_bytes(xml_object, tag_name)
+            xml_element = xml_object.to_xml_element(tag_name=tag_name)
+            return xml_element, self._to_xml_document(xml_element)
+        started = time.time()
+        if self._serializer == self.SERIALIZER_BYTES:
+            xml_document = to_xml_bytes(xml_object, tag_name)
+            metrics.phases[CallMetrics.PHASE_TO_XML_BYTES] = time.time() - started
+            return None, xml_document
+        xml_element = xml_object.to_xml_element(tag_name=tag_name)
+        built = time.time()
+        xml_document = self._to_xml_document(xml_element)
+        metrics.phases[CallMetrics.PHASE_TO_XML_ELEMENT] = built - started
+        metrics.phases[CallMetrics.PHASE_TOSTRING] = time.time() - built
+        return xml_element, xml_document
+
+    def _encode_body(self, xml_document, metrics=None):
+        """
+        :rtype: tuple
+        :return: Content-Type и тело запроса
         """
-        xml_element = delivery_request.to_xml_element(tag_name=u'DeliveryRequest')
-        xml_response = self._make_api_request(xml_element, method_url)
+        started = time.time() if metrics is not None else None
+        if self._body_encoding == self.BODY_ENCODING_MULTIPART:
+            boundary = uuid.uuid4().hex
+            content_type = 'multipart/form-data; boundary={}'.format(boundary)
+            body = ''.join((
+                '--', boundary, '\r\n',
+                'Content-Disposition: form-data; name="xml_request"\r\n',
+                'Content-Type: text/xml; charset=utf-8\r\n',
+                '\r\n',
+                xml_document, '\r\n',
+                '--', boundary, '--\r\n',
+            ))
+        else:
+            content_type = 'application/x-www-form-urlencoded'
+            body = urllib.urlencode({'xml_request': xml_document})
+        if metrics is not None:
+            metrics.phases[CallMetrics.PHASE_ENCODE] = time.time() - started
+            metrics.request_bytes = len(body)
+        return content_type, body
+
+    def _parse_delivery_order(self, api_order):
+        if api_order.get(u'DispatchNumber'):
+            return ResponseOrder(number=api_order.get(u'Number'), dispatch_number=api_order.get(u'DispatchNumber'))
+
+    def _parse_status_order(self, api_order):
+        api_order_status = api_order.find(u'Status')
+        if api_order_status is not None:
+            history = None
+            if self._status_history is not None and api_order_status.find(u'State') is not None:
+                if api_order.get(u'DispatchNumber'):
+                    key = self._status_history.dispatch_number_key(api_order.get(u'DispatchNumber'))
+                else:
+                    key = self._status_history.number_key(api_order.get(u'Number'))
+                history = self._status_history.add_element(key, api_order_status)
+            return ResponseOrder(
+                number=api_order.get(u'Number'),
+                dispatch_number=api_order.get(u'DispatchNumber'),
+                status=ResponseStatus(
+                    city_code=api_order_status.get(u'CityCode'),
+                    city_name=api_order_status.get(u'CityName'),
+                    code=int(api_order_status.get(u'Code')),
+                    date=api_order_status.get(u'Date'),
+                    description=api_order_status.get(u'Description')
+                ),
+                history=history
+            )
+
+    def _parse_error(self, api_order):
+        return ResponseError(code=api_order.get(u'ErrorCode'), message=api_order.get(u'Msg'), )
+
+    def _make_response(self, xml_element, api_orders, parse_order):
         api_response = Response(status=Response.STATUS_OK, request_element=xml_element)
         orders = {}
-        for api_order in xml_response.findall('Order'):
+        for api_order in api_orders:
             order_number = api_order.get(u'Number')
-            if api_order.get('ErrorCode'):
+            if api_order.get(u'ErrorCode'):
                 order = orders.get(order_number)
                 if not order:
                     order = ResponseOrder(number=order_number)
                     orders[order_number] = order
-                error = ResponseError(code=api_order.get(u'ErrorCode'), message=api_order.get(u'Msg'), )
-                order.add_error(error)
+                order.add_error(self._parse_error(api_order))
                 api_response.status = api_response.STATUS_FAIL
-            elif api_order.get(u'DispatchNumber'):
-                order = ResponseOrder(number=order_number, dispatch_number=api_order.get(u'DispatchNumber'))
-                orders[order_number] = order
-        api_response.data = orders.values()
+            else:
+                order = parse_order(api_order)
+                if order is not None:
+                    orders[order_number] = order
+        api_response.data = ResponseOrderCollection(orders.values())
         return api_response
 
-    def make_status_report_request(self, status_report, method_url=u'status_report_h.php'):
+    def _iter_response_orders(self, api_orders, parse_order):
+        # Ошибки одного заказа приходят подряд, поэтому заказ с ошибками отдается, когда начинается следующий
+        failed_order = None
+        for api_order in api_orders:
+            order_number = api_order.get(u'Number')
+            if failed_order is not None and failed_order.number != order_number:
+                yield failed_order
+                failed_order = None
+            if api_order.get(u'ErrorCode'):
+                if failed_order is None:
+                    failed_order = ResponseOrder(number=order_number)
+                failed_order.add_error(self._parse_error(api_order))
+            else:
+                order = parse_order(api_order)
+                if order is not None:
+                    failed_order = None
+                    yield order
+        if failed_order is not None:
+            yield failed_order
+
+
+class CDEKAPI(CDEKAPIBase):
+    _session = None
+    _timeout = None
+
+    BATCH_ERROR_CODE = u'ERR_BATCH_REQUEST_FAILED'
+    # Пачка заказов не была обработана шлюзом: ошибка соединения или некорректный ответ
+
+    TRANSPORT_ERRORS = (requests.RequestException, ParseError, socket.error)
+    # Ошибки соединения, таймауты и некорректные ответы: по ним нельзя понять, обработал ли шлюз запрос
+
+    def __init__(self, account, password, api_host=u'http://gw.edostavka.ru:11443', session=None, pool_maxsize=10,
+                 timeout=None, serializer=CDEKAPIBase.SERIALIZER_ELEMENT_TREE,
+                 body_encoding=CDEKAPIBase.BODY_ENCODING_FORM, status_history=None, registry=None):
         """
-        Производит запрос на получение статуса отправления
+        Соединения с шлюзом переиспользуются (keep-alive) через общую сессию requests, которую можно безопасно
+        использовать из нескольких потоков
+        :param basestring account:
+        :param basestring password:
+        :param basestring api_host:
+        :param requests.Session session: Сессия для запросов; если не передана, создается своя
+        :param int pool_maxsize: Максимальное количество открытых соединений с шлюзом. Потоки, которым не хватило
+        соединения, ждут его освобождения
+        :param float|tuple timeout: Таймаут запроса в секундах, см. requests
+        :param basestring serializer: SERIALIZER_ELEMENT_TREE или SERIALIZER_BYTES
+        :param basestring body_encoding: BODY_ENCODING_FORM или BODY_ENCODING_MULTIPART
+        :param cdek.history.StatusHistory status_history: Хранилище историй статусов, None - не сохранять
+        :param cdek.registry.OrderRegistry registry: Реестр зарегистрированных заказов и их статусов
+        """
+        super(CDEKAPI, self).__init__(account, password, api_host, serializer, body_encoding, status_history,
+                                      registry)
+        self._timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+            session.mount(u'http://', adapter)
+            session.mount(u'https://', adapter)
+        self._session = session
+
+    def close(self):
+        """
+        Закрывает соединения с шлюзом
+        """
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def make_delivery_request(self, delivery_request, method_url=u'new_orders.php'):
+        """
+        Производит запрос на регистрацию списка заказов на доставку
         :param basestring method_url:
         :param CDEKDeliveryRequest delivery_request:
         """
-        xml_element = status_report.to_xml_element(tag_name=u'StatusReport')
-        xml_response = self._make_api_request(xml_element, method_url)
-        api_response = Response(status=Response.STATUS_OK, request_element=xml_element)
-        orders = {}
-        for api_order in xml_response.findall('Order'):
-            order_number = api_order.get(u'Number')
-            if api_order.get('ErrorCode'):
-                order = orders.get(order_number)
-                if not order:
-                    order = ResponseOrder(number=order_number)
-                    orders[order_number] = order
-                error = ResponseError(code=api_order.get(u'ErrorCode'), message=api_order.get(u'Msg'), )
-                order.add_error(error)
-                api_response.status = api_response.STATUS_FAIL
-            elif api_order.find(u'Status') is not None:
-                api_order_status = api_order.find(u'Status')
-                order = ResponseOrder(
-                    number=order_number,
-                    dispatch_number=api_order.get(u'DispatchNumber'),
-                    status=ResponseStatus(
-                        city_code=api_order_status.get(u'CityCode'),
-                        city_name=api_order_status.get(u'CityName'),
-                        code=int(api_order_status.get(u'Code')),
-                        date=api_order_status.get(u'Date'),
-                        description=api_order_status.get(u'Description')
-                    )
-                )
-                orders[order_number] = order
-        api_response.data = orders.values()
+        api_response = self._make_api_call(delivery_request, u'DeliveryRequest', method_url,
+                                           self._parse_delivery_order)
+        return self._record_delivery(delivery_request, api_response)
+
+    def make_batch_delivery_request(self, orders, number, date, batch_size=100, workers=4,
+                                    method_url=u'new_orders.php'):
+        """
+        Производит регистрацию большого списка заказов: заказы разбиваются на DeliveryRequest размером не больше
+        batch_size со своими номерами (number-1, number-2, ...) и ключами, которые отправляются параллельно. Если
+        пачка не была обработана шлюзом, все ее заказы получают ошибку BATCH_ERROR_CODE, остальные пачки при этом
+        не затрагиваются
+        :param list orders: Список OrderRequestObject
+        :param basestring number: Префикс номера акта приема-передачи
+        :param datetime.datetime date: Дата документа
+        :param int batch_size: Максимальное количество заказов в одном DeliveryRequest
+        :param int workers: Количество одновременных запросов
+        :param basestring method_url:
+        :rtype: Response
+        :return: Объединенный ответ; request_element содержит список элементов всех отправленных DeliveryRequest
+        """
+        factory = CDEKRequestDeliveryObjectsFactory(account=self._account, password=self._password)
+        delivery_requests = [
+            factory.factory_delivery_request(orders=orders[offset:offset + batch_size],
+                                             number=u'{}-{}'.format(number, index + 1), date=date)
+            for index, offset in enumerate(xrange(0, len(orders), batch_size))
+        ]
+        api_response = Response(status=Response.STATUS_OK, request_element=[], data=ResponseOrderCollection())
+        if not delivery_requests:
+            return api_response
+        pool = ThreadPool(min(workers, len(delivery_requests)))
+        try:
+            results = pool.map(lambda x: self._make_batch_delivery_request(x, method_url), delivery_requests)
+        finally:
+            pool.close()
+            pool.join()
+        for batch_response in results:
+            if batch_response.status == Response.STATUS_FAIL:
+                api_response.status = Response.STATUS_FAIL
+            api_response.request_element.append(batch_response.request_element)
+            api_response.data.extend(batch_response.data)
         return api_response
 
-    def _make_api_request(self, xml_element, method_url):
-        xml_document = tostring(xml_element, encoding='UTF-8').replace("'", "\"")
-        url = urlparse.urljoin(self._api_host, method_url)
-        response = requests.post(
+    def _make_batch_delivery_request(self, delivery_request, method_url):
+        try:
+            return self.make_delivery_request(delivery_request, method_url)
+        except self.TRANSPORT_ERRORS as e:
+            error_message = u'{}: {}'.format(e.__class__.__name__, e)
+            request_element = None
+            if self._serializer == self.SERIALIZER_ELEMENT_TREE:
+                request_element = delivery_request.to_xml_element(tag_name=u'DeliveryRequest')
+            return Response(
+                status=Response.STATUS_FAIL,
+                request_element=request_element,
+                data=ResponseOrderCollection(
+                    ResponseOrder(number=x.number, errors=[ResponseError(code=self.BATCH_ERROR_CODE,
+                                                                         message=error_message)])
+                    for x in delivery_request.order)
+            )
+
+    def make_status_report_request(self, status_report, method_url=u'status_report_h.php', shard_size=None, workers=4,
+                                   shard_retries=1):
+        """
+        Производит запрос на получение статуса отправления
+        :param basestring method_url:
+        :param CDEKDeliveryRequest delivery_request:
+        :param int shard_size: Если задан и заказов больше, они разбиваются на StatusReport не больше shard_size
+        заказов со своими ключами, которые отправляются параллельно, а ответы объединяются; request_element ответа
+        тогда содержит список элементов всех отправленных StatusReport
+        :param int workers: Количество одновременных запросов при разбиении
+        :param int shard_retries: Сколько раз повторяется часть, не обработанная шлюзом, остальные части при этом не
+        повторяются. Если повторы не помогли, заказы этой части получают ошибку BATCH_ERROR_CODE
+        """
+        if shard_size is not None and shard_size < 1:
+            raise ValueError(u'shard_size must be positive')
+        if shard_retries < 0:
+            raise ValueError(u'shard_retries must not be negative')
+        orders = status_report.order
+        if isinstance(orders, XMLableObject):
+            orders = [orders]
+        if shard_size is not None and orders and len(orders) > shard_size:
+            return self._make_sharded_status_report_request(status_report, orders, method_url, shard_size, workers,
+                                                            shard_retries)
+        api_response = self._make_api_call(status_report, u'StatusReport', method_url, self._parse_status_order)
+        return self._record_statuses(api_response)
+
+    def _make_sharded_status_report_request(self, status_report, orders, method_url, shard_size, workers,
+                                            shard_retries):
+        factory = CDEKStatusReportObjectsFactory(account=self._account, password=self._password)
+        shards = [orders[offset:offset + shard_size] for offset in xrange(0, len(orders), shard_size)]
+
+        def make_shard_request(orders):
+            error_message = None
+            for _ in xrange(shard_retries + 1):
+                shard_report = factory.factory_status_report(
+                    date=datetime.datetime.now(), orders=orders, change_period=status_report.change_period,
+                    show_history=status_report.show_history)
+                try:
+                    return self._make_api_call(shard_report, u'StatusReport', method_url, self._parse_status_order)
+                except self.TRANSPORT_ERRORS as e:
+                    error_message = u'{}: {}'.format(e.__class__.__name__, e)
+            return Response(
+                status=Response.STATUS_FAIL,
+                request_element=None,
+                data=ResponseOrderCollection(
+                    ResponseOrder(number=x.number, dispatch_number=x.dispatch_number,
+                                  errors=[ResponseError(code=self.BATCH_ERROR_CODE, message=error_message)])
+                    for x in orders)
+            )
 
-            url=url,
-            data={'xml_request': xml_document},
-            stream=True
+        pool = ThreadPool(min(workers, len(shards)))
+        try:
+            results = pool.map(make_shard_request, shards)
+        finally:
+            pool.close()
+            pool.join()
+        api_response = Response(status=Response.STATUS_OK, request_element=[], data=ResponseOrderCollection())
+        for shard_response in results:
+            if shard_response.status == Response.STATUS_FAIL:
+                api_response.status = Response.STATUS_FAIL
+            api_response.request_element.append(shard_response.request_element)
+            api_response.data.extend(shard_response.data)
+        return self._record_statuses(api_response)
+
+    def iter_status_report_request(self, status_report, method_url=u'status_report_h.php'):
+        """
+        Производит запрос на получение статуса отправления, разбирая ответ потоково: ResponseOrder отдаются по мере
+        получения элементов Order, разобранные элементы сразу освобождаются. Запрос формируется и отправляется при
+        получении первого заказа; замеры начинаются тогда же, поэтому поток, который так и не начали читать, не
+        оставляет незавершенных замеров
+        :param basestring method_url:
+        :param StatusReportObject status_report:
+        :rtype: collections.Iterable[ResponseOrder]
+        """
+        return self._iter_response_orders(self._iter_status_report(status_report, method_url),
+                                          self._parse_status_order)
+
+    def _iter_status_report(self, status_report, method_url):
+        metrics = self._start_metrics(method_url, status_report)
+        try:
+            xml_element, xml_document = self._serialize(status_report, u'StatusReport', metrics)
+        except Exception as e:
+            self._finish_metrics(metrics, e)
+            raise
+        api_orders = self._iter_api_request(xml_document, method_url, metrics)
+        try:
+            for api_order in api_orders:
+                yield api_order
+        finally:
+            api_orders.close()
+
+    def _make_api_call(self, xml_object, tag_name, method_url, parse_order):
+        metrics = self._start_metrics(method_url, xml_object)
+        try:
+            xml_element, xml_document = self._serialize(xml_object, tag_name, metrics)
+            response = self._post(xml_document, method_url, metrics)
+            started = time.time() if metrics is not None else None
+            try:
+                xml_response = ElementTree()
+                xml_response.parse(response.raw)
+                if metrics is not None:
+                    metrics.response_bytes = response.raw.tell()
+            finally:
+                response.close()
+            api_response = self._make_response(xml_element, xml_response.findall(u'Order'), parse_order)
+            if metrics is not None:
+                metrics.phases[CallMetrics.PHASE_PARSE] = time.time() - started
+        except Exception as e:
+            self._finish_metrics(metrics, e)
+            raise
+        self._finish_metrics(metrics)
+        return api_response
+
+    def _post(self, xml_document, method_url, metrics=None):
+        content_type, body = self._encode_body(xml_document, metrics)
+        started = time.time() if metrics is not None else None
+        response = self._session.post(
+            url=self._get_url(method_url),
+            data=body,
+            headers={'Content-Type': content_type},
+            stream=True,
+            timeout=self._timeout
         )
-        xml_response = ElementTree()
-        xml_response.parse(response.raw)
-        return xml_response
\ No newline at end of file
+        if metrics is not None:
+            metrics.phases[CallMetrics.PHASE_NETWORK] = time.time() - started
+        return response
+
+    def _iter_api_request(self, xml_document, method_url, metrics=None):
+        error = None
+        try:
+            response = self._post(xml_document, method_url, metrics)
+        except Exception as e:
+            self._finish_metrics(metrics, e)
+            raise
+        # Время разбора считается без времени, которое потребитель тратит между элементами
+        timed = metrics is not None
+        parse_time = 0
+        resumed = time.time() if timed else None
+        try:
+            depth = 0
+            root = None
+            for event, element in iterparse(response.raw, events=(u'start', u'end')):
+                if event == u'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    if element.tag == u'Order':
+                        if timed:
+                            parse_time += time.time() - resumed
+                        yield element
+                        if timed:
+                            resumed = time.time()
+                    root.clear()
+            if timed:
+                parse_time += time.time() - resumed
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if timed:
+                metrics.response_bytes = response.raw.tell()
+                metrics.phases[CallMetrics.PHASE_PARSE] = parse_time
+            response.close()
+            self._finish_metrics(metrics, error)
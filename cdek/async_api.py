@@ -0,0 +1,293 @@
+# coding=utf-8
+import asyncore
+import collections
+import logging
+import os
+import socket
+import sys
+import time
+import urlparse
+from xml.etree.ElementTree import fromstring
+
+from cdek.api import CDEKAPIBase
+from cdek.exceptions import CDEKConfigurationError, CDEKHTTPError
+from cdek.metrics import CallMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResult(object):
+    """
+    Результат запроса AsyncCDEKAPI. Запросы выполняются циклом событий клиента; result() крутит цикл, пока запрос не
+    завершится
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        """
+        :param float timeout: Максимальное время ожидания в секундах
+        :rtype: cdek.base.Response
+        """
+        if not self._done:
+            self._client.run(until=self.done, timeout=timeout)
+        if not self._done:
+            raise socket.timeout(u'Request is not finished')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done:
+            self._client.run(until=self.done, timeout=timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        :param callable callback: Вызывается с этим AsyncResult после завершения запроса; исключения обработчиков,
+        вызванных циклом событий, записываются в лог cdek.async_api и не мешают остальным обработчикам
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _set(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception(u'AsyncResult callback %r failed', callback)
+
+
+class _HTTPExchange(asyncore.dispatcher):
+    # Один HTTP/1.0 запрос: соединение, отправка запроса и чтение ответа до закрытия соединения сервером
+
+    def __init__(self, address, request_data, callback, socket_map, timeout):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self._request_data = request_data
+        self._response_data = []
+        self._callback = callback
+        self._started = time.time()
+        self._deadline = self._started + timeout if timeout else None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self._request_data) or not self.connected
+
+    def handle_write(self):
+        sent = self.send(self._request_data)
+        self._request_data = self._request_data[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._response_data.append(data)
+
+    def handle_close(self):
+        self._finish(''.join(self._response_data), None)
+
+    def handle_error(self):
+        self._finish(None, sys.exc_info()[1])
+
+    def handle_expt(self):
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self._finish(None, socket.error(error, os.strerror(error)))
+
+    def check_timeout(self, now):
+        if self._deadline is not None and now > self._deadline:
+            self._finish(None, socket.timeout(u'Request timed out'))
+
+    def _finish(self, response_data, exception):
+        self.close()
+        if self._callback is not None:
+            callback, self._callback = self._callback, None
+            callback(response_data, exception, self._started)
+
+
+class AsyncCDEKAPI(CDEKAPIBase):
+    """
+    Клиент, выполняющий множество запросов одновременно в одном цикле событий (asyncore) без потоков. Методы
+    запросов сразу возвращают AsyncResult; количество одновременно открытых соединений ограничено max_in_flight,
+    остальные запросы ждут в очереди. Ответ с кодом HTTP не из 2xx завершает запрос ошибкой CDEKHTTPError.
+    Поддерживается только http
+    """
+
+    def __init__(self, account, password, api_host=u'http://gw.edostavka.ru:11443', max_in_flight=100, timeout=None,
+                 serializer=CDEKAPIBase.SERIALIZER_ELEMENT_TREE, body_encoding=CDEKAPIBase.BODY_ENCODING_FORM,
+                 status_history=None, registry=None, address_ttl=60.0):
+        """
+        :param basestring account:
+        :param basestring password:
+        :param basestring api_host:
+        :param int max_in_flight: Максимальное количество одновременных запросов
+        :param float timeout: Таймаут запроса в секундах
+        :param basestring serializer: SERIALIZER_ELEMENT_TREE или SERIALIZER_BYTES
+        :param basestring body_encoding: BODY_ENCODING_FORM или BODY_ENCODING_MULTIPART
+        :param cdek.history.StatusHistory status_history: Хранилище историй статусов, None - не сохранять
+        :param cdek.registry.OrderRegistry registry: Реестр зарегистрированных заказов и их статусов
+        :param float address_ttl: Сколько секунд используется найденный IP-адрес шлюза. Адрес ищется при создании
+        запроса, а не в цикле событий, чтобы поиск не останавливал выполняющиеся запросы
+        """
+        super(AsyncCDEKAPI, self).__init__(account, password, api_host, serializer, body_encoding, status_history,
+                                           registry)
+        parsed_host = urlparse.urlparse(api_host)
+        if parsed_host.scheme != u'http':
+            raise CDEKConfigurationError(u'AsyncCDEKAPI поддерживает только http')
+        self._host = parsed_host.hostname
+        self._port = parsed_host.port or 80
+        self._address = None
+        self._address_expires_at = None
+        self._address_ttl = address_ttl
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+        self._socket_map = {}
+        self._queue = collections.deque()
+        self._in_flight = 0
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def make_delivery_request(self, delivery_request, method_url=u'new_orders.php'):
+        """
+        Производит запрос на регистрацию списка заказов на доставку
+        :param basestring method_url:
+        :param cdek.objects.request.DeliveryRequestObject delivery_request:
+        :rtype: AsyncResult
+        """
+        return self._make_api_request(delivery_request, u'DeliveryRequest', method_url, self._parse_delivery_order,
+                                      lambda x: self._record_delivery(delivery_request, x))
+
+    def make_status_report_request(self, status_report, method_url=u'status_report_h.php'):
+        """
+        Производит запрос на получение статуса отправления
+        :param basestring method_url:
+        :param cdek.objects.status.StatusReportObject status_report:
+        :rtype: AsyncResult
+        """
+        return self._make_api_request(status_report, u'StatusReport', method_url, self._parse_status_order,
+                                      self._record_statuses)
+
+    def gather(self, results, timeout=None):
+        """
+        Дожидается завершения всех запросов
+        :param list results: Список AsyncResult
+        :param float timeout:
+        :rtype: list
+        """
+        results = list(results)
+        self.run(until=lambda: all(x.done() for x in results), timeout=timeout)
+        return [x.result(timeout=0) for x in results]
+
+    def run(self, until=None, timeout=None):
+        """
+        Крутит цикл событий, пока все запросы не будут выполнены, until() не вернет True или не истечет timeout
+        :param callable until:
+        :param float timeout:
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while self._socket_map or self._queue:
+            if until is not None and until():
+                return
+            if deadline is not None and time.time() > deadline:
+                return
+            self._start_queued()
+            asyncore.loop(timeout=0.05, use_poll=True, map=self._socket_map, count=1)
+            now = time.time()
+            for exchange in self._socket_map.values():
+                exchange.check_timeout(now)
+
+    def _make_api_request(self, xml_object, tag_name, method_url, parse_order, record):
+        address = self._get_address()
+        metrics = self._start_metrics(method_url, xml_object)
+        try:
+            xml_element, xml_document = self._serialize(xml_object, tag_name, metrics)
+            content_type, body = self._encode_body(xml_document, metrics)
+        except Exception as e:
+            self._finish_metrics(metrics, e)
+            raise
+        url = urlparse.urlparse(self._get_url(method_url))
+        request_data = (
+            'POST {} HTTP/1.0\r\n'
+            'Host: {}:{}\r\n'
+            'Content-Type: {}\r\n'
+            'Content-Length: {}\r\n'
+            'Connection: close\r\n'
+            '\r\n'
+        ).format(url.path + (u'?' + url.query if url.query else u''), self._host, self._port, content_type,
+                 len(body)).encode('ascii') + body
+        result = AsyncResult(self)
+        queued = time.time() if metrics is not None else None
+
+        def on_response(response_data, exception, started):
+            self._in_flight -= 1
+            if metrics is not None:
+                parse_started = time.time()
+                metrics.phases[CallMetrics.PHASE_QUEUE] = started - queued
+                metrics.phases[CallMetrics.PHASE_NETWORK] = parse_started - started
+                metrics.response_bytes = len(response_data) if response_data is not None else None
+            if exception is not None:
+                self._finish_metrics(metrics, exception)
+                result._set(exception=exception)
+                return
+            try:
+                xml_response = fromstring(self._get_response_body(response_data))
+                api_response = record(self._make_response(xml_element, xml_response.findall(u'Order'), parse_order))
+            except Exception as e:
+                self._finish_metrics(metrics, e)
+                result._set(exception=e)
+            else:
+                if metrics is not None:
+                    metrics.phases[CallMetrics.PHASE_PARSE] = time.time() - parse_started
+                self._finish_metrics(metrics)
+                result._set(result=api_response)
+
+        self._queue.append((address, request_data, on_response))
+        self._start_queued()
+        return result
+
+    def _get_response_body(self, response_data):
+        headers, _, body = response_data.partition('\r\n\r\n')
+        status_line = headers.split('\r\n', 1)[0].split(None, 2)
+        status_code = int(status_line[1]) if len(status_line) > 1 and status_line[1].isdigit() else None
+        if status_code is None or not 200 <= status_code < 300:
+            raise CDEKHTTPError(status_code, status_line[2] if len(status_line) > 2 else None)
+        for header in headers.split('\r\n')[1:]:
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-length':
+                return body[:int(value)]
+        return body
+
+    def _get_address(self):
+        now = time.time()
+        if self._address is None or now >= self._address_expires_at:
+            self._address = (socket.gethostbyname(self._host), self._port)
+            self._address_expires_at = now + self._address_ttl
+        return self._address
+
+    def _start_queued(self):
+        while self._queue and self._in_flight < self._max_in_flight:
+            address, request_data, on_response = self._queue.popleft()
+            self._in_flight += 1
+            _HTTPExchange(address, request_data, on_response, self._socket_map, self._timeout)
@@ -1,5 +1,7 @@
 # encoding=utf8
-from xml.etree.ElementTree import Element, SubElement
+import collections
+import threading
+from xml.etree.ElementTree import Element
 
 
 class XMLAttribute(object):
@@ -11,51 +13,266 @@ class XMLAttribute(object):
         self.required = required
 
 
-class XMLableObject(object):
+class SlottedObject(object):
+    """
+    Основа классов со __slots__: без __getstate__ такие объекты сохраняются pickle только протоколом 2, а состояние
+    здесь собирается из заданных слотов всех классов иерархии, поэтому работают и протоколы 0 и 1
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for klass in type(self).__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                if name not in state and name != '__weakref__' and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+def _to_pascal_case(attribute_name):
+    return u''.join([x.capitalize() for x in attribute_name.split(u'_')])
+
+
+class XMLableObjectMeta(type):
+    """
+    Компилирует xml_attributes класса один раз при его создании: имена тегов вычисляются заранее, чтобы
+    to_xml_element не пересчитывал их для каждого объекта, атрибуты объявляются в __slots__, чтобы экземпляры
+    не несли с собой __dict__, а обязательные и допустимые имена собираются в множества для проверки аргументов
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        if '__slots__' not in attrs:
+            inherited_slots = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited_slots.update(getattr(klass, '__slots__', ()))
+            attrs['__slots__'] = tuple(str(x.name) for x in attrs.get('xml_attributes', ())
+                                       if x.name not in inherited_slots)
+        return super(XMLableObjectMeta, mcs).__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        super(XMLableObjectMeta, cls).__init__(name, bases, attrs)
+        cls._xml_fields = tuple((x.name, _to_pascal_case(x.name)) for x in cls.xml_attributes)
+        cls._attribute_names = tuple(x.name for x in cls.xml_attributes)
+        cls._required_attributes = tuple(x.name for x in cls.xml_attributes if x.required)
+        cls._required_attribute_set = frozenset(cls._required_attributes)
+        cls._allowed_attribute_set = frozenset(cls._attribute_names)
+
+
+class XMLableObject(SlottedObject):
+    __metaclass__ = XMLableObjectMeta
+    __slots__ = ()
     xml_attributes = ()
 
     @property
     def attributes(self):
-        return [x.name for x in self.xml_attributes]
+        return list(self._attribute_names)
 
     def _to_pascal_case(self, attribute_name):
-        attribute_name = u''.join([x.capitalize() for x in attribute_name.split(u'_')])
-        return attribute_name
+        return _to_pascal_case(attribute_name)
 
     def to_xml_element(self, tag_name, parent=None):
-        element = Element(tag_name) if parent is None else SubElement(parent=parent, tag=tag_name)
-        for attribute_name in self.attributes:
+        element = Element(tag_name)
+        if parent is not None:
+            parent.append(element)
+        attrib = element.attrib
+        for attribute_name, xml_name in self._xml_fields:
             attribute = getattr(self, attribute_name)
             if attribute is None:
-                pass
-            elif not isinstance(attribute, (XMLableObject, tuple, list)):
-                attribute = attribute if isinstance(attribute, unicode) else str(attribute).decode(u'utf8')
-                element.set(self._to_pascal_case(attribute_name), attribute)
+                continue
+            attribute_type = type(attribute)
+            if attribute_type is unicode:
+                attrib[xml_name] = attribute
+            elif isinstance(attribute, XMLableObject):
+                attribute.to_xml_element(xml_name, element)
             elif isinstance(attribute, (tuple, list)):
                 for subattribute in attribute:
                     if isinstance(subattribute, XMLableObject):
-                        subattribute.to_xml_element(parent=element, tag_name=self._to_pascal_case(attribute_name))
+                        subattribute.to_xml_element(xml_name, element)
                     else:
-                        subattribute = unicode(subattribute)
-                        element.set(self._to_pascal_case(attribute_name), subattribute)
-            elif isinstance(attribute, XMLableObject):
-                attribute.to_xml_element(parent=element, tag_name=self._to_pascal_case(attribute_name))
+                        attrib[xml_name] = unicode(subattribute)
+            elif isinstance(attribute, unicode):
+                attrib[xml_name] = attribute
+            else:
+                attrib[xml_name] = str(attribute).decode(u'utf8')
         return element
 
     def __init__(self, **kwargs):
-        for xml_attribute in self.xml_attributes:
-            if xml_attribute.required and not xml_attribute.name in kwargs.keys():
-                raise TypeError(u'"{}" keyword argument required!'.format(xml_attribute.name))
-            elif xml_attribute.name in kwargs.keys():
-                setattr(self, xml_attribute.name, kwargs[xml_attribute.name])
-        for key in kwargs.keys():
-            if not key in self.attributes:
-                raise AssertionError(u'Wrong keyword argument "{}"!'.format(key))
+        if not self._required_attribute_set.issubset(kwargs):
+            for name in self._required_attributes:
+                if name not in kwargs:
+                    raise TypeError(u'"{}" keyword argument required!'.format(name))
+        if not self._allowed_attribute_set.issuperset(kwargs):
+            for key in kwargs:
+                if key not in self._allowed_attribute_set:
+                    raise AssertionError(u'Wrong keyword argument "{}"!'.format(key))
+        get = kwargs.get
+        for name in self._attribute_names:
+            setattr(self, name, get(name))
+
+    @classmethod
+    def create_trusted(cls, **kwargs):
+        """
+        Создает объект без проверки аргументов - для данных, уже проверенных до этого. Отсутствующие атрибуты
+        получают None, лишние аргументы игнорируются
+        :rtype: XMLableObject
+        """
+        obj = cls.__new__(cls)
+        get = kwargs.get
+        for name in cls._attribute_names:
+            setattr(obj, name, get(name))
+        return obj
+
+
+class FragmentCache(object):
+    """
+    Ограниченный по размеру LRU-кэш сериализованных замороженных объектов: элементов ElementTree и фрагментов
+    документа cdek.writer. Ключ включает значения объекта, поэтому равные объекты из разных запросов сериализуются
+    один раз
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        :param int max_size: Максимальное количество фрагментов
+        """
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """
+        :param tuple key:
+        :param callable build: Строит фрагмент, если его нет в кэше
+        """
+        with self._lock:
+            fragment = self._entries.pop(key, None)
+            if fragment is not None:
+                self._entries[key] = fragment
+                self.hits += 1
+                return fragment
+            self.misses += 1
+        fragment = build()
+        with self._lock:
+            self._entries[key] = fragment
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return fragment
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            return {u'hits': self.hits, u'misses': self.misses, u'size': len(self._entries)}
+
+
+def _typed_value(value):
+    if isinstance(value, tuple):
+        return tuple(_typed_value(x) for x in value)
+    if isinstance(value, XMLableObject):
+        return type(value), value
+    # repr различает и значения одного типа, которые равны, но сериализуются по-разному
+    return type(value), repr(value)
+
+
+class FrozenXMLableObject(XMLableObject):
+    """
+    Неизменяемый XMLableObject для подобъектов, общих для многих заказов (адрес отправителя, вызов курьера,
+    дополнительные услуги). Объекты сравниваются по значениям, а их сериализованная форма берется из fragment_cache
+    и вставляется в каждый ссылающийся на них заказ без повторной сериализации. Вложенные объекты тоже должны быть
+    замороженными, списки и множества превращаются в кортежи. Конкретные классы объявляют слот _fragments для
+    фрагментов, уже полученных этим объектом
+    """
+    __slots__ = ()
+    fragment_cache = FragmentCache()
+
+    def __init__(self, **kwargs):
+        self._fragments = {}
+        for key, value in kwargs.items():
+            if isinstance(value, list):
+                kwargs[key] = value = tuple(value)
+            elif isinstance(value, (set, frozenset)):
+                # Порядок элементов множества не определен, а от него зависят ключ и фрагмент
+                kwargs[key] = value = tuple(sorted(value))
+            for subvalue in value if isinstance(value, tuple) else (value,):
+                if isinstance(subvalue, XMLableObject) and not isinstance(subvalue, FrozenXMLableObject):
+                    raise TypeError(u'"{}" must be frozen!'.format(key))
+        super(FrozenXMLableObject, self).__init__(**kwargs)
+
+    @classmethod
+    def create_trusted(cls, **kwargs):
+        # Замороженные объекты создаются редко и проверяются всегда
+        return cls(**kwargs)
+
+    def __setattr__(self, name, value):
+        try:
+            getattr(self, name)
+        except AttributeError:
+            # Атрибут еще не задан: объект создается
+            super(FrozenXMLableObject, self).__setattr__(name, value)
+        else:
+            raise AttributeError(u'{} is frozen'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError(u'{} is frozen'.format(type(self).__name__))
+
+    def __getstate__(self):
+        state = super(FrozenXMLableObject, self).__getstate__()
+        state.pop('_fragments', None)
+        return state
+
+    def __setstate__(self, state):
+        # __setattr__ запрещает изменения, а полученные фрагменты не сохраняются
+        super(FrozenXMLableObject, self).__setstate__(state)
+        object.__setattr__(self, '_fragments', {})
+
+    def _key(self):
+        # Значения сравниваются с учетом типа и записи: 44 и 44.0, 1 и True, Decimal('1') и Decimal('1.0') равны,
+        # но сериализуются по-разному
+        return (type(self),) + tuple(_typed_value(getattr(self, x)) for x, _ in self._xml_fields)
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenXMLableObject) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def get_fragment(self, tag_name, kind, build):
+        """
+        :param unicode tag_name:
+        :param unicode kind: Вид фрагмента, например u'element' или u'bytes'
+        :param callable build: Строит фрагмент, если его нет ни у объекта, ни в fragment_cache
+        """
+        key = (tag_name, kind)
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            fragment = self._fragments[key] = self.fragment_cache.get((self,) + key, build)
+        return fragment
+
+    def to_xml_element(self, tag_name, parent=None):
+        # Один и тот же элемент вставляется во все родительские элементы
+        element = self.get_fragment(tag_name, u'element',
+                                    lambda: super(FrozenXMLableObject, self).to_xml_element(tag_name))
+        if parent is not None:
+            parent.append(element)
+        return element
 
 
-class ResponseError(object):
-    code = None
-    message = None
+class ResponseError(SlottedObject):
+    __slots__ = ('code', 'message')
 
     def __init__(self, code, message):
         self.code = code
@@ -65,17 +282,15 @@ class ResponseError(object):
         return '<ApiResponseError: {}>'.format(self.code)
 
 
-class ResponseOrder(object):
-    number = None
-    dispatch_number = None
-    errors = None
-    status = None
+class ResponseOrder(SlottedObject):
+    __slots__ = ('number', 'dispatch_number', 'errors', 'status', 'history')
 
-    def __init__(self, number, dispatch_number=None, errors=None, status=None):
+    def __init__(self, number, dispatch_number=None, errors=None, status=None, history=None):
         self.number = number
         self.dispatch_number = dispatch_number
         self.errors = errors or []
         self.status = status
+        self.history = history
 
 
     def __repr__(self):
@@ -85,12 +300,8 @@ class ResponseOrder(object):
         self.errors.append(error)
 
 
-class ResponseStatus(object):
-    city_code = None
-    city_name = None
-    code = None
-    date = None
-    description = None
+class ResponseStatus(SlottedObject):
+    __slots__ = ('city_code', 'city_name', 'code', 'date', 'description')
 
     STATUS_CODE_REGISTERED = 1
     # Заказ зарегистрирован в базе данных СДЭК
@@ -163,9 +374,88 @@ class ResponseStatus(object):
         self.description = description
 
 
-class Response(object):
-    status = None
-    request_element = None
+class ResponseOrderCollection(SlottedObject, list):
+    """
+    Список ResponseOrder с индексами по номеру заказа и номеру отправления СДЭК. Индексы строятся при первом
+    обращении и сбрасываются при изменении списка, поэтому простой перебор ничего лишнего не стоит
+    """
+    __slots__ = ('_by_number', '_by_dispatch_number')
+
+    def __init__(self, orders=()):
+        super(ResponseOrderCollection, self).__init__(orders)
+        self._by_number = None
+        self._by_dispatch_number = None
+
+    @property
+    def by_number(self):
+        """
+        :rtype: dict
+        :return: Заказы по номеру отправления клиента (Number)
+        """
+        if self._by_number is None:
+            self._by_number = dict((x.number, x) for x in self)
+        return self._by_number
+
+    @property
+    def by_dispatch_number(self):
+        """
+        :rtype: dict
+        :return: Заказы по номеру отправления СДЭК (DispatchNumber); заказы без номера не входят
+        """
+        if self._by_dispatch_number is None:
+            self._by_dispatch_number = dict((x.dispatch_number, x) for x in self if x.dispatch_number)
+        return self._by_dispatch_number
+
+    def __getstate__(self):
+        # Индексы не сохраняются: после восстановления они строятся заново
+        return {'_by_number': None, '_by_dispatch_number': None}
+
+    def get_by_number(self, number, default=None):
+        return self.by_number.get(number, default)
+
+    def get_by_dispatch_number(self, dispatch_number, default=None):
+        return self.by_dispatch_number.get(dispatch_number, default)
+
+    def failed(self):
+        """
+        :rtype: collections.Iterable[ResponseOrder]
+        :return: Заказы с ошибками
+        """
+        return (x for x in self if x.errors)
+
+    def succeeded(self):
+        """
+        :rtype: collections.Iterable[ResponseOrder]
+        :return: Заказы без ошибок
+        """
+        return (x for x in self if not x.errors)
+
+    def _reset_indexes(self):
+        self._by_number = None
+        self._by_dispatch_number = None
+
+    def _resetting(method):
+        def wrapper(self, *args):
+            self._reset_indexes()
+            return method(self, *args)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    append = _resetting(list.append)
+    extend = _resetting(list.extend)
+    insert = _resetting(list.insert)
+    remove = _resetting(list.remove)
+    pop = _resetting(list.pop)
+    __setitem__ = _resetting(list.__setitem__)
+    __delitem__ = _resetting(list.__delitem__)
+    __setslice__ = _resetting(list.__setslice__)
+    __delslice__ = _resetting(list.__delslice__)
+    __iadd__ = _resetting(list.__iadd__)
+    del _resetting
+
+
+class Response(SlottedObject):
+    __slots__ = ('status', 'data', 'request_element')
 
     STATUS_OK = u'ok'
     STATUS_FAIL = u'fail'
@@ -0,0 +1,489 @@
+# coding=utf-8
+"""
+Замеры производительности клиента на синтетических заказах и локальной заглушке шлюза.
+Запуск: python -m cdek.benchmarks [--output results.json] [--compare previous.json]
+"""
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import random
+import sys
+import time
+from decimal import Decimal
+from xml.etree.ElementTree import tostring, fromstring
+
+import requests
+
+from cdek.api import CDEKAPI
+from cdek.base import ResponseOrder, ResponseStatus
+from cdek.bulk import BulkDeliveryPipeline
+from cdek.factory import CDEKRequestDeliveryObjectsFactory, CDEKStatusReportObjectsFactory
+from cdek.history import StatusHistory, format_timestamp
+from cdek.stub import StubGateway
+from cdek.writer import to_xml_bytes
+
+
+RECIPIENT_NAMES = (u'Петров Виктор Владимирович', u'Иванова Мария Сергеевна', u'Сидоров Алексей Петрович',
+                   u'Кузнецова Анна Игоревна', u'Смирнов Дмитрий Олегович')
+STREETS = (u'Ленина', u'Тверская', u'Проспект Мира', u'Садовая-Кудринская', u'Большая Покровская')
+ITEM_NAMES = (u'Футболка хлопковая, размер M, цвет синий', u'Кроссовки беговые, размер 42',
+              u'Чехол для телефона силиконовый', u'Книга «Мастер и Маргарита»', u'Набор кухонных полотенец, 3 шт.')
+
+
+def generate_orders(factory, order_count, packages_per_order=2, items_per_package=3, seed=0):
+    """
+    Генерирует синтетические заказы для замеров: количество упаковок и товаров, получатели, адреса и товары
+    выбираются случайно, но воспроизводимо
+    :param CDEKRequestDeliveryObjectsFactory factory:
+    :param int order_count: Количество заказов
+    :param int packages_per_order: Максимальное количество упаковок в заказе
+    :param int items_per_package: Максимальное количество товаров в упаковке
+    :param int seed:
+    :rtype: list
+    """
+    random_generator = random.Random(seed)
+    orders = []
+    date_invoice = datetime.datetime(2015, 1, 1, 12, 0)
+    for order_index in xrange(order_count):
+        packages = []
+        for package_index in xrange(random_generator.randint(1, packages_per_order)):
+            items = []
+            for item_index in xrange(random_generator.randint(1, items_per_package)):
+                cost = Decimal(random_generator.randint(100, 100000)) / 100
+                items.append(factory.factory_item(
+                    ware_key=u'{}-{}-{}'.format(order_index, package_index, item_index),
+                    cost=cost,
+                    payment=cost if random_generator.random() < 0.5 else Decimal(0),
+                    weight=random_generator.randint(100, 3000),
+                    weight_brutto=3100,
+                    amount=random_generator.randint(1, 5),
+                    link=u'http://shop.ru/item/{}'.format(random_generator.randint(1, 100000)),
+                    comment=random_generator.choice(ITEM_NAMES)
+                ))
+            packages.append(factory.factory_package(number=u'{}'.format(package_index + 1),
+                                                    weight=3100 * len(items), items=items))
+        address = factory.factory_address(street=random_generator.choice(STREETS),
+                                          house=u'{}'.format(random_generator.randint(1, 200)),
+                                          flat=u'{}'.format(random_generator.randint(1, 500)))
+        orders.append(factory.factory_order(
+            number=u'order-{}'.format(order_index),
+            date_invoice=date_invoice,
+            recipient_name=random_generator.choice(RECIPIENT_NAMES),
+            recipient_email=u'customer{}@mail.ru'.format(order_index),
+            phone=u'+7987{:07d}'.format(random_generator.randint(0, 9999999)),
+            tariff_type_code=random_generator.choice((1, 10, 136, 137)),
+            seller_name=u'ООО "Магазин"',
+            address=address,
+            packages=packages,
+            send_city_post_code=u'111402',
+            rec_city_post_code=u'{:06d}'.format(random_generator.randint(100000, 699999)),
+            comment=u'Позвонить за час до доставки' if random_generator.random() < 0.3 else None
+        ))
+    return orders
+
+
+def generate_order_columns(factory, order_count, packages_per_order=2, items_per_package=3, seed=0):
+    """
+    Те же заказы, что и generate_orders, в колоночном виде для CDEKRequestDeliveryObjectsFactory.factory_orders_bulk
+    :rtype: tuple
+    :return: Колонки заказов, упаковок и товаров
+    """
+    orders = collections.defaultdict(list)
+    packages = collections.defaultdict(list)
+    items = collections.defaultdict(list)
+    for order in generate_orders(factory, order_count, packages_per_order, items_per_package, seed):
+        orders[u'date_invoice'].append(datetime.datetime.strptime(order.date_invoice, u'%Y-%m-%dT%H:%M:%S'))
+        for name in (u'number', u'recipient_name', u'recipient_email', u'phone', u'tariff_type_code',
+                     u'seller_name', u'send_city_post_code', u'rec_city_post_code', u'comment'):
+            orders[name].append(getattr(order, name))
+        for name in (u'street', u'house', u'flat'):
+            orders[name].append(getattr(order.address, name))
+        for package in order.package:
+            packages[u'order_number'].append(order.number)
+            for name in (u'number', u'weight'):
+                packages[name].append(getattr(package, name))
+            for item in package.item:
+                items[u'order_number'].append(order.number)
+                items[u'package_number'].append(package.number)
+                for name in (u'ware_key', u'cost', u'payment', u'weight', u'weight_brutto', u'amount', u'link',
+                             u'comment'):
+                    items[name].append(getattr(item, name))
+    return dict(orders), dict(packages), dict(items)
+
+
+def _factory_orders_per_object(factory, orders, packages, items):
+    # Построение тех же заказов, что и factory_orders_bulk, вызовами factory_* для каждого объекта
+    package_items = collections.defaultdict(list)
+    for row in [dict(zip(items, x)) for x in zip(*items.values())]:
+        package_items[row.pop(u'order_number'), row.pop(u'package_number')].append(factory.factory_item(**row))
+    order_packages = collections.defaultdict(list)
+    for row in [dict(zip(packages, x)) for x in zip(*packages.values())]:
+        order_number = row.pop(u'order_number')
+        order_packages[order_number].append(
+            factory.factory_package(items=package_items[order_number, row[u'number']], **row))
+    result = []
+    for row in [dict(zip(orders, x)) for x in zip(*orders.values())]:
+        address = factory.factory_address(street=row.pop(u'street'), house=row.pop(u'house'), flat=row.pop(u'flat'))
+        result.append(factory.factory_order(address=address, packages=order_packages[row[u'number']], **row))
+    return result
+
+
+def _measure(function, repeat):
+    return _measure_result(function, repeat)[0]
+
+
+def _measure_result(function, repeat):
+    # Лучшее время из repeat запусков и результат последнего запуска
+    best = None
+    result = None
+    for _ in xrange(repeat):
+        started = time.time()
+        result = function()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_serialization(order_counts=(100, 1000, 5000), repeat=3):
+    """
+    Время построения дерева DeliveryRequest через to_xml_element и его перевода в строку, а также прямой записи в байты
+    через cdek.writer
+    """
+    factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+    results = []
+    for order_count in order_counts:
+        delivery_request = factory.factory_delivery_request(orders=generate_orders(factory, order_count),
+                                                            number=u'bench', date=datetime.datetime(2015, 1, 1))
+        to_element = _measure(lambda: delivery_request.to_xml_element(u'DeliveryRequest'), repeat)
+        element = delivery_request.to_xml_element(u'DeliveryRequest')
+        to_string = _measure(lambda: tostring(element, encoding='UTF-8').replace("'", "\""), repeat)
+        to_bytes = _measure(lambda: to_xml_bytes(delivery_request, u'DeliveryRequest'), repeat)
+        document_size = len(to_xml_bytes(delivery_request, u'DeliveryRequest'))
+        results.append({u'orders': order_count, u'to_xml_element': to_element, u'tostring': to_string,
+                        u'to_xml_bytes': to_bytes, u'megabytes_per_second': document_size / to_bytes / 1e6,
+                        u'etree_megabytes_per_second': document_size / (to_element + to_string) / 1e6})
+    return results
+
+
+def bench_construction(order_counts=(1000, 10000), repeat=3):
+    """
+    Время построения заказов через фабрику с проверкой аргументов и в режиме trusted
+    """
+    factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+    trusted_factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password', trusted=True)
+    results = []
+    for order_count in order_counts:
+        results.append({u'orders': order_count,
+                        u'validated': _measure(lambda: generate_orders(factory, order_count), repeat),
+                        u'trusted': _measure(lambda: generate_orders(trusted_factory, order_count), repeat)})
+    return results
+
+
+def bench_bulk_factory(order_counts=(100, 1000, 10000), repeat=3):
+    """
+    Время построения заказов вызовами factory_* для каждого объекта и одним вызовом factory_orders_bulk по колонкам
+    """
+    factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+    results = []
+    for order_count in order_counts:
+        orders, packages, items = generate_order_columns(factory, order_count)
+        per_object = _measure(lambda: _factory_orders_per_object(factory, orders, packages, items), repeat)
+        bulk = _measure(lambda: factory.factory_orders_bulk(orders, packages, items), repeat)
+        results.append({u'orders': order_count, u'per_object': per_object, u'bulk': bulk,
+                        u'speedup': per_object / bulk})
+    return results
+
+
+def bench_bulk_pipeline(order_count=20000, process_counts=(1, 2, 4), batch_size=1000, repeat=1):
+    """
+    Время построения и сериализации заказов в документы DeliveryRequest: в текущем процессе (factory_orders_bulk и
+    to_xml_bytes) и в BulkDeliveryPipeline с разным количеством процессов. Ускорение ограничено количеством ядер
+    """
+    factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+    orders, packages, items = generate_order_columns(factory, order_count)
+    date = datetime.datetime(2015, 1, 1)
+
+    def build_in_process():
+        built_orders = factory.factory_orders_bulk(orders, packages, items)
+        return [to_xml_bytes(factory.factory_delivery_request(built_orders[offset:offset + batch_size],
+                                                              u'act-{}'.format(index + 1), date), u'DeliveryRequest')
+                for index, offset in enumerate(xrange(0, order_count, batch_size))]
+
+    in_process = _measure(build_in_process, repeat)
+    results = [{u'orders': order_count, u'processes': 0, u'cpu_count': multiprocessing.cpu_count(),
+                u'seconds': in_process, u'speedup': 1.0}]
+    for processes in process_counts:
+        pipeline = BulkDeliveryPipeline(u'account', u'password', processes=processes, batch_size=batch_size)
+        seconds = _measure(lambda: pipeline.build(orders, packages, items, u'act', date), repeat)
+        results.append({u'orders': order_count, u'processes': processes, u'cpu_count': multiprocessing.cpu_count(),
+                        u'seconds': seconds, u'speedup': in_process / seconds})
+    return results
+
+
+def _object_size(obj):
+    # Размер самого объекта и его __dict__, если он есть; значения атрибутов не учитываются
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def bench_memory(order_count=1000):
+    """
+    Средний размер в байтах одного объекта запроса и ответа
+    """
+    factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+    orders = generate_orders(factory, order_count)
+    packages = [package for order in orders for package in order.package]
+    items = [item for package in packages for item in package.item]
+    statuses = [ResponseStatus(city_code=u'44', city_name=u'Москва', code=ResponseStatus.STATUS_CODE_DELIVERED,
+                               date=u'2015-01-01T12:00:00+03:00', description=u'Вручен')
+                for _ in xrange(order_count)]
+    response_orders = [ResponseOrder(number=order.number, dispatch_number=u'1000', status=status)
+                       for order, status in zip(orders, statuses)]
+    results = []
+    for name, objects in ((u'OrderRequestObject', orders), (u'PackageRequestObject', packages),
+                          (u'ItemRequestObject', items), (u'ResponseOrder', response_orders),
+                          (u'ResponseStatus', statuses)):
+        results.append({u'object': name, u'bytes': sum(_object_size(x) for x in objects) / float(len(objects))})
+    return results
+
+
+def bench_history(order_count=10000, states_per_order=10):
+    """
+    Память на один статус истории: списки ResponseStatus против StatusHistory
+    """
+    cities = ((u'44', u'Москва'), (u'137', u'Санкт-Петербург'), (u'270', u'Новосибирск'))
+    states = [(1420092000.0 + index * 3600, code, cities[index % len(cities)][0], cities[index % len(cities)][1])
+              for index, code in enumerate([1, 3, 6, 7, 21, 22, 8, 9, 10, 11, 4][:states_per_order])]
+    history = StatusHistory()
+    status_lists = []
+    for order_index in xrange(order_count):
+        history.add(StatusHistory.dispatch_number_key(unicode(1000000000 + order_index)), states)
+        # Строки копируются, как при разборе ответа, где у каждого статуса свои строки
+        status_lists.append([ResponseStatus(city_code=city_code[:], city_name=u''.join(city_name),
+                                            code=code, date=format_timestamp(timestamp),
+                                            description=u''.join(u'Описание статуса'))
+                             for timestamp, code, city_code, city_name in states])
+    list_bytes = sum(sys.getsizeof(x) + sum(_object_size(y) + sum(sys.getsizeof(getattr(y, z)) for z in y.__slots__)
+                                            for y in x) for x in status_lists)
+    history_bytes = (sum(sys.getsizeof(x) for x in (history.codes, history.timestamps, history.cities)) +
+                     sum(sys.getsizeof(x) for x in history.city_codes + history.city_names))
+    status_count = float(order_count * len(states))
+    return [{u'storage': u'ResponseStatus lists', u'bytes_per_status': list_bytes / status_count},
+            {u'storage': u'StatusHistory', u'bytes_per_status': history_bytes / status_count}]
+
+
+def bench_keep_alive(request_count=300):
+    """
+    Средняя задержка запроса статуса к локальной заглушке: новое соединение на каждый запрос против переиспользуемых
+    соединений
+    """
+    factory = CDEKStatusReportObjectsFactory(account=u'account', password=u'password')
+    status_report = factory.factory_status_report(date=datetime.datetime(2015, 1, 1),
+                                                  orders=[factory.factory_order(dispatch_number=u'1000000000')])
+    no_keep_alive_session = requests.Session()
+    no_keep_alive_session.headers[u'Connection'] = u'close'
+    results = []
+    with StubGateway() as gateway:
+        for mode, session in ((u'connection per request', no_keep_alive_session), (u'keep-alive', None)):
+            connection_count = gateway.connection_count
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host, session=session) as api:
+                started = time.time()
+                for _ in xrange(request_count):
+                    api.make_status_report_request(status_report)
+                results.append({u'mode': mode, u'latency': (time.time() - started) / request_count,
+                                u'connections': gateway.connection_count - connection_count})
+    return results
+
+
+def bench_round_trip(batch_sizes=(1, 10, 100, 1000), repeat=3):
+    """
+    Полный цикл запросов к локальной заглушке new_orders.php и status_report_h.php с раздельным временем построения
+    объектов, сериализации, сети и разбора ответа
+    """
+    delivery_factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+    status_factory = CDEKStatusReportObjectsFactory(account=u'account', password=u'password')
+    date = datetime.datetime(2015, 1, 1)
+    results = []
+    with StubGateway() as gateway:
+        with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api:
+            for batch_size in batch_sizes:
+                for method_url, tag_name, build, parse_order in (
+                    (u'new_orders.php', u'DeliveryRequest',
+                     lambda: delivery_factory.factory_delivery_request(
+                         orders=generate_orders(delivery_factory, batch_size), number=u'bench', date=date),
+                     api._parse_delivery_order),
+                    (u'status_report_h.php', u'StatusReport',
+                     lambda: status_factory.factory_status_report(
+                         date=date, orders=[status_factory.factory_order(dispatch_number=unicode(1000000000 + x))
+                                            for x in xrange(batch_size)]),
+                     api._parse_status_order),
+                ):
+                    construction, request_object = _measure_result(build, repeat)
+                    serialization, xml_document = _measure_result(
+                        lambda: api._to_xml_document(request_object.to_xml_element(tag_name)), repeat)
+                    network, response_body = _measure_result(
+                        lambda: api._session.post(url=api._get_url(method_url),
+                                                  data={'xml_request': xml_document}).content, repeat)
+                    parse = _measure(
+                        lambda: api._make_response(None, fromstring(response_body).findall(u'Order'), parse_order),
+                        repeat)
+                    results.append({
+                        u'method': method_url,
+                        u'batch_size': batch_size,
+                        u'construction': construction,
+                        u'serialization': serialization,
+                        u'network': network,
+                        u'parse': parse,
+                        u'request_bytes': len(xml_document),
+                        u'response_bytes': len(response_body),
+                    })
+    return results
+
+
+def bench_body_encoding(order_counts=(10, 100, 1000), repeat=3):
+    """
+    Размер тела запроса new_orders.php и время полного вызова make_delivery_request к локальной заглушке для
+    каждого способа кодирования тела
+    """
+    factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+    date = datetime.datetime(2015, 1, 1)
+    results = []
+    with StubGateway() as gateway:
+        for order_count in order_counts:
+            delivery_request = factory.factory_delivery_request(orders=generate_orders(factory, order_count),
+                                                                number=u'bench', date=date)
+            for body_encoding in (CDEKAPI.BODY_ENCODING_FORM, CDEKAPI.BODY_ENCODING_MULTIPART):
+                with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                             serializer=CDEKAPI.SERIALIZER_BYTES, body_encoding=body_encoding) as api:
+                    request_bytes = gateway.request_bytes
+                    api.make_delivery_request(delivery_request)
+                    request_bytes = gateway.request_bytes - request_bytes
+                    latency = _measure(lambda: api.make_delivery_request(delivery_request), repeat)
+                results.append({
+                    u'encoding': body_encoding,
+                    u'orders': order_count,
+                    u'request_bytes': request_bytes,
+                    u'latency': latency,
+                })
+    return results
+
+
+def run_all(quick=False):
+    """
+    Выполняет все замеры
+    :param bool quick: Уменьшенные объемы для быстрой проверки
+    :rtype: dict
+    """
+    if quick:
+        return {
+            u'serialization': bench_serialization(order_counts=(10, 100), repeat=1),
+            u'memory': bench_memory(order_count=100),
+            u'history': bench_history(order_count=100),
+            u'keep_alive': bench_keep_alive(request_count=20),
+            u'round_trip': bench_round_trip(batch_sizes=(1, 10), repeat=1),
+            u'body_encoding': bench_body_encoding(order_counts=(10,), repeat=1),
+            u'bulk_factory': bench_bulk_factory(order_counts=(100,), repeat=1),
+            u'construction': bench_construction(order_counts=(100,), repeat=1),
+            u'bulk_pipeline': bench_bulk_pipeline(order_count=200, process_counts=(2,), batch_size=100),
+        }
+    return {
+        u'serialization': bench_serialization(),
+        u'memory': bench_memory(),
+        u'history': bench_history(),
+        u'keep_alive': bench_keep_alive(),
+        u'round_trip': bench_round_trip(),
+        u'body_encoding': bench_body_encoding(),
+        u'bulk_factory': bench_bulk_factory(),
+        u'construction': bench_construction(),
+        u'bulk_pipeline': bench_bulk_pipeline(),
+    }
+
+
+def compare(baseline, current, threshold=0.2):
+    """
+    Сравнивает два набора результатов round_trip, serialization и body_encoding, найденные замедления больше threshold
+    :param dict baseline: Результаты предыдущего прогона (содержимое JSON-файла)
+    :param dict current:
+    :param float threshold: Допустимое относительное замедление
+    :rtype: list
+    :return: Список (замер, фаза, было, стало)
+    """
+    regressions = []
+    for group, key_names in ((u'serialization', (u'orders',)), (u'round_trip', (u'method', u'batch_size')),
+                             (u'body_encoding', (u'encoding', u'orders'))):
+        baseline_results = dict((tuple(x[k] for k in key_names), x) for x in baseline[u'results'].get(group, ()))
+        for result in current[u'results'].get(group, ()):
+            key = tuple(result[k] for k in key_names)
+            previous = baseline_results.get(key)
+            if previous is None:
+                continue
+            for phase, value in result.items():
+                if phase in key_names or not isinstance(value, float) or phase.endswith(u'per_second'):
+                    continue
+                if phase in previous and value > previous[phase] * (1 + threshold):
+                    regressions.append((u'{} {}'.format(group, u' '.join(unicode(x) for x in key)), phase,
+                                        previous[phase], value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=u'Замеры производительности rebranch-cdek-api')
+    parser.add_argument(u'--output', help=u'Сохранить результаты в JSON-файл')
+    parser.add_argument(u'--compare', help=u'JSON-файл предыдущего прогона для поиска замедлений')
+    parser.add_argument(u'--threshold', type=float, default=0.2,
+                        help=u'Допустимое относительное замедление при сравнении')
+    parser.add_argument(u'--label', default=u'', help=u'Метка прогона, например версия')
+    parser.add_argument(u'--quick', action=u'store_true', help=u'Уменьшенные объемы')
+    arguments = parser.parse_args(argv)
+
+    report = {
+        u'label': arguments.label,
+        u'python': sys.version.split()[0],
+        u'created': datetime.datetime.now().isoformat(),
+        u'results': run_all(quick=arguments.quick),
+    }
+    results = report[u'results']
+    for result in results[u'serialization']:
+        print (u'serialization orders={orders}: to_xml_element {to_xml_element:.4f}s, tostring {tostring:.4f}s '
+               u'({etree_megabytes_per_second:.1f} MB/s), to_xml_bytes {to_xml_bytes:.4f}s '
+               u'({megabytes_per_second:.1f} MB/s)').format(**result)
+    for result in results[u'memory']:
+        print u'memory {object}: {bytes:.0f} bytes per object'.format(**result)
+    for result in results[u'history']:
+        print u'history {storage}: {bytes_per_status:.1f} bytes per status'.format(**result)
+    for result in results[u'keep_alive']:
+        print u'keep-alive {mode}: {latency:.5f}s per request, {connections} connections'.format(**result)
+    for result in results[u'round_trip']:
+        print (u'{method} batch={batch_size}: construction {construction:.4f}s, serialization {serialization:.4f}s, '
+               u'network {network:.4f}s, parse {parse:.4f}s, request {request_bytes} B, '
+               u'response {response_bytes} B').format(**result)
+    for result in results[u'body_encoding']:
+        print (u'body encoding {encoding} orders={orders}: request {request_bytes} B, '
+               u'latency {latency:.4f}s').format(**result)
+    for result in results[u'bulk_factory']:
+        print (u'bulk factory orders={orders}: per object {per_object:.4f}s, bulk {bulk:.4f}s '
+               u'(x{speedup:.1f})').format(**result)
+    for result in results[u'construction']:
+        print u'construction orders={orders}: validated {validated:.4f}s, trusted {trusted:.4f}s'.format(**result)
+    for result in results[u'bulk_pipeline']:
+        print (u'bulk pipeline orders={orders} processes={processes}: {seconds:.4f}s (x{speedup:.1f}, '
+               u'{cpu_count} CPU)').format(**result)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), report, arguments.threshold)
+        for name, phase, previous, value in regressions:
+            print u'regression {} {}: {:.4f}s -> {:.4f}s'.format(name, phase, previous, value)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
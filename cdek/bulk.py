@@ -0,0 +1,194 @@
+# coding=utf-8
+"""
+Построение и сериализация большого количества заказов в пуле процессов. Каждый процесс строит свою часть заказов
+factory_orders_bulk и возвращает готовые фрагменты XML; родительский процесс собирает из фрагментов документы
+DeliveryRequest
+"""
+import collections
+import multiprocessing
+import threading
+
+from cdek.base import XMLableObject
+from cdek.exceptions import CDEKConfigurationError
+from cdek.factory import CDEKRequestDeliveryObjectsFactory
+from cdek.objects.request import PassportRequestObject, AddressRequestObject, ItemRequestObject, \
+    PackageRequestObject, OrderRequestObject, CallCourierRequestObject, CDEKCall, SendAddressRequestObject, \
+    AddServiceRequestObject, FrozenCallCourierRequestObject, FrozenCDEKCall, FrozenSendAddressRequestObject, \
+    FrozenAddServiceRequestObject
+from cdek.writer import XMLBytesWriter, to_xml_bytes
+
+BulkDeliveryDocument = collections.namedtuple(u'BulkDeliveryDocument', [u'number', u'order_numbers', u'document',
+                                                                        u'packed_orders'])
+
+PackedObject = collections.namedtuple(u'PackedObject', [u'class_index', u'values'])
+# Результат pack_object; отдельный тип отличает упакованные объекты от кортежей среди значений атрибутов
+
+PACKABLE_CLASSES = (OrderRequestObject, AddressRequestObject, PassportRequestObject, PackageRequestObject,
+                    ItemRequestObject, CallCourierRequestObject, CDEKCall, SendAddressRequestObject,
+                    AddServiceRequestObject, FrozenCallCourierRequestObject, FrozenCDEKCall,
+                    FrozenSendAddressRequestObject, FrozenAddServiceRequestObject)
+# Классы, которые можно упаковать pack_object; в упакованном виде класс задается индексом в этом списке
+
+_class_indexes = dict((x, index) for index, x in enumerate(PACKABLE_CLASSES))
+
+
+def pack_object(xml_object):
+    """
+    Компактное представление объекта запроса для передачи между процессами: индекс класса в PACKABLE_CLASSES и
+    значения атрибутов в порядке xml_attributes, вложенные объекты упаковываются так же. Сериализуется pickle в
+    разы быстрее и короче самого объекта
+    :param XMLableObject xml_object:
+    :rtype: PackedObject
+    """
+    values = []
+    for name in xml_object._attribute_names:
+        value = getattr(xml_object, name)
+        if isinstance(value, XMLableObject):
+            value = pack_object(value)
+        elif isinstance(value, (tuple, list)):
+            value = type(value)(pack_object(x) if isinstance(x, XMLableObject) else x for x in value)
+        values.append(value)
+    return PackedObject(_class_indexes[type(xml_object)], tuple(values))
+
+
+def unpack_object(packed):
+    """
+    Восстанавливает объект, упакованный pack_object, через create_trusted: обычные объекты без повторной проверки
+    аргументов, замороженные - как при создании
+    :param PackedObject packed:
+    :rtype: XMLableObject
+    """
+    cls = PACKABLE_CLASSES[packed.class_index]
+    kwargs = {}
+    for name, value in zip(cls._attribute_names, packed.values):
+        if isinstance(value, PackedObject):
+            value = unpack_object(value)
+        elif isinstance(value, (tuple, list)):
+            value = type(value)(unpack_object(x) if isinstance(x, PackedObject) else x for x in value)
+        kwargs[name] = value
+    return cls.create_trusted(**kwargs)
+
+
+def split_rows(orders, packages, items, chunk_size):
+    """
+    Делит строки колонок factory_orders_bulk на части не больше chunk_size заказов; упаковки и товары попадают в
+    часть своего заказа. Номера заказов должны быть уникальны по всем частям, а не только внутри каждой
+    :param dict orders: Колонки заказов
+    :param dict packages: Колонки упаковок
+    :param dict items: Колонки товаров
+    :param int chunk_size:
+    :rtype: list
+    :return: Список кортежей (индекс первого заказа, индекс за последним заказом, индексы строк упаковок, индексы
+    строк товаров)
+    """
+    order_numbers = orders[u'number']
+    if len(set(order_numbers)) != len(order_numbers):
+        raise CDEKConfigurationError(u'Номера заказов должны быть уникальны')
+    chunks = [(offset, min(offset + chunk_size, len(order_numbers)), [], [])
+              for offset in xrange(0, len(order_numbers), chunk_size)]
+    if not chunks and any(packages.values() + items.values()):
+        # Без заказов все строки упаковок и товаров попадают в одну пустую часть, где factory_orders_bulk сообщит
+        # об ошибке
+        chunks.append((0, 0, [], []))
+    chunk_indexes = dict((x, index // chunk_size) for index, x in enumerate(order_numbers))
+    for table_index, table in ((2, packages), (3, items)):
+        for row, order_number in enumerate(table[CDEKRequestDeliveryObjectsFactory.BULK_ORDER_NUMBER_COLUMN]):
+            # Строки с несуществующими заказами попадают в первую часть, где factory_orders_bulk сообщит об ошибке
+            chunks[chunk_indexes.get(order_number, 0)][table_index].append(row)
+    return chunks
+
+
+_worker_state = None
+# Фабрика, колонки и части текущего build: процессы пула получают их при fork, а не через pickle
+
+_build_lock = threading.Lock()
+# _worker_state общий для модуля, поэтому build из разных потоков выполняются по очереди
+
+
+def _build_chunk(arguments):
+    # Строит заказы части и сериализует каждый в отдельный фрагмент
+    chunk_index, pack = arguments
+    factory, orders, packages, items, chunks = _worker_state
+    order_start, order_stop, package_rows, item_rows = chunks[chunk_index]
+    built_orders = factory.factory_orders_bulk(
+        dict((name, column[order_start:order_stop]) for name, column in orders.items()),
+        dict((name, [column[x] for x in package_rows]) for name, column in packages.items()),
+        dict((name, [column[x] for x in item_rows]) for name, column in items.items()))
+    fragments = [to_xml_bytes(x, u'Order', xml_declaration=False) for x in built_orders]
+    packed_orders = [pack_object(x) for x in built_orders] if pack else None
+    return [x.number for x in built_orders], fragments, packed_orders
+
+
+class BulkDeliveryPipeline(object):
+    """
+    Построение документов DeliveryRequest для сотен тысяч заказов на всех ядрах: построение заказов и их
+    сериализация выполняются в пуле процессов частями по chunk_size заказов, родительский процесс только склеивает
+    фрагменты в документы по batch_size заказов. Колонки не передаются процессам через pickle: пул создается на
+    каждый build, и процессы получают их при fork; обратно передаются только байты фрагментов и, по запросу,
+    упакованные заказы. Документы совпадают с результатом to_xml_bytes для factory_delivery_request_bulk с теми же
+    заказами
+    """
+
+    def __init__(self, account, password, processes=None, chunk_size=1000, batch_size=1000):
+        """
+        :param basestring account:
+        :param basestring password:
+        :param int processes: Количество процессов, по умолчанию по числу ядер; 0 - без пула, в текущем процессе
+        :param int chunk_size: Количество заказов, которое процесс строит за раз
+        :param int batch_size: Максимальное количество заказов в одном DeliveryRequest
+        """
+        self._factory = CDEKRequestDeliveryObjectsFactory(account=account, password=password)
+        self._processes = processes
+        self._chunk_size = chunk_size
+        self._batch_size = batch_size
+
+    def build(self, orders, packages, items, number, date, pack=False):
+        """
+        :param dict orders: Колонки заказов, см. CDEKRequestDeliveryObjectsFactory.factory_orders_bulk
+        :param dict packages: Колонки упаковок
+        :param dict items: Колонки товаров
+        :param basestring number: Префикс номера акта; документы получают номера number-1, number-2, ...
+        :param datetime.datetime date: Дата документа
+        :param bool pack: Вернуть также упакованные заказы каждого документа, см. unpack_object
+        :rtype: list
+        :return: Список BulkDeliveryDocument
+        """
+        global _worker_state
+        chunks = split_rows(orders, packages, items, self._chunk_size)
+        tasks = [(x, pack) for x in xrange(len(chunks))]
+        with _build_lock:
+            _worker_state = (self._factory, orders, packages, items, chunks)
+            try:
+                if self._processes == 0:
+                    results = [_build_chunk(x) for x in tasks]
+                else:
+                    pool = multiprocessing.Pool(self._processes)
+                    try:
+                        results = pool.map(_build_chunk, tasks, chunksize=1)
+                    finally:
+                        pool.close()
+                        pool.join()
+            finally:
+                _worker_state = None
+        order_numbers = []
+        fragments = []
+        packed_orders = []
+        for chunk_numbers, chunk_fragments, chunk_packed_orders in results:
+            order_numbers.extend(chunk_numbers)
+            fragments.extend(chunk_fragments)
+            if pack:
+                packed_orders.extend(chunk_packed_orders)
+        documents = []
+        for index, offset in enumerate(xrange(0, len(fragments), self._batch_size)):
+            batch_fragments = fragments[offset:offset + self._batch_size]
+            delivery_request = self._factory.factory_delivery_request(
+                orders=[], number=u'{}-{}'.format(number, index + 1), date=date)
+            delivery_request.order_count = len(batch_fragments)
+            writer = XMLBytesWriter()
+            writer.write_declaration()
+            writer.write_start_tag(delivery_request, u'DeliveryRequest')
+            document = writer.getvalue() + b''.join(batch_fragments) + b'</DeliveryRequest>'
+            documents.append(BulkDeliveryDocument(delivery_request.number,
+                                                  order_numbers[offset:offset + self._batch_size], document,
+                                                  packed_orders[offset:offset + self._batch_size] if pack else None))
+        return documents
@@ -0,0 +1,167 @@
+# coding=utf-8
+import collections
+import threading
+import time
+
+from cdek.base import Response, ResponseStatus, ResponseOrderCollection, XMLableObject
+from cdek.objects.status import StatusReportObject
+
+
+class StatusCache(object):
+    """
+    Кэш статусов заказов по номеру отправления СДЭК и по номеру заказа с датой. Обычные статусы живут ttl секунд и
+    вытесняются по LRU при превышении max_size; терминальные статусы (заказ вручен или возвращен) больше не меняются,
+    поэтому хранятся без срока и не вытесняются
+    """
+    TERMINAL_STATUS_CODES = frozenset([ResponseStatus.STATUS_CODE_DELIVERED, ResponseStatus.STATUS_CODE_RETURNED])
+
+    def __init__(self, ttl=300, max_size=10000, terminal_status_codes=TERMINAL_STATUS_CODES, clock=time.time):
+        """
+        :param float ttl: Время жизни нетерминального статуса в секундах
+        :param int max_size: Максимальное количество нетерминальных записей
+        :param set terminal_status_codes: Коды статусов, которые больше не меняются
+        :param callable clock:
+        """
+        self._ttl = ttl
+        self._max_size = max_size
+        self._terminal_status_codes = terminal_status_codes
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :param tuple key: См. dispatch_number_key и number_key
+        :rtype: cdek.base.ResponseOrder|None
+        """
+        with self._lock:
+            order = self._pinned.get(key)
+            if order is None:
+                entry = self._entries.pop(key, None)
+                if entry is not None and entry[1] > self._clock():
+                    self._entries[key] = entry
+                    order = entry[0]
+            if order is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return order
+
+    def put(self, keys, order):
+        """
+        :param list keys: Ключи, по которым заказ должен находиться
+        :param cdek.base.ResponseOrder order: Заказ со статусом
+        """
+        with self._lock:
+            if order.status.code in self._terminal_status_codes:
+                for key in keys:
+                    self._entries.pop(key, None)
+                    self._pinned[key] = order
+                return
+            expires_at = self._clock() + self._ttl
+            for key in keys:
+                self._entries.pop(key, None)
+                self._entries[key] = (order, expires_at)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                u'hits': self.hits,
+                u'misses': self.misses,
+                u'size': len(self._entries),
+                u'pinned': len(self._pinned),
+            }
+
+    @staticmethod
+    def dispatch_number_key(dispatch_number):
+        return u'dispatch_number', dispatch_number
+
+    @staticmethod
+    def number_key(number, date):
+        return u'number', number, date
+
+
+class CachedStatusReportAPI(object):
+    """
+    Кэширующая прослойка над CDEKAPI.make_status_report_request: заказы, статус которых есть в кэше, не запрашиваются,
+    в StatusReport уходят только остальные
+    """
+
+    def __init__(self, api, cache):
+        """
+        :param cdek.api.CDEKAPI api:
+        :param StatusCache cache:
+        """
+        self._api = api
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def make_status_report_request(self, status_report, method_url=u'status_report_h.php'):
+        """
+        Производит запрос на получение статуса отправления для заказов, отсутствующих в кэше
+        :param StatusReportObject status_report:
+        :param basestring method_url:
+        :rtype: Response
+        """
+        if status_report.change_period is not None or status_report.show_history:
+            # Выборка по периоду и история из кэша не восстанавливаются, ответ только пополняет кэш. Дата акта в
+            # ответе не приходит, поэтому заказы без номера отправления не кэшируются
+            api_response = self._api.make_status_report_request(status_report, method_url)
+            for order in api_response.data:
+                if order.status is not None and order.dispatch_number:
+                    self._cache.put([self._cache.dispatch_number_key(order.dispatch_number)], order)
+            return api_response
+
+        cached_orders = []
+        missing_orders = []
+        requested_orders = status_report.order or []
+        if isinstance(requested_orders, XMLableObject):
+            requested_orders = [requested_orders]
+        for order in requested_orders:
+            cached_order = self._cache.get(self._get_key(order))
+            if cached_order is None:
+                missing_orders.append(order)
+            else:
+                cached_orders.append(cached_order)
+        if not missing_orders:
+            return Response(status=Response.STATUS_OK, request_element=None,
+                            data=ResponseOrderCollection(cached_orders))
+
+        missing_report = StatusReportObject(order=missing_orders, change_period=None, date=status_report.date,
+                                            account=status_report.account, secure=status_report.secure,
+                                            show_history=status_report.show_history)
+        api_response = self._api.make_status_report_request(missing_report, method_url)
+        # Дата акта в ответе не приходит: если один номер запрошен с несколькими датами, заказ из ответа нельзя
+        # отнести ни к одной из них, и по номеру он не кэшируется
+        dates = {}
+        for order in missing_orders:
+            if not order.dispatch_number:
+                dates.setdefault(order.number, set()).add(order.date)
+        for order in api_response.data:
+            if order.status is None:
+                continue
+            keys = []
+            if order.dispatch_number:
+                keys.append(self._cache.dispatch_number_key(order.dispatch_number))
+            if len(dates.get(order.number, ())) == 1:
+                keys.append(self._cache.number_key(order.number, next(iter(dates[order.number]))))
+            if keys:
+                self._cache.put(keys, order)
+        api_response.data = ResponseOrderCollection(cached_orders + list(api_response.data))
+        return api_response
+
+    def _get_key(self, order):
+        if order.dispatch_number:
+            return self._cache.dispatch_number_key(order.dispatch_number)
+        return self._cache.number_key(order.number, order.date)
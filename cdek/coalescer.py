@@ -0,0 +1,205 @@
+# coding=utf-8
+"""
+Объединение одновременных запросов статуса отдельных заказов в общие StatusReport
+"""
+import collections
+import datetime
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class _Lookup(object):
+    # Ожидающий запрос статуса одного заказа
+
+    __slots__ = ('key', 'order', 'max_batch_size', 'flush_at', 'done', 'result', 'exception')
+
+    def __init__(self, key, order, max_batch_size, flush_at):
+        self.key = key
+        self.order = order
+        self.max_batch_size = max_batch_size
+        self.flush_at = flush_at
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class StatusRequestCoalescer(object):
+    """
+    Собирает запросы статуса отдельных заказов из разных потоков за короткое окно и отправляет их одним
+    StatusReport, раздавая ResponseOrder ответа запросившим потокам. Пачка отправляется, когда истекло окно самого
+    раннего ожидающего запроса или набралось столько запросов, сколько допускает самый строгий max_batch_size среди
+    них. Одинаковые заказы из разных потоков запрашиваются один раз. Номер заказа клиента уникален только в
+    пределах даты акта, а в ответе шлюза даты нет, поэтому заказы с одинаковым номером и разными датами
+    запрашиваются отдельными StatusReport; заказы, которые в ответе могли совпасть по номеру с заказом, запрошенным
+    по номеру отправления, запрашиваются повторно по одному
+    """
+
+    def __init__(self, api, factory, window=0.01, max_batch_size=1000, show_history=False, workers=4,
+                 method_url=u'status_report_h.php'):
+        """
+        :param cdek.api.CDEKAPI api:
+        :param cdek.factory.CDEKStatusReportObjectsFactory factory:
+        :param float window: Время в секундах, в течение которого запрос ждет попутчиков
+        :param int max_batch_size: Максимальное количество заказов в StatusReport
+        :param bool show_history: Запрашивать историю статусов
+        :param int workers: Количество одновременно отправляемых пачек
+        :param basestring method_url:
+        """
+        self._api = api
+        self._factory = factory
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._show_history = show_history
+        self._method_url = method_url
+        self._pending = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._pool = ThreadPool(workers)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self.batch_count = 0
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def get_status(self, dispatch_number=None, number=None, date=None, max_batch_size=None, latency_budget=None,
+                   timeout=None):
+        """
+        Запрашивает статус заказа по номеру отправления СДЭК или по номеру заказа клиента и дате акта
+        :param basestring dispatch_number:
+        :param basestring number:
+        :param datetime.date date:
+        :param int max_batch_size: Максимальный размер пачки, в которую может попасть этот запрос
+        :param float latency_budget: Сколько секунд запрос может ждать попутчиков; если меньше окна, пачка уходит
+        раньше
+        :param float timeout: Максимальное время ожидания ответа в секундах
+        :rtype: cdek.base.ResponseOrder|None
+        :return: None, если шлюз не вернул заказ
+        """
+        order = self._factory.factory_order(dispatch_number=dispatch_number, number=number, date=date)
+        key = (u'dispatch_number', dispatch_number) if dispatch_number else (u'number', number, order.date)
+        wait = self._window if latency_budget is None else min(self._window, latency_budget)
+        lookup = _Lookup(key, order, min(max_batch_size or self._max_batch_size, self._max_batch_size),
+                         time.time() + wait)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError(u'Coalescer is closed')
+            self._pending.append(lookup)
+            self._condition.notify()
+        if not lookup.done.wait(timeout):
+            raise socket.timeout(u'Status request is not finished')
+        if lookup.exception is not None:
+            raise lookup.exception
+        return lookup.result
+
+    def close(self):
+        """
+        Отправляет ожидающие запросы и останавливает фоновый поток
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    batch = self._take_batch()
+                    if batch is not None or (self._closed and not self._pending):
+                        break
+                    flush_at = min(x.flush_at for x in self._pending) if self._pending else None
+                    self._condition.wait(flush_at - time.time() if flush_at is not None else None)
+            if batch is None:
+                return
+            self.batch_count += 1
+            self._pool.apply_async(self._send, (batch,))
+
+    def _take_batch(self):
+        # Пачка из самых старых запросов, если ее пора отправлять
+        if not self._pending:
+            return None
+        batch = []
+        keys = set()
+        limit = self._max_batch_size
+        for lookup in self._pending:
+            size = len(keys) + (lookup.key not in keys)
+            if size > min(limit, lookup.max_batch_size):
+                break
+            batch.append(lookup)
+            keys.add(lookup.key)
+            limit = min(limit, lookup.max_batch_size)
+        full = len(batch) < len(self._pending)
+        if not (full or len(keys) >= limit or self._closed or min(x.flush_at for x in batch) <= time.time()):
+            return None
+        del self._pending[:len(batch)]
+        return batch
+
+    def _send(self, batch):
+        try:
+            self._resolve(batch)
+        except Exception as e:
+            for lookup in batch:
+                if lookup.result is None and lookup.exception is None:
+                    lookup.exception = e
+        finally:
+            for lookup in batch:
+                lookup.done.set()
+
+    def _resolve(self, batch):
+        lookups = collections.OrderedDict()
+        for lookup in batch:
+            lookups.setdefault(lookup.key, []).append(lookup)
+        # Группы заказов, в каждой из которых номер заказа клиента встречается не больше одного раза. Номера
+        # заказов, запрошенных по номеру отправления, до ответа неизвестны, поэтому такие заказы идут в первую группу
+        groups = []
+        for key in lookups:
+            index = 0
+            if key[0] == u'number':
+                while index < len(groups) and key[1] in groups[index][1]:
+                    index += 1
+            if index == len(groups):
+                groups.append(([], set()))
+            groups[index][0].append(key)
+            if key[0] == u'number':
+                groups[index][1].add(key[1])
+        queue = collections.deque(x for x, _ in groups)
+        while queue:
+            keys = queue.popleft()
+            status_report = self._factory.factory_status_report(
+                date=datetime.datetime.now(), orders=[lookups[x][0].order for x in keys],
+                show_history=self._show_history)
+            try:
+                data = self._api.make_status_report_request(status_report, self._method_url).data
+            except Exception as e:
+                for key in keys:
+                    for lookup in lookups[key]:
+                        lookup.exception = e
+                continue
+            # Ответ индексируется по номеру заказа клиента: заказ, запрошенный по номеру отправления, мог совпасть по
+            # номеру с другим заказом группы и вытеснить его или быть вытесненным. Такие заказы запрашиваются отдельно
+            dispatch_numbers = set(x[1] for x in keys if x[0] == u'dispatch_number')
+            for key in keys:
+                if key[0] == u'dispatch_number':
+                    result = data.get_by_dispatch_number(key[1])
+                    ambiguous = result is None
+                else:
+                    result = data.get_by_number(key[1])
+                    ambiguous = result is not None and result.dispatch_number in dispatch_numbers
+                if ambiguous and len(keys) > 1:
+                    queue.append([key])
+                    continue
+                for lookup in lookups[key]:
+                    lookup.result = result
@@ -1,2 +1,14 @@
+# coding=utf-8
 class CDEKConfigurationError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class CDEKHTTPError(Exception):
+    """
+    Шлюз ответил кодом HTTP не из 2xx
+    """
+
+    def __init__(self, status_code, reason=None):
+        super(CDEKHTTPError, self).__init__(u'HTTP {} {}'.format(status_code, reason or u'').strip())
+        self.status_code = status_code
+        self.reason = reason
@@ -1,22 +1,33 @@
 # coding=utf-8
+import collections
 import hashlib
+import itertools
 
 from cdek.objects.request import AddressRequestObject, OrderRequestObject, ItemRequestObject, PackageRequestObject, \
     DeliveryRequestObject, PassportRequestObject, CDEKCall, SendAddressRequestObject, CallCourierRequestObject, \
-    AddServiceRequestObject
+    AddServiceRequestObject, FrozenCDEKCall, FrozenSendAddressRequestObject, FrozenCallCourierRequestObject, \
+    FrozenAddServiceRequestObject
 from cdek.objects.status import OrderStatusObject, ChangePeriodStatusObject, StatusReportObject
 from cdek.exceptions import CDEKConfigurationError
 
 
 class CDEKObjectsFactoryAbastract(object):
-    def __init__(self, account, password):
+    def __init__(self, account, password, trusted=False):
         """
         :param basestring account:
         :param basestring password:
         :param basestring api_host:
+        :param bool trusted: Данные уже проверены: объекты создаются без проверки аргументов, см.
+        XMLableObject.create_trusted
         """
         self._account = account
         self._password = password
+        self._trusted = trusted
+
+    def _create(self, object_class, **kwargs):
+        if self._trusted:
+            return object_class.create_trusted(**kwargs)
+        return object_class(**kwargs)
 
     def _get_secure(self, date):
         utc_date = self._format_date(date)
@@ -28,7 +39,53 @@ class CDEKObjectsFactoryAbastract(object):
         return date.strftime(u'%Y-%m-%d')
 
 
+def _get_column_length(columns, table_name):
+    lengths = set(len(x) for x in columns.values())
+    if len(lengths) > 1:
+        raise CDEKConfigurationError(u'Колонки {} разной длины'.format(table_name))
+    return lengths.pop() if lengths else 0
+
+
+def _check_columns(columns, required, allowed):
+    for name in required:
+        if name not in columns:
+            raise TypeError(u'"{}" keyword argument required!'.format(name))
+    for name in columns:
+        if name not in allowed:
+            raise AssertionError(u'Wrong keyword argument "{}"!'.format(name))
+
+
+def _build_objects(object_class, columns, count):
+    # Колонки уже проверены целиком, поэтому объекты создаются без проверок XMLableObject.__init__
+    names = [x.name for x in object_class.xml_attributes]
+    setters = [getattr(object_class, x).__set__ for x in names]
+    values = [columns[x] if x in columns else itertools.repeat(None, count) for x in names]
+    new = object_class.__new__
+    objects = []
+    for row in itertools.izip(*values):
+        obj = new(object_class)
+        for setter, value in itertools.izip(setters, row):
+            setter(obj, value)
+        objects.append(obj)
+    return objects
+
+
 class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
+    BULK_ORDER_NUMBER_COLUMN = u'order_number'
+    # Колонка упаковок и товаров со ссылкой на номер заказа
+
+    BULK_PACKAGE_NUMBER_COLUMN = u'package_number'
+    # Колонка товаров со ссылкой на номер упаковки в заказе
+
+    BULK_ADDRESS_COLUMNS = (u'street', u'house', u'flat', u'pvz_code')
+    # Колонки заказов с адресом доставки, см. factory_address
+
+    BULK_PASSPORT_COLUMNS = (u'passport_series', u'passport_number')
+    # Колонки заказов с паспортными данными получателя, см. factory_order
+
+    BULK_OBJECT_COLUMNS = {u'call_courier': CallCourierRequestObject, u'add_service': AddServiceRequestObject}
+    # Колонки заказов с готовыми объектами и их классы; пустые значения - None
+
     def factory_address(self, street, house, flat, pvz_code=None):
         """
         Инстанциирует CDEKAddress
@@ -41,7 +98,7 @@ class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
         режим доставки «до склада»
         :return:
         """
-        address = AddressRequestObject(street=street, house=house, flat=flat, pvz_code=pvz_code)
+        address = self._create(AddressRequestObject, street=street, house=house, flat=flat, pvz_code=pvz_code)
         return address
 
     def factory_item(self, ware_key, cost, payment, weight, weight_brutto, amount, link, comment=None):
@@ -65,9 +122,9 @@ class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
         :param basestring  comment: Наименование товара на русском (может также содержать описание товара: размер, цвет)
         :return:
         """
-        item = ItemRequestObject(ware_key=ware_key, cost=cost, payment=payment, weight=weight,
-                                 weight_brutto=weight_brutto,
-                                 amount=amount, link=link, comment=comment)
+        item = self._create(ItemRequestObject, ware_key=ware_key, cost=cost, payment=payment, weight=weight,
+                            weight_brutto=weight_brutto,
+                            amount=amount, link=link, comment=comment)
         return item
 
     def factory_package(self, number, weight, items, bar_code=None, size_a=None, size_b=None, size_c=None):
@@ -87,8 +144,8 @@ class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
         # Если bar_code не установлен то установить значение number
         if bar_code is None:
             bar_code = number
-        package = PackageRequestObject(number=number, bar_code=bar_code, weight=weight, item=items, size_a=size_a,
-                                       size_b=size_b, size_c=size_c)
+        package = self._create(PackageRequestObject, number=number, bar_code=bar_code, weight=weight, item=items,
+                               size_a=size_a, size_b=size_b, size_c=size_c)
         return package
 
     def factory_order(self, number, date_invoice, recipient_name, recipient_email, phone, tariff_type_code,
@@ -130,15 +187,16 @@ class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
             raise CDEKConfigurationError(u'send_city_code либо send_city_post_code должен быть указан')
 
         date_invoice = date_invoice.isoformat()
-        passport = PassportRequestObject(series=passport_series, number=passport_number)
-        order = OrderRequestObject(number=number, date_invoice=date_invoice, recipient_name=recipient_name,
-                                   recipient_email=recipient_email, phone=phone, tariff_type_code=tariff_type_code,
-                                   seller_name=seller_name, address=address, package=packages,
-                                   send_city_code=send_city_code,
-                                   rec_city_code=rec_city_code, send_city_post_code=send_city_post_code,
-                                   rec_city_post_code=rec_city_post_code, comment=comment, passport=passport,
-                                   call_courier=call_courier, add_service=add_service,
-                                   delivery_recipient_cost=delivery_recipient_cost)
+        passport = self._create(PassportRequestObject, series=passport_series, number=passport_number)
+        order = self._create(OrderRequestObject, number=number, date_invoice=date_invoice,
+                             recipient_name=recipient_name,
+                             recipient_email=recipient_email, phone=phone, tariff_type_code=tariff_type_code,
+                             seller_name=seller_name, address=address, package=packages,
+                             send_city_code=send_city_code,
+                             rec_city_code=rec_city_code, send_city_post_code=send_city_post_code,
+                             rec_city_post_code=rec_city_post_code, comment=comment, passport=passport,
+                             call_courier=call_courier, add_service=add_service,
+                             delivery_recipient_cost=delivery_recipient_cost)
         return order
 
     def factory_delivery_request(self, orders, number, date):
@@ -153,11 +211,126 @@ class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
         """
         assert isinstance(orders, list)
         secure = self._get_secure(date)
-        delivery_request = DeliveryRequestObject(order=orders, number=number, date=self._format_date(date),
-                                                 account=self._account, secure=secure, order_count=len(orders))
+        delivery_request = self._create(DeliveryRequestObject, order=orders, number=number,
+                                        date=self._format_date(date), account=self._account, secure=secure,
+                                        order_count=len(orders))
         return delivery_request
 
-    def factory_call(self, date, time_beg, time_end, send_city_code, lunch_beg=None, lunch_end=None):
+    def factory_orders_bulk(self, orders, packages, items):
+        """
+        Инстанциирует список OrderRequestObject по колоночным данным: каждая таблица - словарь «имя колонки - список
+        значений», все колонки таблицы одной длины. Имена колонок совпадают с аргументами factory_order,
+        factory_address, factory_package и factory_item; упаковки ссылаются на заказ колонкой order_number, товары - на
+        заказ и упаковку колонками order_number и package_number. Проверки выполняются один раз для каждой колонки, а
+        не для каждого объекта, поэтому построение десятков тысяч заказов в разы быстрее вызовов factory_* в цикле
+        :param dict orders: Колонки заказов, включая колонки адреса street, house, flat, pvz_code и паспорта
+        passport_series, passport_number
+        :param dict packages: Колонки упаковок
+        :param dict items: Колонки товаров
+        :rtype: list
+        """
+        order_fields = set(x.name for x in OrderRequestObject.xml_attributes) - {u'address', u'package', u'passport'}
+        _check_columns(orders,
+                       required=[x.name for x in OrderRequestObject.xml_attributes if x.required and
+                                 x.name in order_fields] + [x for x in self.BULK_ADDRESS_COLUMNS if x != u'pvz_code'],
+                       allowed=order_fields | set(self.BULK_ADDRESS_COLUMNS) | set(self.BULK_PASSPORT_COLUMNS))
+        _check_columns(packages,
+                       required=[self.BULK_ORDER_NUMBER_COLUMN, u'number', u'weight'],
+                       allowed=set(x.name for x in PackageRequestObject.xml_attributes) - {u'item'} |
+                               {self.BULK_ORDER_NUMBER_COLUMN})
+        _check_columns(items,
+                       required=[self.BULK_ORDER_NUMBER_COLUMN, self.BULK_PACKAGE_NUMBER_COLUMN] +
+                                [x.name for x in ItemRequestObject.xml_attributes if x.required],
+                       allowed=set(x.name for x in ItemRequestObject.xml_attributes) |
+                               {self.BULK_ORDER_NUMBER_COLUMN, self.BULK_PACKAGE_NUMBER_COLUMN})
+        order_count = _get_column_length(orders, u'заказов')
+        package_count = _get_column_length(packages, u'упаковок')
+        item_count = _get_column_length(items, u'товаров')
+
+        order_numbers = orders[u'number']
+        if len(set(order_numbers)) != order_count:
+            raise CDEKConfigurationError(u'Номера заказов должны быть уникальны')
+        for city_code, city_post_code in ((u'rec_city_code', u'rec_city_post_code'),
+                                          (u'send_city_code', u'send_city_post_code')):
+            city_codes = orders.get(city_code) or itertools.repeat(None, order_count)
+            city_post_codes = orders.get(city_post_code) or itertools.repeat(None, order_count)
+            if any(x is None and y is None for x, y in itertools.izip(city_codes, city_post_codes)):
+                raise CDEKConfigurationError(u'{} либо {} должен быть указан'.format(city_code, city_post_code))
+        for name, object_class in self.BULK_OBJECT_COLUMNS.items():
+            if name in orders:
+                assert all(x is None or isinstance(x, object_class) for x in orders[name])
+
+        package_items = collections.defaultdict(list)
+        for key, item in itertools.izip(
+                itertools.izip(items[self.BULK_ORDER_NUMBER_COLUMN], items[self.BULK_PACKAGE_NUMBER_COLUMN]),
+                _build_objects(ItemRequestObject, items, item_count)):
+            package_items[key].append(item)
+
+        package_columns = dict(packages)
+        if u'bar_code' in package_columns:
+            package_columns[u'bar_code'] = [x if x is not None else y
+                                            for x, y in itertools.izip(packages[u'bar_code'], packages[u'number'])]
+        else:
+            package_columns[u'bar_code'] = packages[u'number']
+        package_keys = list(itertools.izip(packages[self.BULK_ORDER_NUMBER_COLUMN], packages[u'number']))
+        if len(set(package_keys)) != package_count:
+            raise CDEKConfigurationError(u'Номера упаковок должны быть уникальны в пределах заказа')
+        package_columns[u'item'] = [package_items.pop(x, []) for x in package_keys]
+        if package_items:
+            raise CDEKConfigurationError(u'Товары ссылаются на несуществующие упаковки: {}'.format(
+                u', '.join(u'{}/{}'.format(*x) for x in sorted(package_items))))
+        order_packages = collections.defaultdict(list)
+        for (order_number, _), package in itertools.izip(package_keys,
+                                                         _build_objects(PackageRequestObject, package_columns,
+                                                                        package_count)):
+            order_packages[order_number].append(package)
+
+        order_columns = dict((x, y) for x, y in orders.items()
+                             if x not in self.BULK_ADDRESS_COLUMNS and x not in self.BULK_PASSPORT_COLUMNS)
+        order_columns[u'date_invoice'] = [x if isinstance(x, basestring) else x.isoformat()
+                                          for x in orders[u'date_invoice']]
+        order_columns[u'address'] = _build_objects(AddressRequestObject, orders, order_count)
+        order_columns[u'passport'] = _build_objects(
+            PassportRequestObject,
+            dict((x[len(u'passport_'):], y) for x, y in orders.items() if x in self.BULK_PASSPORT_COLUMNS),
+            order_count)
+        order_columns[u'package'] = [order_packages.pop(x, []) for x in order_numbers]
+        if order_packages:
+            raise CDEKConfigurationError(u'Упаковки ссылаются на несуществующие заказы: {}'.format(
+                u', '.join(sorted(order_packages))))
+        return _build_objects(OrderRequestObject, order_columns, order_count)
+
+    def factory_delivery_request_bulk(self, orders, packages, items, number, date):
+        """
+        Инстанциирует DeliveryRequestObject по колоночным данным, см. factory_orders_bulk. Для отправки без построения
+        дерева ElementTree используйте его вместе с CDEKAPI(serializer=CDEKAPI.SERIALIZER_BYTES) или
+        cdek.writer.to_xml_bytes
+        :param dict orders: Колонки заказов
+        :param dict packages: Колонки упаковок
+        :param dict items: Колонки товаров
+        :param basestring number: Номер акта приема-передачи/ТТН
+        :param datetime.datetime date: Дата документа (дата заказа)
+        :rtype: cdek.objects.request.DeliveryRequestObject
+        """
+        return self.factory_delivery_request(self.factory_orders_bulk(orders, packages, items), number, date)
+
+    @staticmethod
+    def columns_from_rows(rows, column_names=None):
+        """
+        Переводит строки в колонки для factory_orders_bulk
+        :param collections.Iterable rows: Словари (например, csv.DictReader) или кортежи (строки курсора БД)
+        :param list column_names: Имена колонок для кортежей, например [x[0] for x in cursor.description]
+        :rtype: dict
+        """
+        rows = list(rows)
+        if column_names is None:
+            column_names = list(rows[0]) if rows else []
+            return dict((x, [row.get(x) for row in rows]) for x in column_names)
+        if not rows:
+            return dict((x, []) for x in column_names)
+        return dict(itertools.izip(column_names, (list(x) for x in itertools.izip(*rows))))
+
+    def factory_call(self, date, time_beg, time_end, send_city_code, lunch_beg=None, lunch_end=None, frozen=False):
         """
         Инстанциирует CDEKCall
         :rtype : cdek.objects.request.CDEKCall
@@ -167,13 +340,16 @@ class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
         :param int send_city_code: Код города отправителя из базы СДЭК
         :param datetime.time lunch_beg: Время начала обеда, если входит во временной диапазон [TimeBeg; TimeEnd]
         :param datetime.time lunch_end: Время окончания обеда, если входит во временной диапазон [TimeBeg; TimeEnd]
+        :param bool frozen: Создать неизменяемый объект, который сериализуется один раз, см. FrozenXMLableObject
         :return:
         """
-        call = CDEKCall(date=date.isoformat(), time_beg=time_beg.isoformat(), time_end=time_end.isoformat(),
-                        send_city_code=send_city_code, lunch_beg=lunch_beg.isoformat(), lunch_end=lunch_end.isoformat())
+        call_class = FrozenCDEKCall if frozen else CDEKCall
+        call = self._create(call_class, date=date.isoformat(), time_beg=time_beg.isoformat(),
+                            time_end=time_end.isoformat(), send_city_code=send_city_code,
+                            lunch_beg=lunch_beg.isoformat(), lunch_end=lunch_end.isoformat())
         return call
 
-    def factory_send_address(self, street, house, flat, send_phone, sender_name, comment=None):
+    def factory_send_address(self, street, house, flat, send_phone, sender_name, comment=None, frozen=False):
         """
         Инстанциирует CDEKSendAddress
         :rtype : SendAddressRequestObject
@@ -183,34 +359,42 @@ class CDEKRequestDeliveryObjectsFactory(CDEKObjectsFactoryAbastract):
         :param basestring send_phone:Контактный телефон отправителя
         :param basestring sender_name:Отправитель (ФИО)
         :param basestring comment:Комментарий
+        :param bool frozen: Создать неизменяемый объект, который сериализуется один раз, см. FrozenXMLableObject
         :return:
         """
-        address = SendAddressRequestObject(street=street, house=house, flat=flat, send_phone=send_phone,
-                                           sender_name=sender_name,
-                                           comment=comment)
+        address_class = FrozenSendAddressRequestObject if frozen else SendAddressRequestObject
+        address = self._create(address_class, street=street, house=house, flat=flat, send_phone=send_phone,
+                               sender_name=sender_name, comment=comment)
         return address
 
-    def factory_call_courier(self, call, send_address):
+    def factory_call_courier(self, call, send_address, frozen=False):
         """
         Инстанциирует CDEKCallCourier
         :rtype : cdek.objects.request.CDEKCallCourier
         :param CDEKCall call:
         :param CDEKSendAddress send_address:
+        :param bool frozen: Создать неизменяемый объект, который сериализуется один раз, см. FrozenXMLableObject.
+        call и send_address тоже должны быть созданы с frozen=True
         :return:
         """
         assert isinstance(call, CDEKCall)
         assert isinstance(send_address, SendAddressRequestObject)
-        call_courier = CallCourierRequestObject(call=call, send_address=send_address)
+        call_courier_class = FrozenCallCourierRequestObject if frozen else CallCourierRequestObject
+        call_courier = self._create(call_courier_class, call=call, send_address=send_address)
         return call_courier
 
-    def factory_add_service(self, service_codes):
+    def factory_add_service(self, service_codes, frozen=False):
         """
         Инстанциирует CDEKAddService
         :param list|tuple|set service_codes: Тип дополнительной услуги
+        :param bool frozen: Создать неизменяемый объект, который сериализуется один раз, см. FrozenXMLableObject
         :return:
         """
         assert isinstance(service_codes, (list, tuple, set))
-        add_service = AddServiceRequestObject(service_code=service_codes)
+        if frozen:
+            add_service = self._create(FrozenAddServiceRequestObject, service_code=list(service_codes))
+        else:
+            add_service = self._create(AddServiceRequestObject, service_code=service_codes)
         return add_service
 
 
@@ -226,7 +410,7 @@ class CDEKStatusReportObjectsFactory(CDEKObjectsFactoryAbastract):
         if date:
             date = date.isoformat()
         assert (dispatch_number or (number and date))
-        return OrderStatusObject(dispatch_number=dispatch_number, number=number, date=date)
+        return self._create(OrderStatusObject, dispatch_number=dispatch_number, number=number, date=date)
 
     def factory_change_period(self, date_first, date_last=None):
         """
@@ -236,7 +420,7 @@ class CDEKStatusReportObjectsFactory(CDEKObjectsFactoryAbastract):
         :return:
         """
         assert date_first
-        return ChangePeriodStatusObject(date_first=date_first, date_last=date_last)
+        return self._create(ChangePeriodStatusObject, date_first=date_first, date_last=date_last)
 
     def factory_status_report(self, date, orders=None, change_period=None, show_history=False):
         """
@@ -248,5 +432,6 @@ class CDEKStatusReportObjectsFactory(CDEKObjectsFactoryAbastract):
         """
         assert orders or change_period
         secure = self._get_secure(date)
-        return StatusReportObject(change_period=change_period, order=orders, date=self._format_date(date),
-                                  account=self._account, secure=secure, show_history=show_history)
\ No newline at end of file
+        return self._create(StatusReportObject, change_period=change_period, order=orders,
+                            date=self._format_date(date), account=self._account, secure=secure,
+                            show_history=show_history)
\ No newline at end of file
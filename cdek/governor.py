@@ -0,0 +1,197 @@
+# coding=utf-8
+"""
+Ограничение количества одновременных запросов к шлюзу, подстраивающееся под его задержки и ошибки
+"""
+import socket
+import threading
+import time
+
+from cdek.api import CDEKAPI
+from cdek.exceptions import CDEKHTTPError
+
+
+class ConcurrencyGovernor(object):
+    """
+    Лимит одновременных запросов по схеме AIMD: каждый успешный запрос, уложившийся в latency_target, увеличивает
+    лимит на increase / limit (то есть примерно на increase за «поколение» запросов), медленный или завершившийся
+    ошибкой запрос умножает лимит на decrease_factor. Сигналы запросов, начатых до последнего уменьшения, лимит не
+    уменьшают: иначе одна перегрузка, замеченная всеми одновременными запросами, обрушила бы его до минимума.
+    Дополнительно можно ограничить частоту начала запросов. Можно использовать из нескольких потоков
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, latency_target=1.0, increase=1.0,
+                 decrease_factor=0.5, max_rate=None, clock=time.time):
+        """
+        :param int initial_limit: Начальный лимит одновременных запросов
+        :param int min_limit:
+        :param int max_limit:
+        :param float latency_target: Время запроса в секундах, после которого он считается медленным
+        :param float increase: Прирост лимита за поколение успешных запросов
+        :param float decrease_factor: Множитель лимита при медленном или неудачном запросе
+        :param float max_rate: Максимальное количество запросов в секунду, None - без ограничения
+        :param callable clock:
+        """
+        self._limit = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._latency_target = latency_target
+        self._increase = increase
+        self._decrease_factor = decrease_factor
+        self._interval = 1.0 / max_rate if max_rate else None
+        self._clock = clock
+        self._in_flight = 0
+        self._queue_depth = 0
+        self._next_start = None
+        self._last_decrease = None
+        self._condition = threading.Condition()
+        self.successes = 0
+        self.slowdowns = 0
+        self.errors = 0
+
+    @property
+    def limit(self):
+        """
+        :rtype: int
+        """
+        return max(self._min_limit, int(self._limit))
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        """
+        :rtype: int
+        :return: Количество запросов, ожидающих свободного места
+        """
+        return self._queue_depth
+
+    def acquire(self, timeout=None):
+        """
+        Ждет, пока количество выполняющихся запросов станет меньше лимита
+        :param float timeout: Максимальное время ожидания в секундах
+        :rtype: float
+        :return: Время начала запроса, которое нужно передать в release
+        """
+        deadline = self._clock() + timeout if timeout is not None else None
+        with self._condition:
+            self._queue_depth += 1
+            try:
+                while True:
+                    wait = None
+                    if self._in_flight < self.limit:
+                        now = self._clock()
+                        if self._next_start is None or now >= self._next_start:
+                            break
+                        wait = self._next_start - now
+                    if deadline is not None:
+                        remaining = deadline - self._clock()
+                        if remaining <= 0:
+                            raise socket.timeout(u'No free slot in governor')
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self._queue_depth -= 1
+            self._in_flight += 1
+            started = self._clock()
+            if self._interval is not None:
+                self._next_start = max(self._next_start or started, started) + self._interval
+            return started
+
+    def release(self, started, error=False):
+        """
+        Учитывает завершение запроса и пересчитывает лимит
+        :param float started: Результат acquire
+        :param bool error: Запрос завершился ошибкой
+        """
+        latency = self._clock() - started
+        with self._condition:
+            self._in_flight -= 1
+            if error or latency > self._latency_target:
+                if error:
+                    self.errors += 1
+                else:
+                    self.slowdowns += 1
+                if self._last_decrease is None or started >= self._last_decrease:
+                    self._limit = max(float(self._min_limit), self._limit * self._decrease_factor)
+                    self._last_decrease = self._clock()
+            else:
+                self.successes += 1
+                self._limit = min(float(self._max_limit), self._limit + self._increase / self._limit)
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._condition:
+            return {
+                u'limit': self.limit,
+                u'in_flight': self._in_flight,
+                u'queue_depth': self._queue_depth,
+                u'successes': self.successes,
+                u'slowdowns': self.slowdowns,
+                u'errors': self.errors,
+            }
+
+
+class GovernedCDEKAPI(object):
+    """
+    Прослойка над CDEKAPI, пропускающая make_delivery_request и make_status_report_request через
+    ConcurrencyGovernor. Ошибкой для лимита считаются только признаки перегрузки шлюза: ошибки соединения
+    (CDEKAPI.TRANSPORT_ERRORS, CDEKHTTPError) и заказы с ошибкой CDEKAPI.BATCH_ERROR_CODE. Ошибки отдельных заказов и
+    прочие исключения лимит не уменьшают
+    """
+
+    def __init__(self, api, governor=None, queue_timeout=None):
+        """
+        :param cdek.api.CDEKAPI api:
+        :param ConcurrencyGovernor governor: По умолчанию свой с настройками по умолчанию
+        :param float queue_timeout: Максимальное время ожидания свободного места в секундах
+        """
+        self._api = api
+        self._governor = governor if governor is not None else ConcurrencyGovernor()
+        self._queue_timeout = queue_timeout
+
+    @property
+    def governor(self):
+        return self._governor
+
+    @property
+    def limit(self):
+        return self._governor.limit
+
+    @property
+    def queue_depth(self):
+        return self._governor.queue_depth
+
+    def make_delivery_request(self, delivery_request, method_url=u'new_orders.php'):
+        """
+        :param cdek.objects.request.DeliveryRequestObject delivery_request:
+        :param basestring method_url:
+        :rtype: cdek.base.Response
+        """
+        return self._call(self._api.make_delivery_request, delivery_request, method_url)
+
+    def make_status_report_request(self, status_report, method_url=u'status_report_h.php'):
+        """
+        :param cdek.objects.status.StatusReportObject status_report:
+        :param basestring method_url:
+        :rtype: cdek.base.Response
+        """
+        return self._call(self._api.make_status_report_request, status_report, method_url)
+
+    def _call(self, method, xml_object, method_url):
+        started = self._governor.acquire(self._queue_timeout)
+        try:
+            api_response = method(xml_object, method_url)
+        except CDEKAPI.TRANSPORT_ERRORS + (CDEKHTTPError,):
+            self._governor.release(started, error=True)
+            raise
+        except Exception:
+            self._governor.release(started)
+            raise
+        self._governor.release(started, error=any(x.code == CDEKAPI.BATCH_ERROR_CODE
+                                                  for order in api_response.data for x in order.errors))
+        return api_response
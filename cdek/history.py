@@ -0,0 +1,301 @@
+# coding=utf-8
+"""
+Компактное хранение истории статусов заказов (StatusReport с ShowHistory): коды статусов, время и города всех
+заказов лежат в общих массивах, названия городов хранятся один раз
+"""
+import calendar
+import datetime
+import re
+import threading
+import time
+from array import array
+
+from cdek.base import ResponseStatus
+
+_DATE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?(?:([+-])(\d{2}):?(\d{2})|Z)?$')
+
+
+def parse_timestamp(date):
+    """
+    Переводит дату шлюза вида 2015-01-01T12:00:00+03:00 во время UNIX
+    :param basestring date:
+    :rtype: float
+    """
+    match = _DATE_PATTERN.match(date)
+    if match is None:
+        raise ValueError(u'Wrong date "{}"'.format(date))
+    local_date, sign, hours, minutes = match.groups()
+    timestamp = calendar.timegm(time.strptime(local_date, u'%Y-%m-%dT%H:%M:%S'))
+    if sign is not None:
+        offset = int(hours) * 3600 + int(minutes) * 60
+        timestamp -= offset if sign == u'+' else -offset
+    return float(timestamp)
+
+
+def format_timestamp(timestamp):
+    """
+    :param float timestamp:
+    :rtype: unicode
+    :return: Дата в UTC вида 2015-01-01T09:00:00+00:00
+    """
+    return unicode(datetime.datetime.utcfromtimestamp(timestamp).isoformat()) + u'+00:00'
+
+
+class StatusTimeline(object):
+    """
+    История статусов одного заказа, хранящаяся в StatusHistory. Элементы - ResponseStatus без описания, даты в UTC.
+    Чтения выполняются под блокировкой хранилища, поэтому видят границы и массивы одного и того же состояния
+    """
+    __slots__ = ('_history', '_key')
+
+    def __init__(self, history, key):
+        """
+        :param StatusHistory history:
+        :param tuple key: Ключ заказа, см. StatusHistory.dispatch_number_key и StatusHistory.number_key
+        """
+        self._history = history
+        self._key = key
+
+    def _bounds(self):
+        return self._history._bounds[self._key]
+
+    def _status(self, position):
+        history = self._history
+        city_index = history.cities[position]
+        return ResponseStatus(city_code=history.city_codes[city_index], city_name=history.city_names[city_index],
+                              code=history.codes[position], date=format_timestamp(history.timestamps[position]),
+                              description=None)
+
+    def __len__(self):
+        with self._history._lock:
+            start, stop = self._bounds()
+        return stop - start
+
+    def __getitem__(self, index):
+        with self._history._lock:
+            start, stop = self._bounds()
+            return self._status(xrange(start, stop)[index])
+
+    def __iter__(self):
+        with self._history._lock:
+            start, stop = self._bounds()
+            statuses = [self._status(x) for x in xrange(start, stop)]
+        return iter(statuses)
+
+    @property
+    def codes(self):
+        with self._history._lock:
+            start, stop = self._bounds()
+            return self._history.codes[start:stop]
+
+    @property
+    def timestamps(self):
+        with self._history._lock:
+            start, stop = self._bounds()
+            return self._history.timestamps[start:stop]
+
+    def time_in(self, codes, now=None):
+        """
+        :param set codes: Коды статусов
+        :param float now: Время, до которого длится последний статус, по умолчанию текущее
+        :rtype: float
+        :return: Сколько секунд заказ провел в статусах codes
+        """
+        now = time.time() if now is None else now
+        with self._history._lock:
+            start, stop = self._bounds()
+            return self._history._time_in(start, stop, codes, now)
+
+    def time_in_transit(self, now=None):
+        """
+        :rtype: float
+        :return: Сколько секунд заказ был в пути между складами отправителя и получателя
+        """
+        return self.time_in(StatusHistory.TRANSIT_STATUS_CODES, now)
+
+    def last_transition(self):
+        """
+        :rtype: tuple|None
+        :return: Предыдущий код статуса, текущий код статуса и время перехода
+        """
+        with self._history._lock:
+            start, stop = self._bounds()
+            return self._history._last_transition(start, stop)
+
+    def __repr__(self):
+        return '<StatusTimeline: {} {}>'.format(self._key, list(self.codes))
+
+
+class StatusHistory(object):
+    """
+    Истории статусов многих заказов в общих массивах: код статуса (array 'i'), время UNIX (array 'd') и индекс
+    города (array 'I') на каждый статус. История заказа заменяется при повторном добавлении; место, занятое
+    замененными историями, освобождается, когда его становится больше, чем занятого актуальными. Добавление и чтение
+    историй из нескольких потоков безопасно. Истории не вытесняются: хранилище растет с количеством заказов, и
+    долгоживущему процессу стоит периодически заменять его новым. Номера отправлений и номера заказов пересекаются,
+    поэтому ключи историй разделены, см. dispatch_number_key и number_key
+    """
+    TRANSIT_STATUS_CODES = frozenset([
+        ResponseStatus.STATUS_CODE_ISSUED_TO_SEND_FROM_SENDER_STORAGE,
+        ResponseStatus.STATUS_CODE_ISSUED_TO_SHIPPER_IN_SENDER_STORAGE,
+        ResponseStatus.STATUS_CODE_SENT_TO_TRANSIT_CITY,
+        ResponseStatus.STATUS_CODE_RECEIVED_IN_TRANSIT_CITY,
+        ResponseStatus.STATUS_CODE_ACCEPTED_TO_TRANSIT_STORAGE,
+        ResponseStatus.STATUS_CODE_RETURNED_TO_TRANSIT_STORAGE,
+        ResponseStatus.STATUS_CODE_ISSUED_TO_SEND_FROM_TRANSIT_STORAGE,
+        ResponseStatus.STATUS_CODE_ISSUED_TO_SHIPPER_IN_TRANSIT_STORAGE,
+        ResponseStatus.STATUS_CODE_SENT_TO_RECEIVER_CITY,
+        ResponseStatus.STATUS_CODE_RECEIVED_IN_RECEIVER_CITY,
+    ])
+    # Статусы от расхода со склада города-отправителя до прихода на склад города-получателя
+
+    def __init__(self):
+        self.codes = array('i')
+        self.timestamps = array('d')
+        self.cities = array('I')
+        self.invalid_states = 0
+        self.city_codes = []
+        self.city_names = []
+        self._city_index = {}
+        self._bounds = {}
+        self._garbage = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def __contains__(self, key):
+        return key in self._bounds
+
+    def keys(self):
+        with self._lock:
+            return self._bounds.keys()
+
+    @staticmethod
+    def dispatch_number_key(dispatch_number):
+        return u'dispatch_number', dispatch_number
+
+    @staticmethod
+    def number_key(number):
+        return u'number', number
+
+    def timeline(self, key):
+        """
+        :param tuple key: Ключ заказа, см. dispatch_number_key и number_key
+        :rtype: StatusTimeline|None
+        """
+        if key not in self._bounds:
+            return None
+        return StatusTimeline(self, key)
+
+    def add(self, key, states):
+        """
+        Добавляет или заменяет историю заказа
+        :param tuple key: Ключ заказа, см. dispatch_number_key и number_key
+        :param collections.Iterable states: Кортежи (время UNIX, код статуса, код города, название города) в порядке
+        смены статусов
+        :rtype: StatusTimeline
+        """
+        states = list(states)
+        with self._lock:
+            start = len(self.codes)
+            for timestamp, code, city_code, city_name in states:
+                self.codes.append(code)
+                self.timestamps.append(timestamp)
+                self.cities.append(self._intern_city(city_code, city_name))
+            previous = self._bounds.get(key)
+            self._bounds[key] = (start, len(self.codes))
+            if previous is not None:
+                self._garbage += previous[1] - previous[0]
+                if self._garbage > len(self.codes) - self._garbage:
+                    self._compact()
+        return StatusTimeline(self, key)
+
+    def add_element(self, key, status_element):
+        """
+        Добавляет историю из элемента Status ответа шлюза: его элементы State в порядке смены статусов. Элементы
+        State с неразборчивой датой или кодом пропускаются и учитываются в invalid_states
+        :param tuple key: Ключ заказа, см. dispatch_number_key и number_key
+        :param xml.etree.ElementTree.Element status_element:
+        :rtype: StatusTimeline
+        """
+        states = []
+        for state_element in status_element.findall(u'State'):
+            try:
+                states.append((parse_timestamp(state_element.get(u'Date') or u''), int(state_element.get(u'Code')),
+                               state_element.get(u'CityCode'), state_element.get(u'CityName')))
+            except (TypeError, ValueError):
+                with self._lock:
+                    self.invalid_states += 1
+        return self.add(key, states)
+
+    def compact(self):
+        """
+        Освобождает место, занятое замененными историями
+        """
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        codes = array('i')
+        timestamps = array('d')
+        cities = array('I')
+        bounds = {}
+        for key, (start, stop) in self._bounds.items():
+            bounds[key] = (len(codes), len(codes) + stop - start)
+            codes.extend(self.codes[start:stop])
+            timestamps.extend(self.timestamps[start:stop])
+            cities.extend(self.cities[start:stop])
+        self.codes, self.timestamps, self.cities, self._bounds = codes, timestamps, cities, bounds
+        self._garbage = 0
+
+    def time_in_transit(self, now=None):
+        """
+        :param float now: Время, до которого длится последний статус, по умолчанию текущее
+        :rtype: dict
+        :return: Сколько секунд каждый заказ был в пути
+        """
+        return self.time_in(self.TRANSIT_STATUS_CODES, now)
+
+    def time_in(self, codes, now=None):
+        """
+        :param set codes: Коды статусов
+        :param float now: Время, до которого длится последний статус, по умолчанию текущее
+        :rtype: dict
+        :return: Сколько секунд каждый заказ провел в статусах codes
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return dict((key, self._time_in(start, stop, codes, now)) for key, (start, stop) in self._bounds.items())
+
+    def last_transitions(self):
+        """
+        :rtype: dict
+        :return: Последний переход каждого заказа: предыдущий код статуса, текущий код статуса и время перехода
+        """
+        with self._lock:
+            return dict((key, self._last_transition(start, stop)) for key, (start, stop) in self._bounds.items())
+
+    def _intern_city(self, city_code, city_name):
+        key = (city_code, city_name)
+        index = self._city_index.get(key)
+        if index is None:
+            index = self._city_index[key] = len(self.city_codes)
+            self.city_codes.append(city_code)
+            self.city_names.append(city_name)
+        return index
+
+    def _time_in(self, start, stop, codes, now):
+        codes_array = self.codes
+        timestamps = self.timestamps
+        total = 0.0
+        for position in xrange(start, stop):
+            if codes_array[position] in codes:
+                ended = timestamps[position + 1] if position + 1 < stop else now
+                total += ended - timestamps[position]
+        return total
+
+    def _last_transition(self, start, stop):
+        if stop - start < 2:
+            return None
+        return self.codes[stop - 2], self.codes[stop - 1], self.timestamps[stop - 1]
@@ -0,0 +1,118 @@
+# coding=utf-8
+import bisect
+import threading
+
+
+class CallMetrics(object):
+    """
+    Замеры одного вызова CDEKAPI: время по фазам в секундах, размеры запроса и ответа в байтах, количество заказов
+    """
+    __slots__ = ('method_url', 'phases', 'request_bytes', 'response_bytes', 'order_count', 'error')
+
+    PHASE_TO_XML_ELEMENT = u'to_xml_element'
+    PHASE_TOSTRING = u'tostring'
+    PHASE_TO_XML_BYTES = u'to_xml_bytes'
+    PHASE_ENCODE = u'encode'
+    PHASE_QUEUE = u'queue'
+    # Ожидание свободного слота в AsyncCDEKAPI
+    PHASE_NETWORK = u'network'
+    # Отправка запроса и получение заголовков ответа
+    PHASE_PARSE = u'parse'
+    # Чтение тела ответа и его разбор
+
+    def __init__(self, method_url, order_count=None):
+        self.method_url = method_url
+        self.phases = {}
+        self.request_bytes = None
+        self.response_bytes = None
+        self.order_count = order_count
+        self.error = None
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def __repr__(self):
+        return '<CallMetrics: {} {:.4f}s>'.format(self.method_url, self.total)
+
+
+class Histogram(object):
+    """
+    Гистограмма с фиксированными границами корзин
+    """
+    TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+    SIZE_BUCKETS = (1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26)
+    COUNT_BUCKETS = (1, 10, 100, 1000, 10000)
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def export(self):
+        """
+        :rtype: dict
+        :return: Количество наблюдений, их сумма и накопленные количества по верхним границам корзин
+        """
+        cumulative = 0
+        buckets = []
+        for upper_bound, count in zip(self._buckets + (u'+Inf',), self._counts):
+            cumulative += count
+            buckets.append([upper_bound, cumulative])
+        return {u'count': self.count, u'sum': self.sum, u'buckets': buckets}
+
+
+class MetricsRegistry(object):
+    """
+    Счетчики и гистограммы в памяти процесса. Экземпляр можно передать в CDEKAPI.add_hook: для каждого вызова он
+    считает вызовы и ошибки и раскладывает фазы, размеры и количество заказов по гистограммам с именами вида
+    «new_orders.php.network»
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=Histogram.TIME_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def __call__(self, call_metrics):
+        """
+        :param CallMetrics call_metrics:
+        """
+        prefix = call_metrics.method_url
+        self.increment(u'{}.calls'.format(prefix))
+        if call_metrics.error is not None:
+            self.increment(u'{}.errors'.format(prefix))
+        for phase, duration in call_metrics.phases.items():
+            self.observe(u'{}.{}'.format(prefix, phase), duration)
+        for name, value, buckets in ((u'request_bytes', call_metrics.request_bytes, Histogram.SIZE_BUCKETS),
+                                     (u'response_bytes', call_metrics.response_bytes, Histogram.SIZE_BUCKETS),
+                                     (u'order_count', call_metrics.order_count, Histogram.COUNT_BUCKETS)):
+            if value is not None:
+                self.observe(u'{}.{}'.format(prefix, name), value, buckets)
+
+    def export(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                u'counters': dict(self._counters),
+                u'histograms': dict((name, x.export()) for name, x in self._histograms.items()),
+            }
@@ -1,5 +1,5 @@
 # encoding=utf8
-from cdek.base import XMLableObject, XMLAttribute
+from cdek.base import XMLableObject, XMLAttribute, FrozenXMLableObject
 
 
 class PassportRequestObject(XMLableObject):
@@ -124,4 +124,20 @@ class AddServiceRequestObject(XMLableObject):
 
     xml_attributes = (
         XMLAttribute(u'service_code', True),
-    )
\ No newline at end of file
+    )
+
+
+class FrozenCallCourierRequestObject(FrozenXMLableObject, CallCourierRequestObject):
+    __slots__ = ('_fragments',)
+
+
+class FrozenCDEKCall(FrozenXMLableObject, CDEKCall):
+    __slots__ = ('_fragments',)
+
+
+class FrozenSendAddressRequestObject(FrozenXMLableObject, SendAddressRequestObject):
+    __slots__ = ('_fragments',)
+
+
+class FrozenAddServiceRequestObject(FrozenXMLableObject, AddServiceRequestObject):
+    __slots__ = ('_fragments',)
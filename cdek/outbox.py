@@ -0,0 +1,312 @@
+# coding=utf-8
+"""
+Локальная очередь заказов на регистрацию в SQLite: заказы принимаются сразу, а отправляются в шлюз фоновым потоком
+"""
+import collections
+import cPickle as pickle
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from cdek.api import CDEKAPI
+from cdek.base import ResponseError, ResponseOrder
+
+logger = logging.getLogger(__name__)
+
+OutboxEntry = collections.namedtuple(u'OutboxEntry', [u'number', u'state', u'act_number', u'date', u'response_order'])
+
+
+class DeliveryOutbox(object):
+    """
+    Очередь заказов на регистрацию, переживающая перезапуск процесса. enqueue сохраняет заказ в файл и сразу
+    возвращает управление; фоновый поток собирает заказы в DeliveryRequest, когда их набралось batch_size или
+    самый старый ждет дольше max_delay, и записывает результат каждого заказа обратно в очередь.
+
+    Перед отправкой заказы пачки помечаются как отправляемые вместе с номером и датой акта. Номер заказа уникален
+    только в пределах акта, поэтому заказ, судьба которого неизвестна, не отправляется повторно с новым номером акта,
+    а сверяется со шлюзом через StatusReport по номеру заказа и дате акта: найденные считаются зарегистрированными,
+    остальные снова ставятся в очередь. Так разбираются заказы, отправка которых была прервана перезапуском
+    процесса (при start), и заказы пачек, оборвавшихся ошибкой соединения, таймаутом или некорректным ответом
+    (фоновым потоком через retry_delay; пока сверка не удалась, она повторяется с тем же интервалом). Ошибка
+    ERR_ORDER_DUBL_EXISTS при повторной отправке тоже означает, что заказ уже зарегистрирован. Номер заказа в
+    очереди уникален, повторно он не принимается
+    """
+    STATE_QUEUED = u'queued'
+    STATE_SENDING = u'sending'
+    STATE_SENT = u'sent'
+    STATE_FAILED = u'failed'
+
+    DUPLICATE_ERROR_CODE = u'ERR_ORDER_DUBL_EXISTS'
+    # Заказ с таким номером уже зарегистрирован
+
+    def __init__(self, api, factory, status_factory, path, number_prefix=u'outbox', batch_size=100, max_delay=1.0,
+                 retry_delay=5.0, start=True):
+        """
+        :param cdek.api.CDEKAPI api: Или другой клиент с методами make_delivery_request и make_status_report_request
+        :param cdek.factory.CDEKRequestDeliveryObjectsFactory factory:
+        :param cdek.factory.CDEKStatusReportObjectsFactory status_factory: Для сверки заказов с неизвестной судьбой
+        :param basestring path: Путь к файлу базы данных
+        :param basestring number_prefix: Префикс номеров актов, к нему добавляется номер пачки
+        :param int batch_size: Максимальное количество заказов в DeliveryRequest
+        :param float max_delay: Сколько секунд заказ может ждать попутчиков
+        :param float retry_delay: Через сколько секунд сверить заказы пачки, оборвавшейся ошибкой соединения
+        :param bool start: Сразу сверить прерванные отправки и запустить фоновый поток
+        """
+        self._api = api
+        self._factory = factory
+        self._number_prefix = number_prefix
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._retry_delay = retry_delay
+        self._status_factory = status_factory
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+        with self._lock, self._connection:
+            self._connection.executescript(u'''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    number TEXT PRIMARY KEY,
+                    payload BLOB NOT NULL,
+                    state TEXT NOT NULL,
+                    available REAL NOT NULL,
+                    act_number TEXT,
+                    date TEXT,
+                    dispatch_number TEXT,
+                    errors TEXT,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, available);
+                CREATE TABLE IF NOT EXISTS batches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created REAL NOT NULL
+                );
+            ''')
+        if start:
+            self.start()
+
+    def start(self):
+        """
+        Сверяет прерванные отправки и запускает фоновый поток
+        """
+        self.reconcile()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, flush=True):
+        """
+        Останавливает фоновый поток; неотправленные заказы остаются в очереди
+        :param bool flush: Перед остановкой отправить все заказы, которые можно отправить
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if flush:
+            self.flush()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def enqueue(self, order):
+        """
+        :param cdek.objects.request.OrderRequestObject order:
+        :rtype: bool
+        :return: False, если заказ с таким номером уже есть в очереди
+        """
+        now = time.time()
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    u'INSERT INTO outbox (number, payload, state, available, created) VALUES (?, ?, ?, ?, ?)',
+                    (order.number, sqlite3.Binary(pickle.dumps(order, pickle.HIGHEST_PROTOCOL)), self.STATE_QUEUED,
+                     now, now))
+        except sqlite3.IntegrityError:
+            return False
+        with self._condition:
+            self._condition.notify()
+        return True
+
+    def get(self, number):
+        """
+        :param basestring number: Номер заказа клиента
+        :rtype: OutboxEntry|None
+        :return: response_order - результат регистрации, None, пока заказ не отправлен
+        """
+        with self._lock:
+            row = self._connection.execute(
+                u'SELECT number, state, act_number, date, dispatch_number, errors FROM outbox WHERE number = ?',
+                (number,)).fetchone()
+        if row is None:
+            return None
+        number, state, act_number, date, dispatch_number, errors = row
+        response_order = None
+        if state in (self.STATE_SENT, self.STATE_FAILED):
+            response_order = ResponseOrder(number=number, dispatch_number=dispatch_number,
+                                           errors=[ResponseError(*x) for x in json.loads(errors or u'[]')])
+        return OutboxEntry(number, state, act_number, date, response_order)
+
+    def counts(self):
+        """
+        :rtype: dict
+        :return: Количество заказов по состояниям
+        """
+        with self._lock:
+            return dict(self._connection.execute(u'SELECT state, COUNT(*) FROM outbox GROUP BY state'))
+
+    def flush(self):
+        """
+        Отправляет все заказы, доступные для отправки, не дожидаясь порогов
+        :rtype: int
+        :return: Количество отправленных пачек
+        """
+        batches = 0
+        while self._send_batch():
+            batches += 1
+        return batches
+
+    def reconcile(self, due_only=False):
+        """
+        Разбирает заказы, судьба которых неизвестна: найденные в шлюзе считаются зарегистрированными, остальные
+        снова ставятся в очередь. Если сверка не удалась из-за ошибки соединения, она откладывается на retry_delay
+        :param bool due_only: Только заказы, время сверки которых наступило; по умолчанию все, как после перезапуска
+        :rtype: bool
+        :return: False, если сверка не удалась
+        """
+        with self._send_lock:
+            return self._reconcile(time.time() if due_only else None)
+
+    def _reconcile(self, due_at):
+        with self._lock:
+            if due_at is None:
+                rows = self._connection.execute(u'SELECT number, date FROM outbox WHERE state = ?',
+                                                (self.STATE_SENDING,)).fetchall()
+            else:
+                rows = self._connection.execute(u'SELECT number, date FROM outbox WHERE state = ? AND available <= ?',
+                                                (self.STATE_SENDING, due_at)).fetchall()
+        if not rows:
+            return True
+        status_report = self._status_factory.factory_status_report(
+            date=datetime.datetime.now(),
+            orders=[self._status_factory.factory_order(
+                number=number, date=datetime.datetime.strptime(date, u'%Y-%m-%d').date())
+                for number, date in rows])
+        try:
+            api_response = self._api.make_status_report_request(status_report)
+        except CDEKAPI.TRANSPORT_ERRORS:
+            with self._lock, self._connection:
+                self._connection.executemany(u'UPDATE outbox SET available = ? WHERE number = ?',
+                                             [(time.time() + self._retry_delay, x[0]) for x in rows])
+            return False
+        found = dict((x.number, x) for x in api_response.data if x.dispatch_number and not x.errors)
+        now = time.time()
+        with self._lock, self._connection:
+            for number, _ in rows:
+                if number in found:
+                    self._connection.execute(
+                        u'UPDATE outbox SET state = ?, dispatch_number = ?, errors = NULL WHERE number = ?',
+                        (self.STATE_SENT, found[number].dispatch_number, number))
+                else:
+                    self._connection.execute(
+                        u'UPDATE outbox SET state = ?, available = ? WHERE number = ?',
+                        (self.STATE_QUEUED, now, number))
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    wait = self._get_wait()
+                    if wait is not None and wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                if self._closed:
+                    return
+            try:
+                self.reconcile(due_only=True)
+                self._send_batch()
+            except Exception:
+                # Фоновый поток не должен останавливаться; пачка, оставшаяся отправляемой, будет сверена позже
+                logger.exception(u'Outbox batch failed')
+                with self._condition:
+                    if not self._closed:
+                        self._condition.wait(self._retry_delay)
+
+    def _get_wait(self):
+        # Сколько секунд ждать до отправки следующей пачки или сверки; None - ждать нечего
+        with self._lock:
+            count, oldest = self._connection.execute(
+                u'SELECT COUNT(*), MIN(available) FROM outbox WHERE state = ?', (self.STATE_QUEUED,)).fetchone()
+            send_at = oldest + self._max_delay if count else None
+            if count >= self._batch_size:
+                retry_at = self._connection.execute(
+                    u'SELECT available FROM outbox WHERE state = ? ORDER BY available LIMIT 1 OFFSET ?',
+                    (self.STATE_QUEUED, self._batch_size - 1)).fetchone()[0]
+                send_at = min(retry_at, send_at)
+            check_at = self._connection.execute(
+                u'SELECT MIN(available) FROM outbox WHERE state = ?', (self.STATE_SENDING,)).fetchone()[0]
+        times = [x for x in (send_at, check_at) if x is not None]
+        if not times:
+            return None
+        return min(times) - time.time()
+
+    def _claim_batch(self):
+        # Помечает пачку заказов как отправляемую до отправки, чтобы после перезапуска ее можно было сверить. Время
+        # сверки отодвигается на retry_delay, чтобы фоновый поток не сверял пачку, которая еще отправляется
+        now = time.time()
+        date = datetime.datetime.now()
+        with self._lock, self._connection:
+            rows = self._connection.execute(
+                u'SELECT number, payload FROM outbox WHERE state = ? AND available <= ? ORDER BY created LIMIT ?',
+                (self.STATE_QUEUED, now, self._batch_size)).fetchall()
+            if not rows:
+                return None, None
+            batch_id = self._connection.execute(u'INSERT INTO batches (created) VALUES (?)', (now,)).lastrowid
+            act_number = u'{}-{}'.format(self._number_prefix, batch_id)
+            self._connection.executemany(
+                u'UPDATE outbox SET state = ?, available = ?, act_number = ?, date = ? WHERE number = ?',
+                [(self.STATE_SENDING, now + self._retry_delay, act_number, date.strftime(u'%Y-%m-%d'), x[0])
+                 for x in rows])
+        orders = [pickle.loads(str(x[1])) for x in rows]
+        return self._factory.factory_delivery_request(orders=orders, number=act_number, date=date), orders
+
+    def _send_batch(self):
+        with self._send_lock:
+            delivery_request, orders = self._claim_batch()
+            if delivery_request is None:
+                return False
+            try:
+                results = dict((x.number, x) for x in
+                               self._api.make_delivery_request(delivery_request, u'new_orders.php').data)
+            except CDEKAPI.TRANSPORT_ERRORS:
+                results = {}
+            check_at = time.time() + self._retry_delay
+            with self._lock, self._connection:
+                for order in orders:
+                    result = results.get(order.number)
+                    if result is None or (result.errors and
+                                          all(x.code == CDEKAPI.BATCH_ERROR_CODE for x in result.errors)):
+                        # Шлюз мог зарегистрировать заказ: он остается отправляемым до сверки
+                        self._connection.execute(u'UPDATE outbox SET available = ? WHERE number = ?',
+                                                 (check_at, order.number))
+                    elif not result.errors or any(x.code == self.DUPLICATE_ERROR_CODE for x in result.errors):
+                        self._connection.execute(
+                            u'UPDATE outbox SET state = ?, dispatch_number = ?, errors = NULL WHERE number = ?',
+                            (self.STATE_SENT, result.dispatch_number, order.number))
+                    else:
+                        self._connection.execute(
+                            u'UPDATE outbox SET state = ?, dispatch_number = ?, errors = ? WHERE number = ?',
+                            (self.STATE_FAILED, result.dispatch_number,
+                             json.dumps([[x.code, x.message] for x in result.errors]), order.number))
+            return True
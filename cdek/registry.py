@@ -0,0 +1,163 @@
+# coding=utf-8
+"""
+Локальный реестр зарегистрированных заказов в SQLite: номер заказа клиента, дата акта, номер отправления СДЭК и
+последний известный статус. Нужен, чтобы строить StatusReport без своих таблиц соответствия номеров
+"""
+import collections
+import sqlite3
+import threading
+import time
+
+RegistryEntry = collections.namedtuple(u'RegistryEntry', [u'number', u'date', u'dispatch_number', u'status_code',
+                                                          u'status_date'])
+
+_COLUMNS = u'number, date, dispatch_number, status_code, status_date'
+
+
+class OrderRegistry(object):
+    """
+    Реестр заказов. CDEKAPI(registry=...) заполняет его сам: make_delivery_request добавляет зарегистрированные
+    заказы, make_status_report_request обновляет их статусы. Можно использовать из нескольких потоков
+    """
+    QUERY_CHUNK_SIZE = 500
+    # Количество значений в одном IN (...): SQLite ограничивает число параметров запроса
+
+    def __init__(self, path=u':memory:'):
+        """
+        :param basestring path: Путь к файлу базы данных
+        """
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript(u'''
+                CREATE TABLE IF NOT EXISTS orders (
+                    number TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    dispatch_number TEXT,
+                    status_code INTEGER,
+                    status_date TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (number, date)
+                );
+                CREATE INDEX IF NOT EXISTS orders_dispatch_number ON orders (dispatch_number);
+                CREATE INDEX IF NOT EXISTS orders_date ON orders (date);
+                CREATE INDEX IF NOT EXISTS orders_status_code ON orders (status_code);
+            ''')
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(u'SELECT COUNT(*) FROM orders').fetchone()[0]
+
+    def record_delivery(self, delivery_request, response):
+        """
+        Добавляет заказы, которым шлюз присвоил номер отправления
+        :param cdek.objects.request.DeliveryRequestObject delivery_request:
+        :param cdek.base.Response response: Ответ на delivery_request
+        """
+        now = time.time()
+        rows = [(x.number, delivery_request.date, x.dispatch_number, now) for x in response.data
+                if x.dispatch_number and not x.errors]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                u'INSERT OR REPLACE INTO orders (number, date, dispatch_number, status_code, status_date, updated) '
+                u'VALUES (?, ?, ?, NULL, NULL, ?)', rows)
+
+    def record_statuses(self, orders):
+        """
+        Обновляет статусы заказов по номеру отправления СДЭК
+        :param collections.Iterable orders: ResponseOrder со статусами
+        """
+        now = time.time()
+        rows = [(x.status.code, x.status.date, now, x.dispatch_number) for x in orders
+                if x.status is not None and x.dispatch_number]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                u'UPDATE orders SET status_code = ?, status_date = ?, updated = ? WHERE dispatch_number = ?', rows)
+
+    def get_by_numbers(self, numbers, date=None):
+        """
+        :param list numbers: Номера заказов клиента
+        :param basestring date: Дата акта вида 2015-01-01; если не указана, ищется по всем датам
+        :rtype: list
+        :return: Список RegistryEntry
+        """
+        if date is None:
+            return self._select_in(u'number', numbers)
+        return self._select_in(u'number', numbers, u'date = ?', [date])
+
+    def get_by_dispatch_numbers(self, dispatch_numbers):
+        """
+        :param list dispatch_numbers: Номера отправлений СДЭК
+        :rtype: list
+        :return: Список RegistryEntry
+        """
+        return self._select_in(u'dispatch_number', dispatch_numbers)
+
+    def find(self, date_first=None, date_last=None, status_codes=None, exclude_status_codes=None, limit=None):
+        """
+        Выборка заказов, например тех, чей статус нужно запросить
+        :param basestring date_first: Начальная дата акта вида 2015-01-01 включительно
+        :param basestring date_last: Конечная дата акта включительно
+        :param collections.Iterable status_codes: Только заказы с этими последними статусами; None - статус неизвестен
+        :param collections.Iterable exclude_status_codes: Кроме заказов с этими последними статусами, например
+        cdek.cache.StatusCache.TERMINAL_STATUS_CODES
+        :param int limit:
+        :rtype: list
+        :return: Список RegistryEntry
+        """
+        conditions = []
+        parameters = []
+        if date_first is not None:
+            conditions.append(u'date >= ?')
+            parameters.append(date_first)
+        if date_last is not None:
+            conditions.append(u'date <= ?')
+            parameters.append(date_last)
+        if status_codes is not None:
+            status_codes = list(status_codes)
+            codes = [x for x in status_codes if x is not None]
+            condition = u'status_code IN ({})'.format(u', '.join(u'?' * len(codes))) if codes else u'0'
+            if None in status_codes:
+                condition = u'({} OR status_code IS NULL)'.format(condition)
+            conditions.append(condition)
+            parameters.extend(codes)
+        if exclude_status_codes is not None:
+            codes = list(exclude_status_codes)
+            conditions.append(u'(status_code IS NULL OR status_code NOT IN ({}))'.format(
+                u', '.join(u'?' * len(codes))))
+            parameters.extend(codes)
+        query = u'SELECT {} FROM orders'.format(_COLUMNS)
+        if conditions:
+            query += u' WHERE ' + u' AND '.join(conditions)
+        query += u' ORDER BY date, number'
+        if limit is not None:
+            query += u' LIMIT {:d}'.format(limit)
+        with self._lock:
+            return [RegistryEntry(*x) for x in self._connection.execute(query, parameters)]
+
+    def _select_in(self, column, values, condition=None, parameters=()):
+        values = list(values)
+        entries = []
+        with self._lock:
+            for offset in xrange(0, len(values), self.QUERY_CHUNK_SIZE):
+                chunk = values[offset:offset + self.QUERY_CHUNK_SIZE]
+                query = u'SELECT {} FROM orders WHERE {} IN ({})'.format(_COLUMNS, column,
+                                                                        u', '.join(u'?' * len(chunk)))
+                if condition is not None:
+                    query += u' AND ' + condition
+                entries.extend(RegistryEntry(*x) for x in self._connection.execute(query, chunk + list(parameters)))
+        return entries
+
+
+def status_orders(factory, entries):
+    """
+    Заказы для StatusReport по записям реестра
+    :param cdek.factory.CDEKStatusReportObjectsFactory factory:
+    :param collections.Iterable entries: RegistryEntry
+    :rtype: list
+    :return: Список OrderStatusObject
+    """
+    return [factory.factory_order(dispatch_number=x.dispatch_number) for x in entries]
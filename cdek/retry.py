@@ -0,0 +1,200 @@
+# coding=utf-8
+"""
+Повторная отправка заказов, не зарегистрированных шлюзом из-за временных ошибок
+"""
+import datetime
+import random
+import threading
+import time
+
+from cdek.api import CDEKAPI
+from cdek.base import Response, ResponseError, ResponseOrder, ResponseOrderCollection
+
+
+class DeliveryRetrier(object):
+    """
+    Регистрирует заказы через make_delivery_request и повторно отправляет только заказы с временными ошибками:
+    каждый повтор - новый DeliveryRequest с текущей датой, заново вычисленным по ней ключом secure и номером акта
+    number-r1, number-r2, ... Между повторами выдерживается экспоненциально растущая пауза со случайным
+    уменьшением. Номера зарегистрированных заказов запоминаются (и, если передан реестр, проверяются по нему),
+    такие заказы больше не отправляются.
+
+    Если запрос оборвался ошибкой соединения, таймаутом или некорректным ответом, шлюз мог уже зарегистрировать
+    заказы, а номер заказа уникален только в пределах акта. Поэтому такие заказы повторно не отправляются, пока
+    StatusReport по номеру заказа и дате акта не покажет, что шлюз их не зарегистрировал; найденные считаются
+    зарегистрированными. Заказы, которые так и не удалось сверить, возвращаются с ошибкой CDEKAPI.BATCH_ERROR_CODE.
+
+    api может быть любым клиентом с методами make_delivery_request и make_status_report_request, например
+    cdek.governor.GovernedCDEKAPI
+    """
+    RETRYABLE_ERROR_CODES = frozenset([u'ERR_DATABASE', u'ERR_UNKNOWN'])
+    # Ошибки заказа, которые шлюз возвращает при внутренних сбоях: заказ не зарегистрирован и его можно отправить снова
+
+    DUPLICATE_ERROR_CODE = u'ERR_ORDER_DUBL_EXISTS'
+    # Заказ с таким номером уже зарегистрирован
+
+    MISSING_ERROR_CODE = u'ERR_ORDER_MISSING_IN_RESPONSE'
+    # Шлюз не вернул ни номера отправления, ни ошибки для заказа; такой заказ тоже повторяется
+
+    def __init__(self, api, factory, status_factory, max_attempts=5, base_delay=1.0, max_delay=60.0, jitter=0.5,
+                 retryable_error_codes=RETRYABLE_ERROR_CODES, registry=None, sleep=time.sleep,
+                 random_generator=random):
+        """
+        :param cdek.api.CDEKAPI api:
+        :param cdek.factory.CDEKRequestDeliveryObjectsFactory factory:
+        :param cdek.factory.CDEKStatusReportObjectsFactory status_factory: Для сверки заказов после ошибок соединения
+        :param int max_attempts: Максимальное количество попыток: отправок и сверок
+        :param float base_delay: Пауза перед первым повтором в секундах, дальше удваивается
+        :param float max_delay: Максимальная пауза в секундах
+        :param float jitter: Доля паузы, на которую она случайно уменьшается
+        :param set retryable_error_codes: Коды ошибок заказа, при которых заказ отправляется повторно
+        :param cdek.registry.OrderRegistry registry: Реестр, по которому проверяются уже зарегистрированные заказы
+        :param callable sleep:
+        :param random.Random random_generator:
+        """
+        self._api = api
+        self._factory = factory
+        self._status_factory = status_factory
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._jitter = jitter
+        self._retryable_error_codes = frozenset(retryable_error_codes)
+        self._registry = registry
+        self._sleep = sleep
+        self._random = random_generator
+        self._registered = set()
+        self._lock = threading.Lock()
+
+    def is_registered(self, number):
+        """
+        :param basestring number: Номер заказа клиента
+        :rtype: bool
+        """
+        with self._lock:
+            if number in self._registered:
+                return True
+        return bool(self._registry is not None and self._registry.get_by_numbers([number]))
+
+    def is_retryable(self, order):
+        """
+        :param ResponseOrder order: Заказ из ответа с ошибками
+        :rtype: bool
+        """
+        return bool(order.errors) and all(x.code in self._retryable_error_codes or x.code == self.MISSING_ERROR_CODE
+                                          for x in order.errors)
+
+    def get_delay(self, attempt):
+        """
+        :param int attempt: Номер повтора, начиная с 1
+        :rtype: float
+        """
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self._jitter * self._random.random())
+
+    def make_delivery_request(self, orders, number, method_url=u'new_orders.php',
+                              status_method_url=u'status_report_h.php'):
+        """
+        :param list orders: Список OrderRequestObject
+        :param basestring number: Номер акта приема-передачи; у повторов добавляется суффикс -rN
+        :param basestring method_url:
+        :param basestring status_method_url: Метод для сверки заказов после ошибок соединения
+        :rtype: Response
+        :return: Итог по всем заказам: зарегистрированные, с постоянными ошибками и с временными ошибками после
+        последней попытки; request_element содержит элементы всех DeliveryRequest, на которые шлюз ответил. Уже
+        зарегистрированные ранее заказы получают ошибку DUPLICATE_ERROR_CODE и не отправляются
+        """
+        api_response = Response(status=Response.STATUS_OK, request_element=[], data=ResponseOrderCollection())
+        pending = []
+        registered_numbers = self._get_registered_numbers([x.number for x in orders])
+        for order in orders:
+            if order.number in registered_numbers:
+                api_response.data.append(self._duplicate(order.number))
+            else:
+                pending.append(order)
+
+        # Заказы из запроса, оборвавшегося ошибкой соединения, и дата его акта
+        unconfirmed = []
+        unconfirmed_date = None
+        failures = {}
+        attempt = 0
+        sent = 0
+        while (pending or unconfirmed) and attempt < self._max_attempts:
+            if attempt:
+                self._sleep(self.get_delay(attempt))
+            attempt += 1
+            if unconfirmed:
+                try:
+                    found = self._find_registered(unconfirmed, unconfirmed_date, status_method_url)
+                except CDEKAPI.TRANSPORT_ERRORS:
+                    continue
+                for order in unconfirmed:
+                    if order.number in found:
+                        self._add_registered(order.number)
+                        api_response.data.append(found[order.number])
+                    else:
+                        pending.append(order)
+                unconfirmed = []
+                if not pending:
+                    continue
+
+            date = datetime.datetime.now()
+            delivery_request = self._factory.factory_delivery_request(
+                orders=pending, number=u'{}-r{}'.format(number, sent) if sent else number, date=date)
+            sent += 1
+            try:
+                batch_response = self._api.make_delivery_request(delivery_request, method_url)
+            except CDEKAPI.TRANSPORT_ERRORS as e:
+                error = ResponseError(code=CDEKAPI.BATCH_ERROR_CODE, message=u'{}: {}'.format(e.__class__.__name__, e))
+                for order in pending:
+                    failures[order.number] = ResponseOrder(number=order.number, errors=[error])
+                unconfirmed, unconfirmed_date, pending = pending, date, []
+                continue
+
+            api_response.request_element.append(batch_response.request_element)
+            results = dict((x.number, x) for x in batch_response.data)
+            retry = []
+            for order in pending:
+                result = results.get(order.number)
+                if result is None:
+                    result = ResponseOrder(number=order.number, errors=[
+                        ResponseError(code=self.MISSING_ERROR_CODE, message=u'Order is missing in response')])
+                if not result.errors and result.dispatch_number:
+                    self._add_registered(order.number)
+                elif any(x.code == self.DUPLICATE_ERROR_CODE for x in result.errors):
+                    self._add_registered(order.number)
+                elif self.is_retryable(result):
+                    failures[order.number] = result
+                    retry.append(order)
+                    continue
+                api_response.data.append(result)
+            pending = retry
+
+        api_response.data.extend(failures[x.number] for x in pending + unconfirmed)
+        if any(x.errors for x in api_response.data):
+            api_response.status = Response.STATUS_FAIL
+        return api_response
+
+    def _find_registered(self, orders, date, method_url):
+        # Заказы, которые шлюз зарегистрировал в акте с датой date
+        status_report = self._status_factory.factory_status_report(
+            date=datetime.datetime.now(),
+            orders=[self._status_factory.factory_order(number=x.number, date=date.date()) for x in orders])
+        return dict((x.number, ResponseOrder(number=x.number, dispatch_number=x.dispatch_number))
+                    for x in self._api.make_status_report_request(status_report, method_url).data
+                    if x.dispatch_number and not x.errors)
+
+    def _add_registered(self, number):
+        with self._lock:
+            self._registered.add(number)
+
+    def _get_registered_numbers(self, numbers):
+        with self._lock:
+            registered_numbers = set(x for x in numbers if x in self._registered)
+        if self._registry is not None:
+            registered_numbers.update(x.number for x in self._registry.get_by_numbers(numbers))
+        return registered_numbers
+
+    def _duplicate(self, number):
+        return ResponseOrder(number=number, errors=[ResponseError(code=self.DUPLICATE_ERROR_CODE,
+                                                                  message=u'Order is already registered')])
@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+Локальная заглушка шлюза СДЭК для тестов и замеров производительности
+"""
+import BaseHTTPServer
+import cgi
+import SocketServer
+from cStringIO import StringIO
+import threading
+import time
+import urlparse
+from xml.etree.ElementTree import fromstring, Element, SubElement, tostring
+
+
+def delivery_response(xml_request):
+    """
+    Отвечает на new_orders.php: каждому заказу из DeliveryRequest присваивается номер отправления
+    :param str xml_request:
+    :rtype: str
+    """
+    response = Element(u'response')
+    for index, order in enumerate(fromstring(xml_request).findall(u'Order')):
+        SubElement(response, u'Order', Number=order.get(u'Number'), DispatchNumber=unicode(1000000000 + index))
+    return tostring(response, encoding='UTF-8')
+
+
+def status_report_response(xml_request):
+    """
+    Отвечает на status_report_h.php: каждый заказ из StatusReport находится в статусе «Создан»
+    :param str xml_request:
+    :rtype: str
+    """
+    response = Element(u'StatusReport')
+    for index, order in enumerate(fromstring(xml_request).findall(u'Order')):
+        api_order = SubElement(response, u'Order', Number=order.get(u'Number') or u'',
+                               DispatchNumber=order.get(u'DispatchNumber') or unicode(1000000000 + index))
+        SubElement(api_order, u'Status', Date=u'2015-01-01T12:00:00+03:00', Code=u'1', Description=u'Создан',
+                   CityCode=u'44', CityName=u'Москва')
+    return tostring(response, encoding='UTF-8')
+
+
+class StubGatewayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Ответ целиком отправляется одним пакетом, иначе на keep-alive соединении срабатывает задержка Нейгла
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.gateway.connection_count += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        if self.headers.gettype() == 'multipart/form-data':
+            fields = cgi.parse_multipart(StringIO(body), {'boundary': self.headers.getparam('boundary')})
+        else:
+            fields = urlparse.parse_qs(body)
+        xml_request = fields.get('xml_request', [''])[0]
+        self.server.gateway.request_bytes += len(body)
+        gateway = self.server.gateway
+        handler = gateway.handlers.get(urlparse.urlparse(self.path).path.lstrip('/'))
+        if handler is None:
+            self.send_error(404)
+            return
+        with gateway.lock:
+            gateway.active += 1
+            gateway.max_active = max(gateway.max_active, gateway.active)
+            overloaded = gateway.capacity is not None and gateway.active > gateway.capacity
+        try:
+            if overloaded:
+                gateway.rejected_count += 1
+                self.send_error(503)
+                return
+            if gateway.latency:
+                time.sleep(gateway.latency)
+            response_body = handler(xml_request)
+        finally:
+            with gateway.lock:
+                gateway.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(response_body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class StubGateway(object):
+    """
+    HTTP-сервер в отдельном потоке, отвечающий на запросы CDEKAPI. Обработчики принимают XML запроса и возвращают
+    XML ответа
+    """
+
+    def __init__(self, handlers=None, host='127.0.0.1', port=0, latency=0.0, capacity=None):
+        """
+        :param dict handlers: Обработчики по адресу метода, например {u'new_orders.php': delivery_response}
+        :param str host:
+        :param int port: 0 - выбрать свободный порт
+        :param float latency: Задержка ответа в секундах; атрибут можно менять на ходу, имитируя замедление шлюза
+        :param int capacity: Максимальное количество одновременно обрабатываемых запросов, сверх него шлюз отвечает
+        503; None - без ограничения
+        """
+        self.handlers = {
+            u'new_orders.php': delivery_response,
+            u'status_report_h.php': status_report_response,
+        }
+        self.handlers.update(handlers or {})
+        self.connection_count = 0
+        self.request_bytes = 0
+        self.latency = latency
+        self.capacity = capacity
+        self.active = 0
+        self.max_active = 0
+        self.rejected_count = 0
+        self.lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), StubGatewayRequestHandler)
+        self._server.gateway = self
+        self._thread = None
+
+    @property
+    def api_host(self):
+        return u'http://{}:{}/'.format(*self._server.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
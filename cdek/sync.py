@@ -0,0 +1,199 @@
+# coding=utf-8
+import datetime
+import collections
+import itertools
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+from cdek.api import CDEKAPI
+
+
+class FileWatermarkStorage(object):
+    """
+    Хранит состояние StatusSyncEngine в JSON-файле. Файл перезаписывается атомарно
+    """
+
+    def __init__(self, path):
+        """
+        :param basestring path: Путь к файлу состояния
+        """
+        self._path = path
+
+    def load(self):
+        """
+        :rtype: dict|None
+        """
+        if not os.path.exists(self._path):
+            return None
+        with open(self._path) as state_file:
+            return json.load(state_file)
+
+    def save(self, state):
+        """
+        :param dict state:
+        """
+        temporary_path = u'{}.tmp'.format(self._path)
+        with open(temporary_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(temporary_path, self._path)
+
+
+class StatusSyncEngine(object):
+    """
+    Инкрементальная синхронизация статусов через ChangePeriod: каждый опрос запрашивает только заказы, статус которых
+    менялся с момента предыдущего опроса. Начало периода сдвигается назад на overlap, чтобы не потерять изменения,
+    попавшие в шлюз с задержкой; изменения, уже отданные в пересекающемся окне, повторно не возвращаются
+    """
+
+    def __init__(self, api, factory, storage, initial_date, overlap=datetime.timedelta(days=1), show_history=False):
+        """
+        :param cdek.api.CDEKAPI api:
+        :param cdek.factory.CDEKStatusReportObjectsFactory factory:
+        :param FileWatermarkStorage storage: Хранилище отметки последней синхронизации
+        :param datetime.date initial_date: С какой даты забирать изменения при первом запуске
+        :param datetime.timedelta overlap: Насколько раньше отметки начинать очередной период
+        :param bool show_history:
+        """
+        self._api = api
+        self._factory = factory
+        self._storage = storage
+        self._initial_date = initial_date
+        self._overlap = overlap
+        self._show_history = show_history
+
+    def poll(self, date_last=None):
+        """
+        Забирает изменения статусов с последней отметки по date_last. Ошибки отдельных заказов не мешают сдвигу отметки:
+        она остается на месте, только если запрос оборвался исключением или часть заказов получила ошибку всего запроса
+        (CDEKAPI.BATCH_ERROR_CODE или ошибка без номера заказа)
+        :param datetime.date date_last: Конец периода, по умолчанию сегодня
+        :rtype: list
+        :return: Список ResponseOrder с новыми статусами и заказы с ошибками
+        """
+        date_last = date_last or datetime.date.today()
+        state = self._storage.load() or {}
+        if state.get(u'watermark'):
+            watermark = datetime.datetime.strptime(state[u'watermark'], u'%Y-%m-%d').date()
+        else:
+            watermark = self._initial_date
+        date_first = min(watermark - self._overlap, date_last)
+        seen = set(tuple(x) for x in state.get(u'seen', ()))
+
+        change_period = self._factory.factory_change_period(date_first=date_first, date_last=date_last)
+        status_report = self._factory.factory_status_report(date=datetime.datetime.now(), change_period=change_period,
+                                                            show_history=self._show_history)
+        api_response = self._api.make_status_report_request(status_report)
+
+        changes = []
+        complete = True
+        for order in api_response.data:
+            if any(x.code == CDEKAPI.BATCH_ERROR_CODE for x in order.errors) or (order.errors and not order.number):
+                complete = False
+            if order.status is None:
+                changes.append(order)
+                continue
+            key = (order.dispatch_number or order.number, order.status.code, order.status.date)
+            if key not in seen:
+                seen.add(key)
+                changes.append(order)
+
+        if complete:
+            watermark = date_last
+        # Изменения старше начала следующего периода больше не придут, их можно забыть
+        next_date_first = (watermark - self._overlap).isoformat()
+        state = {
+            u'watermark': watermark.isoformat(),
+            u'seen': [list(x) for x in seen if (x[2] or u'')[:10] >= next_date_first],
+        }
+        self._storage.save(state)
+        return changes
+
+
+class ChangePeriodScanner(object):
+    """
+    Потоковый обход длинного периода изменений статусов: период делится на окна по window дней, на каждое окно
+    отправляется свой StatusReport с ChangePeriod, а ResponseOrder отдаются по мере получения. Без упреждения ответ
+    разбирается потоково (CDEKAPI.iter_status_report_request); с упреждением prefetch следующих окон запрашиваются
+    параллельно, и в памяти держится не больше prefetch + 1 ответов. С хранилищем обход одного и того же периода
+    продолжается с окна, следующего за последним полностью обработанным
+    """
+
+    def __init__(self, api, factory, window=datetime.timedelta(days=1), prefetch=0, show_history=False,
+                 storage=None):
+        """
+        :param cdek.api.CDEKAPI api:
+        :param cdek.factory.CDEKStatusReportObjectsFactory factory:
+        :param datetime.timedelta window: Длина окна, целое количество дней
+        :param int prefetch: Сколько следующих окон запрашивать заранее
+        :param bool show_history:
+        :param FileWatermarkStorage storage: Хранилище отметки последнего обработанного окна
+        """
+        if window.days < 1 or window.seconds or window.microseconds:
+            raise ValueError(u'Window must be a whole number of days')
+        self._api = api
+        self._factory = factory
+        self._window = window
+        self._prefetch = prefetch
+        self._show_history = show_history
+        self._storage = storage
+
+    def windows(self, date_first, date_last):
+        """
+        :param datetime.date date_first:
+        :param datetime.date date_last:
+        :rtype: list
+        :return: Пары (начало, конец) окон, обе даты включительно
+        """
+        windows = []
+        while date_first <= date_last:
+            window_last = min(date_first + self._window - datetime.timedelta(days=1), date_last)
+            windows.append((date_first, window_last))
+            date_first = window_last + datetime.timedelta(days=1)
+        return windows
+
+    def scan(self, date_first, date_last):
+        """
+        Отдает изменения статусов за период. Окно считается обработанным, когда потребитель забрал все его заказы и
+        в ответе не было ошибок; отметка в хранилище сдвигается только по подряд обработанным окнам
+        :param datetime.date date_first:
+        :param datetime.date date_last:
+        :rtype: collections.Iterable[cdek.base.ResponseOrder]
+        """
+        period = [date_first.isoformat(), date_last.isoformat()]
+        state = self._storage.load() if self._storage is not None else None
+        if state and state.get(u'period') == period and state.get(u'completed'):
+            completed = datetime.datetime.strptime(state[u'completed'], u'%Y-%m-%d').date()
+            date_first = completed + datetime.timedelta(days=1)
+        windows = self.windows(date_first, date_last)
+        if self._prefetch:
+            responses = self._prefetch_windows(windows)
+        else:
+            responses = (self._api.iter_status_report_request(self._status_report(x)) for x in windows)
+        failed = False
+        for window, orders in itertools.izip(windows, responses):
+            for order in orders:
+                failed = failed or bool(order.errors)
+                yield order
+            if not failed and self._storage is not None:
+                self._storage.save({u'period': period, u'completed': window[1].isoformat()})
+
+    def _status_report(self, window):
+        change_period = self._factory.factory_change_period(date_first=window[0], date_last=window[1])
+        return self._factory.factory_status_report(date=datetime.datetime.now(), change_period=change_period,
+                                                   show_history=self._show_history)
+
+    def _prefetch_windows(self, windows):
+        pool = ThreadPool(self._prefetch + 1)
+        pending = collections.deque()
+        windows = iter(windows)
+        try:
+            for window in windows:
+                pending.append(pool.apply_async(self._api.make_status_report_request, (self._status_report(window),)))
+                if len(pending) > self._prefetch:
+                    yield pending.popleft().get().data
+            while pending:
+                yield pending.popleft().get().data
+        finally:
+            pool.terminate()
+            pool.join()
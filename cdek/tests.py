@@ -1,16 +1,65 @@
 # encoding=utf8
+import logging
 import os
-from xml.etree.ElementTree import tostring
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from xml.etree.ElementTree import tostring, fromstring
 import datetime
 from decimal import Decimal
 import uuid
+from random import Random
+import requests
 from unittest import TestCase
 
-from cdek.exceptions import CDEKConfigurationError
+from cdek.exceptions import CDEKConfigurationError, CDEKHTTPError
 from cdek.api import CDEKAPI
+from cdek.async_api import AsyncCDEKAPI
 from cdek.factory import CDEKRequestDeliveryObjectsFactory, CDEKStatusReportObjectsFactory
-from cdek.objects.request import ItemRequestObject, AddressRequestObject, PackageRequestObject, OrderRequestObject
-from cdek.base import Response, ResponseOrder
+from cdek.objects.request import ItemRequestObject, AddressRequestObject, PackageRequestObject, OrderRequestObject, \
+    DeliveryRequestObject, AddServiceRequestObject, FrozenAddServiceRequestObject
+from cdek.base import Response, ResponseOrder, ResponseStatus, ResponseError, ResponseOrderCollection, \
+    FragmentCache, FrozenXMLableObject
+from cdek.benchmarks import generate_orders, generate_order_columns, compare as compare_benchmarks
+from cdek.metrics import CallMetrics, MetricsRegistry
+from cdek.history import StatusHistory, parse_timestamp
+from cdek.registry import OrderRegistry, status_orders
+from cdek.retry import DeliveryRetrier
+from cdek.governor import ConcurrencyGovernor, GovernedCDEKAPI
+from cdek.coalescer import StatusRequestCoalescer
+from cdek.outbox import DeliveryOutbox
+from cdek.bulk import BulkDeliveryPipeline, pack_object, unpack_object
+from cdek.cache import StatusCache, CachedStatusReportAPI
+from cdek.sync import FileWatermarkStorage, StatusSyncEngine, ChangePeriodScanner
+from cdek.stub import StubGateway, status_report_response as stub_status_report_response
+from cdek.writer import to_xml_bytes
+
+
+DELIVERY_REQUEST_DOCUMENT = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<DeliveryRequest Account="account" Date="2015-01-01" Number="act-1" OrderCount="1" '
+    'Secure="98beabdb9e836ff313e083ed476b915e">'
+    '<Order DateInvoice="2015-01-01T12:30:00" Number="order-1" Phone="+79876543210" RecCityPostCode="119332" '
+    'RecipientEmail="mail@mail.ru" RecipientName="Петров Виктор" SellerName="ООО &quot;Магазин&quot;" '
+    'SendCityCode="44" TariffTypeCode="1">'
+    '<Address Flat="97" House="34" Street="Ленина" />'
+    '<Package BarCode="1" Number="1" Weight="3000">'
+    '<Item Amount="4" Comment="Комментарий &amp; &lt;товар&gt;" Cost="7500" Link="http://shop.ru/item/42" '
+    'Payment="250.5" WareKey="ware-1" Weight="500" WeightBrutto="600" />'
+    '</Package>'
+    '<Passport />'
+    '<CallCourier>'
+    '<Call Date="2015-01-02" LunchBeg="13:00:00" LunchEnd="14:00:00" SendCityCode="44" TimeBeg="10:00:00" '
+    'TimeEnd="18:00:00" />'
+    '<SendAddress Flat="2" House="1" SendPhone="+70000000000" SenderName="Иванов" Street="Тверская" />'
+    '</CallCourier>'
+    '<AddService ServiceCode="36" />'
+    '</Order>'
+    '</DeliveryRequest>'
+)
 
 
 class BaseTestCase(TestCase):
@@ -21,6 +70,56 @@ class BaseTestCase(TestCase):
                                                                     password=os.getenv(u'CDEK_PASSWORD'))
         self.api_client = CDEKAPI(account=os.getenv(u'CDEK_ACCOUNT'), password=os.getenv(u'CDEK_PASSWORD'))
 
+    def _factory_full_delivery_request(self):
+        factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+        item = factory.factory_item(
+            ware_key=u'ware-1',
+            cost=Decimal(u'7500'),
+            payment=Decimal(u'250.5'),
+            weight=500,
+            weight_brutto=600,
+            amount=4,
+            comment=u'Комментарий & <товар>',
+            link=u'http://shop.ru/item/42'
+        )
+        packages = [factory.factory_package(number=u'1', weight=3000, items=[item])]
+        address = factory.factory_address(street=u'Ленина', house=u'34', flat=u'97')
+        call = factory.factory_call(
+            date=datetime.date(2015, 1, 2),
+            time_beg=datetime.time(10, 0),
+            time_end=datetime.time(18, 0),
+            send_city_code=44,
+            lunch_beg=datetime.time(13, 0),
+            lunch_end=datetime.time(14, 0)
+        )
+        send_address = factory.factory_send_address(
+            street=u'Тверская',
+            house=u'1',
+            flat=u'2',
+            send_phone=u'+70000000000',
+            sender_name=u'Иванов'
+        )
+        order = factory.factory_order(
+            number=u'order-1',
+            date_invoice=datetime.datetime(2015, 1, 1, 12, 30),
+            recipient_name=u'Петров Виктор',
+            recipient_email=u'mail@mail.ru',
+            phone=u'+79876543210',
+            tariff_type_code=1,
+            seller_name=u'ООО "Магазин"',
+            address=address,
+            packages=packages,
+            send_city_code=44,
+            rec_city_post_code=u'119332',
+            call_courier=factory.factory_call_courier(call=call, send_address=send_address),
+            add_service=factory.factory_add_service([30, 36])
+        )
+        return factory.factory_delivery_request(
+            orders=[order],
+            number=u'act-1',
+            date=datetime.datetime(2015, 1, 1)
+        )
+
 
 class TestSerialization(BaseTestCase):
     def test_item_serialization(self):
@@ -235,6 +334,1561 @@ class TestSerialization(BaseTestCase):
         )
         tostring(delivery_request.to_xml_element(u'DeliveryRequest'))
 
+    def test_delivery_request_serialization_output(self):
+        delivery_request = self._factory_full_delivery_request()
+        xml_document = tostring(delivery_request.to_xml_element(u'DeliveryRequest'), encoding='UTF-8')
+        self.assertEqual(xml_document.replace("'", "\""), DELIVERY_REQUEST_DOCUMENT)
+
+
+class TestObjects(BaseTestCase):
+    def test_request_objects_are_slotted(self):
+        address = self.request_delivery_factory.factory_address(street=u'Ленина', house=u'34', flat=u'97')
+        self.assertFalse(hasattr(address, '__dict__'))
+        self.assertIsNone(AddressRequestObject(street=u'Ленина', house=u'34', flat=u'97').pvz_code)
+        self.assertRaises(AttributeError, setattr, address, u'unknown', 1)
+
+    def test_request_object_validation(self):
+        self.assertRaises(TypeError, AddressRequestObject, street=u'Ленина', house=u'34')
+        self.assertRaises(AssertionError, AddressRequestObject, street=u'Ленина', house=u'34', flat=u'97', floor=1)
+        with self.assertRaises(TypeError) as context:
+            AddressRequestObject(street=u'Ленина', floor=1)
+        self.assertEqual(context.exception.args[0], u'"house" keyword argument required!')
+        with self.assertRaises(AssertionError) as context:
+            AddressRequestObject(street=u'Ленина', house=u'34', flat=u'97', floor=1)
+        self.assertEqual(context.exception.args[0], u'Wrong keyword argument "floor"!')
+
+    def test_trusted(self):
+        address = AddressRequestObject.create_trusted(street=u'Ленина', house=u'34', flat=u'97')
+        self.assertIsNone(address.pvz_code)
+        trusted_factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password', trusted=True)
+        self.assertEqual([to_xml_bytes(x, u'Order') for x in generate_orders(trusted_factory, 5)],
+                         [to_xml_bytes(x, u'Order') for x in generate_orders(self.request_delivery_factory, 5)])
+
+    def test_response_objects_are_slotted(self):
+        order = ResponseOrder(number=u'1', status=ResponseStatus(city_code=u'44', city_name=u'Москва', code=4,
+                                                                 date=u'2015-01-01', description=u'Вручен'))
+        self.assertFalse(hasattr(order, '__dict__'))
+        self.assertFalse(hasattr(order.status, '__dict__'))
+        delivery_request = self._factory_full_delivery_request()
+        add_service = self.request_delivery_factory.factory_add_service([30, 36], frozen=True)
+        to_xml_bytes(add_service, u'AddService')
+        response = Response(status=Response.STATUS_FAIL, request_element=None, data=ResponseOrderCollection([
+            order, ResponseOrder(number=u'2', errors=[ResponseError(code=u'ERR_INVALID_NUMBER', message=u'bad')])]))
+        for protocol in (0, 1, 2):
+            self.assertEqual(to_xml_bytes(pickle.loads(pickle.dumps(delivery_request, protocol)), u'DeliveryRequest'),
+                             to_xml_bytes(delivery_request, u'DeliveryRequest'))
+            restored_add_service = pickle.loads(pickle.dumps(add_service, protocol))
+            self.assertEqual(restored_add_service, add_service)
+            self.assertEqual(restored_add_service._fragments, {})
+            with self.assertRaises(AttributeError):
+                restored_add_service.service_code = (30,)
+            restored_response = pickle.loads(pickle.dumps(response, protocol))
+            self.assertEqual(restored_response.status, Response.STATUS_FAIL)
+            self.assertEqual(restored_response.data.get_by_number(u'1').status.code, 4)
+            self.assertEqual(restored_response.data.get_by_number(u'2').errors[0].code, u'ERR_INVALID_NUMBER')
+
+
+class TestStreaming(BaseTestCase):
+    def _status_report_response(self, xml_request):
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<StatusReport DateFirst="2015-01-01" DateLast="2015-01-02">'
+            '<Order Number="1" DispatchNumber="101">'
+            '<Status Date="2015-01-01T12:00:00+03:00" Code="1" Description="Создан" CityCode="44" CityName="Москва">'
+            '<State Date="2015-01-01T12:00:00+03:00" Code="1" Description="Создан" CityCode="44" CityName="Москва" />'
+            '</Status>'
+            '</Order>'
+            '<Order Number="2" ErrorCode="ERR_INVALID_NUMBER" Msg="first" />'
+            '<Order Number="2" ErrorCode="ERR_NEED_ATTRIBUTE" Msg="second" />'
+            '<Order Number="3" DispatchNumber="103">'
+            '<Status Date="2015-01-02T12:00:00+03:00" Code="4" Description="Вручен" CityCode="44" CityName="Москва" />'
+            '</Order>'
+            '</StatusReport>'
+        )
+
+    def test_iter_status_report_request(self):
+        with StubGateway({u'status_report_h.php': self._status_report_response}) as gateway:
+            api_client = CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host)
+            change_period = self.status_report_factory.factory_change_period(date_first=datetime.date(2015, 1, 1))
+            status_report = self.status_report_factory.factory_status_report(
+                date=datetime.datetime.now(), change_period=change_period, show_history=True)
+            orders = list(api_client.iter_status_report_request(status_report))
+            batch_response = api_client.make_status_report_request(status_report)
+        self.assertEqual([x.number for x in orders], [u'1', u'2', u'3'])
+        self.assertEqual(orders[0].status.code, 1)
+        self.assertEqual([x.code for x in orders[1].errors], [u'ERR_INVALID_NUMBER', u'ERR_NEED_ATTRIBUTE'])
+        self.assertEqual(orders[2].dispatch_number, u'103')
+        self.assertEqual(batch_response.status, Response.STATUS_FAIL)
+        self.assertEqual(sorted(x.number for x in batch_response.data), [u'1', u'2', u'3'])
+
+
+class TestSession(BaseTestCase):
+    def test_connections_are_reused(self):
+        order = self.status_report_factory.factory_order(dispatch_number=u'1000000000')
+        status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(), orders=[order])
+        with StubGateway() as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                         pool_maxsize=2) as api_client:
+                responses = []
+
+                def worker():
+                    for _ in range(10):
+                        responses.append(api_client.make_status_report_request(status_report))
+
+                threads = [threading.Thread(target=worker) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len(responses), 40)
+            self.assertTrue(all(x.data[0].dispatch_number == u'1000000000' for x in responses))
+            self.assertLessEqual(gateway.connection_count, 2)
+
+
+class TestBatchDelivery(BaseTestCase):
+    def _factory_order(self, number):
+        item = self.request_delivery_factory.factory_item(ware_key=u'1', cost=Decimal(u'100'), payment=Decimal(u'0'),
+                                                          weight=500, weight_brutto=600, amount=1,
+                                                          link=u'http://shop.ru/item/1')
+        return self.request_delivery_factory.factory_order(
+            number=number,
+            date_invoice=datetime.datetime(2015, 1, 1),
+            recipient_name=u'Петров Виктор Владимирович',
+            recipient_email=u'mail@mail.ru',
+            phone=u'+79876543210',
+            tariff_type_code=1,
+            seller_name=u'ООО "Магазин"',
+            address=self.request_delivery_factory.factory_address(street=u'Ленина', house=u'34', flat=u'97'),
+            packages=[self.request_delivery_factory.factory_package(number=u'1', weight=600, items=[item])],
+            send_city_post_code=u'111402',
+            rec_city_post_code=u'119332'
+        )
+
+    def _delivery_response(self, xml_request):
+        numbers = [x.get(u'Number') for x in fromstring(xml_request).findall(u'Order')]
+        if u'broken' in numbers:
+            return 'not xml'
+        return u''.join(
+            [u'<response>'] +
+            [u'<Order Number="{}" ErrorCode="ERR_INVALID_NUMBER" Msg="bad" />'.format(x) if x.startswith(u'bad')
+             else u'<Order Number="{0}" DispatchNumber="d{0}" />'.format(x) for x in numbers] +
+            [u'</response>']
+        ).encode(u'utf8')
+
+    def test_batches_are_merged(self):
+        numbers = [u'{}'.format(x) for x in range(7)] + [u'bad', u'broken']
+        orders = [self._factory_order(x) for x in numbers]
+        with StubGateway({u'new_orders.php': self._delivery_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = api_client.make_batch_delivery_request(orders, number=u'act', date=datetime.datetime.now(),
+                                                                  batch_size=2, workers=3)
+        self.assertEqual(response.status, Response.STATUS_FAIL)
+        self.assertEqual(len(response.request_element), 5)
+        self.assertEqual([x.get(u'Number') for x in response.request_element],
+                         [u'act-1', u'act-2', u'act-3', u'act-4', u'act-5'])
+        orders = dict((x.number, x) for x in response.data)
+        self.assertEqual(sorted(orders), sorted(numbers))
+        self.assertEqual(orders[u'0'].dispatch_number, u'd0')
+        self.assertEqual(orders[u'6'].dispatch_number, u'd6')
+        self.assertEqual(orders[u'bad'].errors[0].code, u'ERR_INVALID_NUMBER')
+        self.assertEqual(orders[u'broken'].errors[0].code, CDEKAPI.BATCH_ERROR_CODE)
+        self.assertEqual(orders[u'bad'].dispatch_number, None)
+
+
+class TestAsyncApi(BaseTestCase):
+    def test_concurrent_status_reports(self):
+        lock = threading.Lock()
+        concurrency = {u'current': 0, u'max': 0}
+
+        def status_report_response(xml_request):
+            with lock:
+                concurrency[u'current'] += 1
+                concurrency[u'max'] = max(concurrency[u'max'], concurrency[u'current'])
+            time.sleep(0.01)
+            with lock:
+                concurrency[u'current'] -= 1
+            return stub_status_report_response(xml_request)
+
+        with StubGateway({u'status_report_h.php': status_report_response}) as gateway:
+            api_client = AsyncCDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                                      max_in_flight=10, timeout=10)
+            results = []
+            for index in range(200):
+                order = self.status_report_factory.factory_order(dispatch_number=u'{}'.format(index))
+                status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(),
+                                                                                 orders=[order])
+                results.append(api_client.make_status_report_request(status_report))
+            self.assertEqual(api_client.in_flight, 10)
+            responses = api_client.gather(results)
+        self.assertEqual([x.data[0].dispatch_number for x in responses], [u'{}'.format(x) for x in range(200)])
+        self.assertIsInstance(responses[0].data[0], ResponseOrder)
+        self.assertLessEqual(concurrency[u'max'], 10)
+        self.assertEqual(api_client.in_flight, 0)
+
+    def test_connection_error(self):
+        with StubGateway() as gateway:
+            api_host = gateway.api_host
+        api_client = AsyncCDEKAPI(account=u'account', password=u'password', api_host=api_host, timeout=10)
+        order = self.status_report_factory.factory_order(dispatch_number=u'1')
+        status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(), orders=[order])
+        result = api_client.make_status_report_request(status_report)
+        self.assertIsNotNone(result.exception())
+
+    def test_http_error_status(self):
+        with StubGateway(capacity=0) as gateway:
+            api_client = AsyncCDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host, timeout=10)
+            order = self.status_report_factory.factory_order(dispatch_number=u'1')
+            status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(),
+                                                                             orders=[order])
+            exception = api_client.make_status_report_request(status_report).exception(timeout=10)
+        self.assertIsInstance(exception, CDEKHTTPError)
+        self.assertEqual(exception.status_code, 503)
+
+    def test_callback_errors_are_logged(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger(u'cdek.async_api')
+        logger.addHandler(handler)
+        called = []
+
+        def failing_callback(result):
+            raise ValueError(u'callback')
+
+        try:
+            with StubGateway() as gateway:
+                api_client = AsyncCDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                                          timeout=10, address_ttl=0)
+                order = self.status_report_factory.factory_order(dispatch_number=u'1')
+                status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(),
+                                                                                 orders=[order])
+                result = api_client.make_status_report_request(status_report)
+                result.add_done_callback(failing_callback)
+                result.add_done_callback(called.append)
+                response = result.result(timeout=10)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(response.data[0].dispatch_number, u'1')
+        self.assertEqual(called, [result])
+        self.assertEqual(len(records), 1)
+        self.assertIsInstance(records[0].exc_info[1], ValueError)
+
+
+class TestStatusSync(BaseTestCase):
+    def setUp(self):
+        super(TestStatusSync, self).setUp()
+        self.state_directory = tempfile.mkdtemp()
+        self.requested_periods = []
+        self.changes = [
+            (u'101', u'2015-01-01T10:00:00+03:00', u'1'),
+            (u'102', u'2015-01-02T10:00:00+03:00', u'1'),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.state_directory)
+
+    def _status_report_response(self, xml_request):
+        change_period = fromstring(xml_request).find(u'ChangePeriod')
+        date_first, date_last = change_period.get(u'DateFirst'), change_period.get(u'DateLast')
+        self.requested_periods.append((date_first, date_last))
+        return u''.join(
+            [u'<StatusReport>'] +
+            [u'<Order Number="n{0}" DispatchNumber="{0}"><Status Date="{1}" Code="{2}" Description="" CityCode="44" '
+             u'CityName="" /></Order>'.format(*x) for x in self.changes if date_first <= x[1][:10] <= date_last] +
+            [u'</StatusReport>']
+        ).encode(u'utf8')
+
+    def test_poll_returns_only_new_changes(self):
+        storage = FileWatermarkStorage(os.path.join(self.state_directory, u'state.json'))
+        with StubGateway({u'status_report_h.php': self._status_report_response}) as gateway:
+            api_client = CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host)
+            engine = StatusSyncEngine(api_client, self.status_report_factory, storage,
+                                      initial_date=datetime.date(2015, 1, 1))
+            first = engine.poll(date_last=datetime.date(2015, 1, 2))
+            self.changes.append((u'101', u'2015-01-03T10:00:00+03:00', u'3'))
+            second = engine.poll(date_last=datetime.date(2015, 1, 3))
+            third = engine.poll(date_last=datetime.date(2015, 1, 3))
+        self.assertEqual(sorted(x.dispatch_number for x in first), [u'101', u'102'])
+        self.assertEqual([(x.dispatch_number, x.status.code) for x in second], [(u'101', 3)])
+        self.assertEqual(third, [])
+        self.assertEqual(self.requested_periods,
+                         [(u'2014-12-31', u'2015-01-02'), (u'2015-01-01', u'2015-01-03'),
+                          (u'2015-01-02', u'2015-01-03')])
+        self.assertEqual(storage.load()[u'watermark'], u'2015-01-03')
+
+    def test_poll_watermark_after_errors(self):
+        storage = FileWatermarkStorage(os.path.join(self.state_directory, u'state.json'))
+
+        def status_report_response(xml_request):
+            # Ошибка одного заказа не мешает забрать остальные изменения
+            return self._status_report_response(xml_request).replace(
+                b'</StatusReport>', b'<Order Number="n103" ErrorCode="ERR_INVALID_NUMBER" Msg="" /></StatusReport>')
+
+        with StubGateway({u'status_report_h.php': status_report_response}) as gateway:
+            api_client = CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host)
+            engine = StatusSyncEngine(api_client, self.status_report_factory, storage,
+                                      initial_date=datetime.date(2015, 1, 1))
+            changes = engine.poll(date_last=datetime.date(2015, 1, 2))
+        self.assertEqual(sorted(x.number for x in changes), [u'n101', u'n102', u'n103'])
+        self.assertEqual(storage.load()[u'watermark'], u'2015-01-02')
+
+        class FailedBatchAPI(object):
+            def make_status_report_request(self, status_report):
+                return Response(status=Response.STATUS_FAIL, request_element=None, data=ResponseOrderCollection([
+                    ResponseOrder(number=u'n104', errors=[ResponseError(code=CDEKAPI.BATCH_ERROR_CODE,
+                                                                        message=u'timeout')])]))
+
+        engine = StatusSyncEngine(FailedBatchAPI(), self.status_report_factory, storage,
+                                  initial_date=datetime.date(2015, 1, 1))
+        engine.poll(date_last=datetime.date(2015, 1, 5))
+        self.assertEqual(storage.load()[u'watermark'], u'2015-01-02')
+
+    def test_scan_windows(self):
+        self.changes = [(unicode(100 + x), u'2015-01-{:02d}T10:00:00+03:00'.format(x), u'1') for x in range(1, 11)]
+        with StubGateway({u'status_report_h.php': self._status_report_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                for prefetch in (0, 2):
+                    self.requested_periods = []
+                    scanner = ChangePeriodScanner(api_client, self.status_report_factory,
+                                                  window=datetime.timedelta(days=3), prefetch=prefetch)
+                    orders = scanner.scan(datetime.date(2015, 1, 1), datetime.date(2015, 1, 10))
+                    self.assertEqual(sorted(x.dispatch_number for x in orders),
+                                     [unicode(100 + x) for x in range(1, 11)])
+                    self.assertEqual(sorted(self.requested_periods), [
+                        (u'2015-01-01', u'2015-01-03'), (u'2015-01-04', u'2015-01-06'),
+                        (u'2015-01-07', u'2015-01-09'), (u'2015-01-10', u'2015-01-10'),
+                    ])
+
+    def test_scan_resume(self):
+        self.changes = [(unicode(100 + x), u'2015-01-{:02d}T10:00:00+03:00'.format(x), u'1') for x in range(1, 5)]
+        storage = FileWatermarkStorage(os.path.join(self.state_directory, u'scan.json'))
+        with StubGateway({u'status_report_h.php': self._status_report_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                scanner = ChangePeriodScanner(api_client, self.status_report_factory,
+                                              window=datetime.timedelta(days=2), storage=storage)
+                orders = scanner.scan(datetime.date(2015, 1, 1), datetime.date(2015, 1, 4))
+                self.assertEqual([next(orders).dispatch_number for _ in range(3)], [u'101', u'102', u'103'])
+                orders.close()
+                self.assertEqual(storage.load(), {u'period': [u'2015-01-01', u'2015-01-04'],
+                                                  u'completed': u'2015-01-02'})
+                self.requested_periods = []
+                orders = scanner.scan(datetime.date(2015, 1, 1), datetime.date(2015, 1, 4))
+                self.assertEqual([x.dispatch_number for x in orders], [u'103', u'104'])
+        self.assertEqual(self.requested_periods, [(u'2015-01-03', u'2015-01-04')])
+        self.assertEqual(storage.load()[u'completed'], u'2015-01-04')
+
+
+class TestStatusCache(BaseTestCase):
+    def setUp(self):
+        super(TestStatusCache, self).setUp()
+        self.requested = []
+        self.now = 1000.0
+
+    def _status_report_response(self, xml_request):
+        orders = fromstring(xml_request).findall(u'Order')
+        self.requested.append([x.get(u'DispatchNumber') or x.get(u'Number') for x in orders])
+        return u''.join(
+            [u'<StatusReport>'] +
+            [u'<Order Number="{0}" DispatchNumber="{1}"><Status Date="2015-01-01T10:00:00+03:00" Code="{2}" '
+             u'Description="" CityCode="44" CityName="" /></Order>'.format(
+                x.get(u'Number') or u'n' + x.get(u'DispatchNumber'), x.get(u'DispatchNumber') or u'900',
+                4 if x.get(u'DispatchNumber') == u'4' else 1) for x in orders] +
+            [u'</StatusReport>']
+        ).encode(u'utf8')
+
+    def _make_request(self, api_client, *order_kwargs):
+        orders = [self.status_report_factory.factory_order(**x) for x in order_kwargs]
+        status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(), orders=orders)
+        return api_client.make_status_report_request(status_report)
+
+    def test_only_missing_orders_are_requested(self):
+        cache = StatusCache(ttl=60, max_size=3, clock=lambda: self.now)
+        with StubGateway({u'status_report_h.php': self._status_report_response}) as gateway:
+            api_client = CachedStatusReportAPI(CDEKAPI(account=u'account', password=u'password',
+                                                       api_host=gateway.api_host), cache)
+            first = self._make_request(api_client, {u'dispatch_number': u'1'}, {u'dispatch_number': u'4'},
+                                       {u'number': u'm1', u'date': datetime.date(2015, 1, 1)})
+            second = self._make_request(api_client, {u'dispatch_number': u'1'}, {u'dispatch_number': u'4'},
+                                        {u'number': u'm1', u'date': datetime.date(2015, 1, 1)})
+            self.now += 61
+            third = self._make_request(api_client, {u'dispatch_number': u'1'}, {u'dispatch_number': u'4'})
+        self.assertEqual(self.requested, [[u'1', u'4', u'm1'], [u'1']])
+        self.assertEqual(len(first.data), 3)
+        self.assertEqual(sorted(x.dispatch_number for x in second.data), [u'1', u'4', u'900'])
+        self.assertIsNone(second.request_element)
+        self.assertEqual(sorted(x.dispatch_number for x in third.data), [u'1', u'4'])
+        self.assertEqual(cache.stats(), {u'hits': 4, u'misses': 4, u'size': 3, u'pinned': 1})
+
+    def test_change_period_skips_orders_without_dispatch_number(self):
+        def status_report_response(xml_request):
+            return (
+                u'<StatusReport>' +
+                u''.join(u'<Order Number="{}" DispatchNumber="{}"><Status Date="2015-01-01T10:00:00+03:00" Code="1" '
+                         u'Description="" CityCode="44" CityName="" /></Order>'.format(*x)
+                         for x in ((u'm1', u''), (u'm2', u''), (u'm3', u'3'))) +
+                u'</StatusReport>'
+            ).encode(u'utf8')
+
+        cache = StatusCache(ttl=60, clock=lambda: self.now)
+        with StubGateway({u'status_report_h.php': status_report_response}) as gateway:
+            api_client = CachedStatusReportAPI(CDEKAPI(account=u'account', password=u'password',
+                                                       api_host=gateway.api_host), cache)
+            status_report = self.status_report_factory.factory_status_report(
+                date=datetime.datetime.now(),
+                change_period=self.status_report_factory.factory_change_period(datetime.date(2015, 1, 1)))
+            api_response = api_client.make_status_report_request(status_report)
+        self.assertEqual(len(api_response.data), 3)
+        self.assertIsNone(cache.get(cache.dispatch_number_key(None)))
+        self.assertIsNone(cache.get(cache.dispatch_number_key(u'')))
+        self.assertEqual(cache.get(cache.dispatch_number_key(u'3')).number, u'm3')
+        self.assertEqual(cache.stats()[u'size'], 1)
+
+    def test_number_lookups_are_keyed_by_date(self):
+        def status_report_response(xml_request):
+            return u''.join(
+                [u'<StatusReport>'] +
+                [u'<Order Number="{}" DispatchNumber=""><Status Date="2015-01-01T10:00:00+03:00" Code="1" '
+                 u'Description="" CityCode="44" CityName="" /></Order>'.format(x.get(u'Number'))
+                 for x in fromstring(xml_request).findall(u'Order')] +
+                [u'</StatusReport>']
+            ).encode(u'utf8')
+
+        cache = StatusCache(ttl=60, clock=lambda: self.now)
+        with StubGateway({u'status_report_h.php': status_report_response}) as gateway:
+            api_client = CachedStatusReportAPI(CDEKAPI(account=u'account', password=u'password',
+                                                       api_host=gateway.api_host), cache)
+            self._make_request(api_client, {u'number': u'm1', u'date': datetime.date(2015, 1, 1)},
+                               {u'number': u'm1', u'date': datetime.date(2015, 1, 2)},
+                               {u'number': u'm2', u'date': datetime.date(2015, 1, 1)})
+        # Какой из двух заказов m1 пришел в ответе, неизвестно, поэтому ни один из них не кэшируется
+        self.assertIsNone(cache.get(cache.number_key(u'm1', u'2015-01-01')))
+        self.assertIsNone(cache.get(cache.number_key(u'm1', u'2015-01-02')))
+        self.assertEqual(cache.get(cache.number_key(u'm2', u'2015-01-01')).number, u'm2')
+        self.assertIsNone(cache.get(cache.dispatch_number_key(u'')))
+        self.assertEqual(cache.stats()[u'size'], 1)
+
+
+class TestXMLBytesWriter(BaseTestCase):
+    def _assert_equivalent(self, xml_object, tag_name):
+        expected = tostring(xml_object.to_xml_element(tag_name), encoding='UTF-8').replace("'", "\"")
+        self.assertEqual(to_xml_bytes(xml_object, tag_name), expected)
+
+    def test_delivery_request(self):
+        delivery_request = self._factory_full_delivery_request()
+        self.assertEqual(to_xml_bytes(delivery_request, u'DeliveryRequest'), DELIVERY_REQUEST_DOCUMENT)
+
+    def test_generated_orders(self):
+        orders = generate_orders(self.request_delivery_factory, 20)
+        delivery_request = self.request_delivery_factory.factory_delivery_request(
+            orders=orders, number=u'act', date=datetime.datetime(2015, 1, 1))
+        self._assert_equivalent(delivery_request, u'DeliveryRequest')
+
+    def test_status_report(self):
+        status_report = self.status_report_factory.factory_status_report(
+            date=datetime.datetime(2015, 1, 1),
+            orders=[self.status_report_factory.factory_order(dispatch_number=u'1'),
+                    self.status_report_factory.factory_order(number=u'2', date=datetime.date(2015, 1, 1))],
+            change_period=self.status_report_factory.factory_change_period(date_first=datetime.date(2015, 1, 1)),
+            show_history=True
+        )
+        self._assert_equivalent(status_report, u'StatusReport')
+
+    def test_special_characters(self):
+        address = self.request_delivery_factory.factory_address(street=u'O\'Brien & <Co> "1"\nstreet', house=34,
+                                                                flat=Decimal(u'9.5'))
+        document = to_xml_bytes(address, u'Address', xml_declaration=False)
+        self.assertEqual(fromstring(document).attrib,
+                         {u'Street': u'O\'Brien & <Co> "1"\nstreet', u'House': u'34', u'Flat': u'9.5'})
+        self.assertEqual(fromstring(document).attrib, address.to_xml_element(u'Address').attrib)
+
+    def test_api_request(self):
+        status_report = self.status_report_factory.factory_status_report(
+            date=datetime.datetime.now(), orders=[self.status_report_factory.factory_order(dispatch_number=u'1')])
+        with StubGateway() as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                         serializer=CDEKAPI.SERIALIZER_BYTES) as api_client:
+                response = api_client.make_status_report_request(status_report)
+        self.assertEqual(response.data[0].dispatch_number, u'1')
+        self.assertIsNone(response.request_element)
+
+
+class TestBenchmarks(BaseTestCase):
+    def test_generate_orders_is_reproducible(self):
+        first = generate_orders(self.request_delivery_factory, 5, seed=1)
+        second = generate_orders(self.request_delivery_factory, 5, seed=1)
+        self.assertEqual([to_xml_bytes(x, u'Order') for x in first], [to_xml_bytes(x, u'Order') for x in second])
+
+    def test_compare(self):
+        baseline = {u'results': {u'round_trip': [{u'method': u'new_orders.php', u'batch_size': 10, u'network': 1.0,
+                                                  u'parse': 1.0, u'request_bytes': 100}]}}
+        current = {u'results': {u'round_trip': [{u'method': u'new_orders.php', u'batch_size': 10, u'network': 1.1,
+                                                 u'parse': 1.5, u'request_bytes': 200}]}}
+        self.assertEqual(compare_benchmarks(baseline, current, threshold=0.2),
+                         [(u'round_trip new_orders.php 10', u'parse', 1.0, 1.5)])
+
+
+class TestMetrics(BaseTestCase):
+    def _status_report(self, count):
+        orders = [self.status_report_factory.factory_order(dispatch_number=u'{}'.format(x)) for x in range(count)]
+        return self.status_report_factory.factory_status_report(date=datetime.datetime.now(), orders=orders)
+
+    def test_call_metrics(self):
+        registry = MetricsRegistry()
+        calls = []
+        with StubGateway() as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                api_client.add_hook(registry)
+                api_client.add_hook(calls.append)
+                api_client.make_status_report_request(self._status_report(3))
+                list(api_client.iter_status_report_request(self._status_report(2)))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(set(calls[0].phases), {CallMetrics.PHASE_TO_XML_ELEMENT, CallMetrics.PHASE_TOSTRING,
+                                                CallMetrics.PHASE_ENCODE, CallMetrics.PHASE_NETWORK,
+                                                CallMetrics.PHASE_PARSE})
+        self.assertEqual([x.order_count for x in calls], [3, 2])
+        self.assertTrue(all(x.request_bytes > 0 and x.response_bytes > 0 and x.error is None for x in calls))
+        exported = registry.export()
+        self.assertEqual(exported[u'counters'], {u'status_report_h.php.calls': 2})
+        self.assertEqual(exported[u'histograms'][u'status_report_h.php.order_count'][u'count'], 2)
+        self.assertEqual(exported[u'histograms'][u'status_report_h.php.network'][u'buckets'][-1][1], 2)
+
+    def test_async_call_metrics(self):
+        calls = []
+        with StubGateway() as gateway:
+            api_client = AsyncCDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                                      timeout=10, serializer=AsyncCDEKAPI.SERIALIZER_BYTES)
+            api_client.add_hook(calls.append)
+            api_client.make_status_report_request(self._status_report(1)).result()
+        self.assertEqual(set(calls[0].phases), {CallMetrics.PHASE_TO_XML_BYTES, CallMetrics.PHASE_ENCODE,
+                                                CallMetrics.PHASE_QUEUE, CallMetrics.PHASE_NETWORK,
+                                                CallMetrics.PHASE_PARSE})
+
+    def test_errors_are_counted(self):
+        registry = MetricsRegistry()
+        with StubGateway() as gateway:
+            api_host = gateway.api_host
+        with CDEKAPI(account=u'account', password=u'password', api_host=api_host) as api_client:
+            api_client.add_hook(registry)
+            with self.assertRaises(requests.RequestException):
+                api_client.make_status_report_request(self._status_report(1))
+        self.assertEqual(registry.export()[u'counters'],
+                         {u'status_report_h.php.calls': 1, u'status_report_h.php.errors': 1})
+
+    def test_hook_errors_are_logged(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger(u'cdek.api')
+        logger.addHandler(handler)
+        calls = []
+
+        def failing_hook(metrics):
+            raise ValueError(u'hook')
+
+        try:
+            with StubGateway() as gateway:
+                api_host = gateway.api_host
+                with CDEKAPI(account=u'account', password=u'password', api_host=api_host) as api_client:
+                    api_client.add_hook(failing_hook)
+                    api_client.add_hook(calls.append)
+                    api_response = api_client.make_status_report_request(self._status_report(1))
+            with CDEKAPI(account=u'account', password=u'password', api_host=api_host) as api_client:
+                api_client.add_hook(failing_hook)
+                # Ошибка соединения не подменяется ошибкой хука
+                with self.assertRaises(requests.RequestException):
+                    api_client.make_status_report_request(self._status_report(1))
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(api_response.data[0].dispatch_number, u'0')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(records), 2)
+        self.assertTrue(all(isinstance(x.exc_info[1], ValueError) for x in records))
+
+    def test_stream_metrics_start_on_iteration(self):
+        calls = []
+        with StubGateway() as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                api_client.add_hook(calls.append)
+                unused = api_client.iter_status_report_request(self._status_report(2))
+                unused.close()
+                self.assertEqual(calls, [])
+                self.assertEqual(gateway.request_bytes, 0)
+                stream = api_client.iter_status_report_request(self._status_report(3))
+                next(stream)
+                stream.close()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0].order_count, 3)
+        self.assertIsNone(calls[0].error)
+
+    def test_no_metrics_without_hooks(self):
+        api_client = CDEKAPI(account=u'account', password=u'password')
+        self.assertIsNone(api_client._start_metrics(u'status_report_h.php', self._status_report(1)))
+
+
+class TestBodyEncoding(BaseTestCase):
+    def test_multipart(self):
+        delivery_request = self._factory_full_delivery_request()
+        request_sizes = {}
+        with StubGateway() as gateway:
+            for body_encoding in (CDEKAPI.BODY_ENCODING_FORM, CDEKAPI.BODY_ENCODING_MULTIPART):
+                request_bytes = gateway.request_bytes
+                with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                             body_encoding=body_encoding) as api_client:
+                    response = api_client.make_delivery_request(delivery_request)
+                self.assertEqual(response.status, Response.STATUS_OK)
+                self.assertEqual(response.data[0].number, delivery_request.order[0].number)
+                request_sizes[body_encoding] = gateway.request_bytes - request_bytes
+        self.assertLess(request_sizes[CDEKAPI.BODY_ENCODING_MULTIPART], request_sizes[CDEKAPI.BODY_ENCODING_FORM])
+
+    def test_async_multipart(self):
+        delivery_request = self._factory_full_delivery_request()
+        with StubGateway() as gateway:
+            api_client = AsyncCDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                                      timeout=10, body_encoding=AsyncCDEKAPI.BODY_ENCODING_MULTIPART)
+            response = api_client.make_delivery_request(delivery_request).result()
+        self.assertEqual(response.data[0].number, delivery_request.order[0].number)
+
+
+class TestBulkFactory(BaseTestCase):
+    def test_same_orders_as_per_object(self):
+        orders, packages, items = generate_order_columns(self.request_delivery_factory, 20)
+        bulk_orders = self.request_delivery_factory.factory_orders_bulk(orders, packages, items)
+        self.assertEqual([to_xml_bytes(x, u'Order') for x in bulk_orders],
+                         [to_xml_bytes(x, u'Order') for x in generate_orders(self.request_delivery_factory, 20)])
+
+    def test_columns_from_rows(self):
+        rows = [(u'1', u'1', 600), (u'2', u'1', 700)]
+        columns = CDEKRequestDeliveryObjectsFactory.columns_from_rows(rows, [u'order_number', u'number', u'weight'])
+        self.assertEqual(columns, {u'order_number': [u'1', u'2'], u'number': [u'1', u'1'], u'weight': [600, 700]})
+        self.assertEqual(CDEKRequestDeliveryObjectsFactory.columns_from_rows([{u'a': 1}, {u'a': 2}]), {u'a': [1, 2]})
+
+    def test_validation(self):
+        orders, packages, items = generate_order_columns(self.request_delivery_factory, 3)
+        with self.assertRaises(TypeError):
+            self.request_delivery_factory.factory_orders_bulk(orders, packages,
+                                                              dict((x, y) for x, y in items.items() if x != u'link'))
+        with self.assertRaises(AssertionError):
+            self.request_delivery_factory.factory_orders_bulk(dict(orders, unknown=[1, 2, 3]), packages, items)
+        with self.assertRaises(CDEKConfigurationError):
+            self.request_delivery_factory.factory_orders_bulk(dict(orders, phone=[u'1']), packages, items)
+        with self.assertRaises(CDEKConfigurationError):
+            self.request_delivery_factory.factory_orders_bulk(
+                dict(orders, rec_city_post_code=[u'119332', None, u'119332']), packages, items)
+        with self.assertRaises(CDEKConfigurationError):
+            self.request_delivery_factory.factory_orders_bulk(
+                orders, dict(packages, order_number=[u'missing'] * len(packages[u'order_number'])), items)
+
+    def test_duplicate_packages(self):
+        orders, packages, items = generate_order_columns(self.request_delivery_factory, 3)
+        numbers = list(packages[u'number'])
+        numbers[1] = numbers[0]
+        with self.assertRaises(CDEKConfigurationError):
+            self.request_delivery_factory.factory_orders_bulk(orders, dict(packages, number=numbers), items)
+
+    def test_object_columns(self):
+        orders, packages, items = generate_order_columns(self.request_delivery_factory, 3)
+        add_service = self.request_delivery_factory.factory_add_service([30], frozen=True)
+        bulk_orders = self.request_delivery_factory.factory_orders_bulk(
+            dict(orders, add_service=[add_service, None, add_service]), packages, items)
+        self.assertEqual([x.add_service for x in bulk_orders], [add_service, None, add_service])
+        with self.assertRaises(AssertionError):
+            self.request_delivery_factory.factory_orders_bulk(
+                dict(orders, call_courier=[{u'call': None}, None, None]), packages, items)
+
+
+class TestFrozenObjects(BaseTestCase):
+    def _factory_call_courier(self, frozen):
+        call = self.request_delivery_factory.factory_call(
+            date=datetime.date(2015, 1, 1), time_beg=datetime.time(10, 0), time_end=datetime.time(18, 0),
+            send_city_code=44, lunch_beg=datetime.time(13, 0), lunch_end=datetime.time(14, 0), frozen=frozen)
+        send_address = self.request_delivery_factory.factory_send_address(
+            street=u'Ленина', house=u'1', flat=u'2', send_phone=u'+79876543210', sender_name=u'ООО "Склад"',
+            frozen=frozen)
+        return self.request_delivery_factory.factory_call_courier(call, send_address, frozen=frozen)
+
+    def _factory_delivery_request(self, frozen):
+        orders = generate_orders(self.request_delivery_factory, 3)
+        call_courier = self._factory_call_courier(frozen)
+        add_service = self.request_delivery_factory.factory_add_service([30, 36], frozen=frozen)
+        for order in orders:
+            order.call_courier = call_courier
+            order.add_service = add_service
+        return self.request_delivery_factory.factory_delivery_request(orders=orders, number=u'1',
+                                                                      date=datetime.datetime(2015, 1, 1))
+
+    def test_same_document(self):
+        delivery_request = self._factory_delivery_request(frozen=False)
+        frozen_delivery_request = self._factory_delivery_request(frozen=True)
+        for _ in range(2):
+            self.assertEqual(to_xml_bytes(frozen_delivery_request, u'DeliveryRequest'),
+                             to_xml_bytes(delivery_request, u'DeliveryRequest'))
+            self.assertEqual(tostring(frozen_delivery_request.to_xml_element(u'DeliveryRequest')),
+                             tostring(delivery_request.to_xml_element(u'DeliveryRequest')))
+
+    def test_fragment_is_cached(self):
+        fragment_cache = FragmentCache()
+        call_courier = self._factory_call_courier(frozen=True)
+        FrozenXMLableObject.fragment_cache, previous_cache = fragment_cache, FrozenXMLableObject.fragment_cache
+        try:
+            to_xml_bytes(call_courier, u'CallCourier')
+            to_xml_bytes(self._factory_call_courier(frozen=True), u'CallCourier')
+        finally:
+            FrozenXMLableObject.fragment_cache = previous_cache
+        # Фрагменты CallCourier, Call и SendAddress
+        self.assertEqual(fragment_cache.stats(), {u'hits': 1, u'misses': 3, u'size': 3})
+
+    def test_frozen(self):
+        call_courier = self._factory_call_courier(frozen=True)
+        with self.assertRaises(AttributeError):
+            call_courier.send_address.street = u'Тверская'
+        self.assertEqual(call_courier, self._factory_call_courier(frozen=True))
+        with self.assertRaises(TypeError):
+            self.request_delivery_factory.factory_call_courier(self._factory_call_courier(frozen=False).call,
+                                                               call_courier.send_address, frozen=True)
+
+    def test_equality_respects_value_types(self):
+        self.assertEqual(FrozenAddServiceRequestObject(service_code={36, 30}),
+                         FrozenAddServiceRequestObject(service_code=[30, 36]))
+        self.assertEqual(hash(FrozenAddServiceRequestObject(service_code=frozenset([30]))),
+                         hash(FrozenAddServiceRequestObject(service_code=(30,))))
+        for first, second in ((44, 44.0), (1, True), (Decimal(u'1'), Decimal(u'1.0'))):
+            self.assertNotEqual(FrozenAddServiceRequestObject(service_code=[first]),
+                                FrozenAddServiceRequestObject(service_code=[second]))
+            self.assertNotEqual(to_xml_bytes(FrozenAddServiceRequestObject(service_code=[first]), u'AddService'),
+                                to_xml_bytes(FrozenAddServiceRequestObject(service_code=[second]), u'AddService'))
+
+    def test_cache_is_bounded(self):
+        fragment_cache = FragmentCache(max_size=2)
+        for key in range(3):
+            fragment_cache.get(key, lambda: u'<Tag />')
+        self.assertEqual(fragment_cache.stats()[u'size'], 2)
+
+
+class TestResponseOrderCollection(BaseTestCase):
+    def test_indexes(self):
+        orders = ResponseOrderCollection([
+            ResponseOrder(number=u'1', dispatch_number=u'1001'),
+            ResponseOrder(number=u'2', errors=[ResponseError(code=u'ERR_INVALID_NUMBER', message=u'bad')]),
+        ])
+        self.assertEqual(orders.get_by_number(u'2'), orders[1])
+        self.assertEqual(orders.get_by_dispatch_number(u'1001'), orders[0])
+        self.assertEqual(orders.by_dispatch_number.keys(), [u'1001'])
+        self.assertEqual([x.number for x in orders.failed()], [u'2'])
+        self.assertEqual([x.number for x in orders.succeeded()], [u'1'])
+        orders.append(ResponseOrder(number=u'3', dispatch_number=u'1003'))
+        self.assertEqual(orders.get_by_dispatch_number(u'1003').number, u'3')
+        orders[0] = ResponseOrder(number=u'4')
+        self.assertIsNone(orders.get_by_number(u'1'))
+        del orders[1:]
+        self.assertEqual(orders.by_number.keys(), [u'4'])
+
+    def test_response_data(self):
+        with StubGateway() as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                orders = [self.status_report_factory.factory_order(dispatch_number=u'{}'.format(x)) for x in range(3)]
+                status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(),
+                                                                                 orders=orders)
+                response = api_client.make_status_report_request(status_report)
+        self.assertIsInstance(response.data, ResponseOrderCollection)
+        self.assertEqual(response.data.get_by_dispatch_number(u'2').dispatch_number, u'2')
+
+
+class TestStatusHistory(BaseTestCase):
+    def _status_report_response(self, xml_request):
+        return u''.join(
+            [u'<StatusReport>'] +
+            [u'<Order Number="n{0}" DispatchNumber="{0}"><Status Date="2015-01-02T10:00:00+03:00" Code="8" '
+             u'Description="" CityCode="44" CityName="Москва">'
+             u'<State Date="2015-01-01T10:00:00+03:00" Code="1" Description="" CityCode="44" CityName="Москва" />'
+             u'<State Date="2015-01-01T12:00:00+03:00" Code="6" Description="" CityCode="44" CityName="Москва" />'
+             u'<State Date="2015-01-02T10:00:00+03:00" Code="8" Description="" CityCode="137" '
+             u'CityName="Санкт-Петербург" /></Status></Order>'.format(x.get(u'DispatchNumber'))
+             for x in fromstring(xml_request).findall(u'Order')] +
+            [u'</StatusReport>']
+        ).encode(u'utf8')
+
+    def test_history_is_parsed(self):
+        orders = [self.status_report_factory.factory_order(dispatch_number=x) for x in (u'1', u'2')]
+        status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(), orders=orders,
+                                                                         show_history=True)
+        with StubGateway({u'status_report_h.php': self._status_report_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                         status_history=StatusHistory()) as api_client:
+                response = api_client.make_status_report_request(status_report)
+                api_client.make_status_report_request(status_report)
+        history = response.data.get_by_dispatch_number(u'1').history
+        self.assertEqual(list(history.codes), [1, 6, 8])
+        self.assertEqual(history[-1].city_name, u'Санкт-Петербург')
+        self.assertEqual(history[0].date, u'2015-01-01T07:00:00+00:00')
+        now = parse_timestamp(u'2015-01-02T12:00:00+03:00')
+        self.assertEqual(history.time_in_transit(now=now), 22 * 3600 + 2 * 3600)
+        self.assertEqual(history.last_transition(), (6, 8, parse_timestamp(u'2015-01-02T10:00:00+03:00')))
+        status_history = api_client.status_history
+        self.assertEqual(sorted(status_history.keys()), [(u'dispatch_number', u'1'), (u'dispatch_number', u'2')])
+        self.assertEqual(len(status_history.city_names), 2)
+        key = StatusHistory.dispatch_number_key(u'2')
+        self.assertEqual(status_history.time_in_transit(now=now)[key], 24 * 3600)
+        self.assertEqual(status_history.last_transitions()[key][:2], (6, 8))
+        # Номер заказа, совпадающий с номером отправления, не заменяет его историю
+        status_history.add(StatusHistory.number_key(u'2'), [(1.0, 1, u'44', u'Москва')])
+        self.assertEqual(list(status_history.timeline(key).codes), [1, 6, 8])
+        self.assertEqual(list(status_history.timeline(StatusHistory.number_key(u'2')).codes), [1])
+
+    def test_replaced_history_is_compacted(self):
+        history = StatusHistory()
+        for index in range(3):
+            history.add(u'1', [(float(index), 1, u'44', u'Москва'), (float(index + 1), 4, u'44', u'Москва')])
+        self.assertEqual(len(history.codes), 2)
+        self.assertEqual(list(history.timeline(u'1').timestamps), [2.0, 3.0])
+        self.assertIsNone(history.timeline(u'2'))
+
+    def test_history_is_not_stored_by_default(self):
+        orders = [self.status_report_factory.factory_order(dispatch_number=u'1')]
+        status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(), orders=orders,
+                                                                         show_history=True)
+        with StubGateway({u'status_report_h.php': self._status_report_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = api_client.make_status_report_request(status_report)
+        self.assertIsNone(api_client.status_history)
+        self.assertIsNone(response.data[0].history)
+        self.assertEqual(response.data[0].status.code, 8)
+
+    def test_invalid_states_are_skipped(self):
+        status_element = fromstring(
+            u'<Status Date="2015-01-02T10:00:00+03:00" Code="1001" Description="" CityCode="44" CityName="Москва">'
+            u'<State Date="2015-01-01T10:00:00+03:00" Code="1" Description="" CityCode="44" CityName="Москва" />'
+            u'<State Date="01.01.2015 11:00" Code="3" Description="" CityCode="44" CityName="Москва" />'
+            u'<State Date="2015-01-01T12:00:00+03:00" Code="" Description="" CityCode="44" CityName="Москва" />'
+            u'<State Date="2015-01-02T10:00:00+03:00" Code="1001" Description="" CityCode="44" CityName="Москва" />'
+            u'</Status>'.encode(u'utf8'))
+        history = StatusHistory()
+        timeline = history.add_element(u'1', status_element)
+        self.assertEqual(list(timeline.codes), [1, 1001])
+        self.assertEqual(history.invalid_states, 2)
+
+
+class TestOrderRegistry(BaseTestCase):
+    def _delivery_response(self, xml_request):
+        return u''.join(
+            [u'<response>'] +
+            [u'<Order Number="{0}" ErrorCode="ERR_INVALID_NUMBER" Msg="bad" />'.format(x.get(u'Number'))
+             if x.get(u'Number') == u'order-2' else
+             u'<Order Number="{0}" DispatchNumber="d{0}" />'.format(x.get(u'Number'))
+             for x in fromstring(xml_request).findall(u'Order')] +
+            [u'</response>']
+        ).encode(u'utf8')
+
+    def test_registry_is_filled(self):
+        registry = OrderRegistry()
+        orders = generate_orders(self.request_delivery_factory, 4)
+        delivery_request = self.request_delivery_factory.factory_delivery_request(
+            orders=orders, number=u'1', date=datetime.datetime(2015, 1, 1))
+        with StubGateway({u'new_orders.php': self._delivery_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                         registry=registry) as api_client:
+                api_client.make_delivery_request(delivery_request)
+                entries = registry.find(exclude_status_codes=StatusCache.TERMINAL_STATUS_CODES)
+                self.assertEqual([x.number for x in entries], [u'order-0', u'order-1', u'order-3'])
+                status_report = self.status_report_factory.factory_status_report(
+                    date=datetime.datetime.now(), orders=status_orders(self.status_report_factory, entries[1:2]))
+                api_client.make_status_report_request(status_report)
+        self.assertEqual(len(registry), 3)
+        entry = registry.get_by_numbers([u'order-1'], date=u'2015-01-01')[0]
+        self.assertEqual(entry.dispatch_number, u'dorder-1')
+        self.assertEqual(entry.status_code, 1)
+        self.assertEqual([x.number for x in registry.find(status_codes=[None])], [u'order-0', u'order-3'])
+        self.assertEqual([x.number for x in registry.get_by_dispatch_numbers([u'dorder-0', u'dorder-2'])],
+                         [u'order-0'])
+        self.assertEqual(registry.find(date_first=u'2015-01-02'), [])
+
+    def test_bulk_lookup(self):
+        registry = OrderRegistry()
+        response = Response(status=Response.STATUS_OK, request_element=None,
+                            data=[ResponseOrder(number=unicode(x), dispatch_number=u'd{}'.format(x))
+                                  for x in range(1200)])
+        registry.record_delivery(DeliveryRequestObject.create_trusted(date=u'2015-01-01'), response)
+        self.assertEqual(len(registry.get_by_numbers([unicode(x) for x in range(0, 1200, 2)])), 600)
+
+
+class TestDeliveryRetrier(BaseTestCase):
+    def setUp(self):
+        super(TestDeliveryRetrier, self).setUp()
+        self.requests = []
+        self.delays = []
+
+    def _delivery_response(self, xml_request):
+        request = fromstring(xml_request)
+        self.requests.append((request.get(u'Number'), [x.get(u'Number') for x in request.findall(u'Order')]))
+        orders = []
+        for number in self.requests[-1][1]:
+            if number == u'order-1':
+                orders.append(u'<Order Number="{0}" ErrorCode="ERR_INVALID_NUMBER" Msg="bad" />'.format(number))
+            elif number == u'order-2' and len(self.requests) < 3:
+                orders.append(u'<Order Number="{0}" ErrorCode="ERR_DATABASE" Msg="later" />'.format(number))
+            else:
+                orders.append(u'<Order Number="{0}" DispatchNumber="d{0}" />'.format(number))
+        return u''.join([u'<response>'] + orders + [u'</response>']).encode(u'utf8')
+
+    def _make_retrier(self, api_client, **kwargs):
+        return DeliveryRetrier(api_client, self.request_delivery_factory, self.status_report_factory, base_delay=1.0,
+                               jitter=0.5, sleep=self.delays.append, random_generator=Random(1), **kwargs)
+
+    def test_only_retryable_orders_are_resent(self):
+        orders = generate_orders(self.request_delivery_factory, 4)
+        with StubGateway({u'new_orders.php': self._delivery_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                retrier = self._make_retrier(api_client)
+                response = retrier.make_delivery_request(orders, number=u'act')
+                self.assertEqual(self.requests, [
+                    (u'act', [u'order-0', u'order-1', u'order-2', u'order-3']),
+                    (u'act-r1', [u'order-2']),
+                    (u'act-r2', [u'order-2']),
+                ])
+                self.assertEqual(response.status, Response.STATUS_FAIL)
+                self.assertEqual(len(response.request_element), 3)
+                self.assertEqual(response.data.get_by_number(u'order-2').dispatch_number, u'dorder-2')
+                self.assertEqual([x.number for x in response.data.failed()], [u'order-1'])
+                self.assertTrue(retrier.is_registered(u'order-2'))
+                self.assertFalse(retrier.is_registered(u'order-1'))
+
+                response = retrier.make_delivery_request(orders, number=u'act-2')
+                self.assertEqual(self.requests[-1], (u'act-2', [u'order-1']))
+                duplicates = [x for x in response.data if x.errors[0].code == DeliveryRetrier.DUPLICATE_ERROR_CODE]
+                self.assertEqual(len(duplicates), 3)
+        self.assertEqual(len(self.delays), 2)
+        self.assertTrue(0.5 <= self.delays[0] <= 1.0)
+        self.assertTrue(1.0 <= self.delays[1] <= 2.0)
+
+    def test_attempts_are_limited(self):
+        orders = generate_orders(self.request_delivery_factory, 3)
+        with StubGateway({u'new_orders.php': self._delivery_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = self._make_retrier(api_client, max_attempts=2).make_delivery_request(orders, number=u'act')
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(response.data.get_by_number(u'order-2').errors[0].code, u'ERR_DATABASE')
+
+    def test_connection_errors_are_retried(self):
+        orders = generate_orders(self.request_delivery_factory, 2)
+        with StubGateway() as gateway:
+            api_host = gateway.api_host
+        with CDEKAPI(account=u'account', password=u'password', api_host=api_host) as api_client:
+            response = self._make_retrier(api_client, max_attempts=3).make_delivery_request(orders, number=u'act')
+        self.assertEqual(len(self.delays), 2)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(set(x.errors[0].code for x in response.data), {CDEKAPI.BATCH_ERROR_CODE})
+
+    def test_orders_are_checked_before_resending_after_transport_error(self):
+        registered = {}
+        status_lookups = []
+
+        def delivery_response(xml_request):
+            if self.requests:
+                return self._delivery_response(xml_request)
+            request = fromstring(xml_request)
+            self.requests.append((request.get(u'Number'), [x.get(u'Number') for x in request.findall(u'Order')]))
+            # Шлюз успел зарегистрировать первый заказ, но ответ оборвался
+            registered[u'order-0'] = request.get(u'Date')
+            return b'<response><Order Number="order-0"'
+
+        def status_report_response(xml_request):
+            orders = []
+            for order in fromstring(xml_request).findall(u'Order'):
+                status_lookups.append((order.get(u'Number'), order.get(u'Date')))
+                if registered.get(order.get(u'Number')) == order.get(u'Date'):
+                    orders.append(u'<Order Number="{0}" DispatchNumber="d{0}"><Status Date="2015-01-01T10:00:00" '
+                                  u'Code="1" Description="" CityCode="44" CityName="" /></Order>'.format(
+                                      order.get(u'Number')))
+                else:
+                    orders.append(u'<Order Number="{}" ErrorCode="ERR_INVALID_NUMBER" Msg="" />'.format(
+                        order.get(u'Number')))
+            return u''.join([u'<StatusReport>'] + orders + [u'</StatusReport>']).encode(u'utf8')
+
+        orders = generate_orders(self.request_delivery_factory, 3)
+        with StubGateway({u'new_orders.php': delivery_response,
+                          u'status_report_h.php': status_report_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = self._make_retrier(GovernedCDEKAPI(api_client)).make_delivery_request(orders, u'act')
+        self.assertEqual(self.requests, [(u'act', [u'order-0', u'order-1', u'order-2']),
+                                         (u'act-r1', [u'order-1', u'order-2']), (u'act-r2', [u'order-2'])])
+        act_date = registered[u'order-0']
+        self.assertEqual(status_lookups, [(x, act_date) for x in (u'order-0', u'order-1', u'order-2')])
+        self.assertEqual(response.data.get_by_number(u'order-0').dispatch_number, u'dorder-0')
+        self.assertEqual(response.data.get_by_number(u'order-1').errors[0].code, u'ERR_INVALID_NUMBER')
+        self.assertEqual(response.data.get_by_number(u'order-2').dispatch_number, u'dorder-2')
+        self.assertEqual(len(self.delays), 2)
+
+    def test_registry_orders_are_not_resent(self):
+        registry = OrderRegistry()
+        orders = generate_orders(self.request_delivery_factory, 2)
+        registry.record_delivery(DeliveryRequestObject.create_trusted(date=u'2015-01-01'), Response(
+            status=Response.STATUS_OK, request_element=None,
+            data=[ResponseOrder(number=u'order-0', dispatch_number=u'dorder-0')]))
+        with StubGateway({u'new_orders.php': self._delivery_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                self._make_retrier(api_client, registry=registry).make_delivery_request(orders, number=u'act')
+        self.assertEqual(self.requests, [(u'act', [u'order-1'])])
+
+
+class TestConcurrencyGovernor(BaseTestCase):
+    def test_aimd(self):
+        now = [0.0]
+        governor = ConcurrencyGovernor(initial_limit=4, max_limit=6, latency_target=1.0, clock=lambda: now[0])
+        for _ in range(8):
+            governor.release(governor.acquire())
+        self.assertEqual(governor.limit, 5)
+        started = [governor.acquire() for _ in range(5)]
+        now[0] = 2.0
+        for x in started:
+            governor.release(x)
+        # Все пять медленных запросов начаты до уменьшения лимита и уменьшают его только один раз
+        self.assertEqual(governor.limit, 2)
+        governor.release(governor.acquire(), error=True)
+        self.assertEqual(governor.limit, 1)
+        self.assertEqual(governor.stats(), {u'limit': 1, u'in_flight': 0, u'queue_depth': 0, u'successes': 8,
+                                            u'slowdowns': 5, u'errors': 1})
+        for _ in range(100):
+            governor.release(governor.acquire())
+        self.assertEqual(governor.limit, 6)
+
+    def test_queue(self):
+        governor = ConcurrencyGovernor(initial_limit=1)
+        started = governor.acquire()
+        self.assertRaises(socket.timeout, governor.acquire, 0.05)
+        thread = threading.Thread(target=lambda: governor.release(governor.acquire()))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(governor.queue_depth, 1)
+        governor.release(started)
+        thread.join()
+        self.assertEqual((governor.queue_depth, governor.in_flight), (0, 0))
+
+    def test_rate(self):
+        governor = ConcurrencyGovernor(initial_limit=10, max_rate=100)
+        started = time.time()
+        for _ in range(6):
+            governor.release(governor.acquire())
+        self.assertTrue(time.time() - started >= 0.05)
+
+    def test_order_errors_keep_limit(self):
+        def status_report_response(xml_request):
+            return b'<StatusReport><Order Number="1" ErrorCode="ERR_INVALID_NUMBER" Msg="" /></StatusReport>'
+
+        governor = ConcurrencyGovernor(initial_limit=8)
+        with StubGateway({u'status_report_h.php': status_report_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                order = self.status_report_factory.factory_order(dispatch_number=u'1')
+                status_report = self.status_report_factory.factory_status_report(date=datetime.datetime.now(),
+                                                                                 orders=[order])
+                governed_api = GovernedCDEKAPI(api_client, governor)
+                api_response = governed_api.make_status_report_request(status_report)
+                # Собственные исключения вызывающего тоже не говорят о перегрузке шлюза
+                with self.assertRaises(AttributeError):
+                    governed_api.make_status_report_request(None)
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                         timeout=0.01) as api_client:
+                gateway.latency = 0.1
+                with self.assertRaises(requests.RequestException):
+                    GovernedCDEKAPI(api_client, governor).make_status_report_request(status_report)
+        self.assertEqual(api_response.status, Response.STATUS_FAIL)
+        self.assertEqual(governor.stats()[u'successes'], 2)
+        self.assertEqual(governor.errors, 1)
+        self.assertEqual(governor.in_flight, 0)
+        self.assertEqual(governor.limit, 4)
+
+    def _run(self, api_client, requests_count, threads_count):
+        orders = iter(range(requests_count))
+        lock = threading.Lock()
+        errors = []
+
+        def worker():
+            while True:
+                with lock:
+                    index = next(orders, None)
+                if index is None:
+                    return
+                status_report = self.status_report_factory.factory_status_report(
+                    date=datetime.datetime.now(),
+                    orders=[self.status_report_factory.factory_order(dispatch_number=unicode(index))])
+                try:
+                    api_client.make_status_report_request(status_report)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_gateway_slowdown(self):
+        governor = ConcurrencyGovernor(initial_limit=8, latency_target=0.05)
+        with StubGateway(capacity=4) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host,
+                         pool_maxsize=16) as api_client:
+                governed_api = GovernedCDEKAPI(api_client, governor)
+                gateway.latency = 0.1
+                self._run(governed_api, 24, 8)
+                self.assertEqual(governed_api.limit, 1)
+                gateway.latency = 0.0
+                errors = self._run(governed_api, 100, 8)
+                self.assertEqual(errors, [])
+                self.assertTrue(governed_api.limit > 1)
+                self.assertEqual(governed_api.queue_depth, 0)
+        self.assertEqual(governor.in_flight, 0)
+
+
+class TestStatusRequestCoalescer(BaseTestCase):
+    def setUp(self):
+        super(TestStatusRequestCoalescer, self).setUp()
+        self.batches = []
+
+    def _status_response(self, xml_request):
+        self.batches.append([x.get(u'DispatchNumber') or x.get(u'Number') for x in fromstring(xml_request)])
+        response = u''.join(
+            [u'<StatusReport>'] +
+            [u'<Order Number="{0}" DispatchNumber="{1}"><Status Date="2015-01-01T12:00:00+03:00" Code="{2}" '
+             u'Description="" CityCode="44" CityName="" /></Order>'.format(
+                x.get(u'Number') or u'n' + x.get(u'DispatchNumber'),
+                x.get(u'DispatchNumber') or u'd' + x.get(u'Number'), len(self.batches))
+             for x in fromstring(xml_request) if x.get(u'DispatchNumber') != u'missing'] +
+            [u'</StatusReport>'])
+        return response.encode(u'utf8')
+
+    def _lookup(self, coalescer, lookups):
+        results = [None] * len(lookups)
+
+        def worker(index, kwargs):
+            results[index] = coalescer.get_status(timeout=10, **kwargs)
+
+        threads = [threading.Thread(target=worker, args=(index, x)) for index, x in enumerate(lookups)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalescing(self):
+        with StubGateway({u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                with StatusRequestCoalescer(api_client, self.status_report_factory, window=0.2) as coalescer:
+                    lookups = [{u'dispatch_number': unicode(x)} for x in range(20)]
+                    lookups += [{u'dispatch_number': u'3'}, {u'dispatch_number': u'missing'},
+                                {u'number': u'order-1', u'date': datetime.date(2015, 1, 1)}]
+                    results = self._lookup(coalescer, lookups)
+        # Отсутствующий в ответе заказ мог быть вытеснен заказом с тем же номером и перепроверяется отдельно
+        self.assertEqual([len(x) for x in self.batches], [22, 1])
+        self.assertEqual(self.batches[1], [u'missing'])
+        self.assertEqual([x.dispatch_number for x in results[:20]], [unicode(x) for x in range(20)])
+        self.assertEqual(results[20].dispatch_number, u'3')
+        self.assertIsNone(results[21])
+        self.assertEqual((results[22].number, results[22].dispatch_number), (u'order-1', u'dorder-1'))
+
+    def test_same_number_with_different_dates(self):
+        def status_response(xml_request):
+            orders = fromstring(xml_request).findall(u'Order')
+            self.batches.append([(x.get(u'Number'), x.get(u'Date')) for x in orders])
+            return u''.join(
+                [u'<StatusReport>'] +
+                [u'<Order Number="{0}" DispatchNumber="{0}-{1}"><Status Date="2015-01-01T12:00:00+03:00" Code="1" '
+                 u'Description="" CityCode="44" CityName="" /></Order>'.format(x.get(u'Number'), x.get(u'Date'))
+                 for x in orders] +
+                [u'</StatusReport>']).encode(u'utf8')
+
+        with StubGateway({u'status_report_h.php': status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                with StatusRequestCoalescer(api_client, self.status_report_factory, window=0.2) as coalescer:
+                    results = self._lookup(coalescer, [
+                        {u'number': u'42', u'date': datetime.date(2015, 1, 1)},
+                        {u'number': u'42', u'date': datetime.date(2015, 2, 2)},
+                        {u'number': u'43', u'date': datetime.date(2015, 1, 1)},
+                        {u'number': u'42', u'date': datetime.date(2015, 2, 2)},
+                    ])
+        self.assertEqual([x.dispatch_number for x in results],
+                         [u'42-2015-01-01', u'42-2015-02-02', u'43-2015-01-01', u'42-2015-02-02'])
+        self.assertEqual(sorted(len(x) for x in self.batches), [1, 2])
+        self.assertEqual(sorted(sum(self.batches, [])),
+                         [(u'42', u'2015-01-01'), (u'42', u'2015-02-02'), (u'43', u'2015-01-01')])
+
+    def test_batch_size_and_latency_budget(self):
+        with StubGateway({u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                with StatusRequestCoalescer(api_client, self.status_report_factory, window=5) as coalescer:
+                    started = time.time()
+                    results = self._lookup(coalescer, [{u'dispatch_number': unicode(x), u'max_batch_size': 4}
+                                                       for x in range(12)])
+                    self.assertTrue(time.time() - started < 2)
+                    self.assertEqual([len(x) for x in self.batches], [4, 4, 4])
+                    self.assertEqual(sorted(x.dispatch_number for x in results), sorted(unicode(x) for x in range(12)))
+
+                    started = time.time()
+                    result = coalescer.get_status(dispatch_number=u'single', latency_budget=0.05, timeout=10)
+                    self.assertTrue(time.time() - started < 2)
+                    self.assertEqual(result.dispatch_number, u'single')
+
+    def test_errors_are_delivered_to_callers(self):
+        with StubGateway() as gateway:
+            api_host = gateway.api_host
+        with CDEKAPI(account=u'account', password=u'password', api_host=api_host) as api_client:
+            with StatusRequestCoalescer(api_client, self.status_report_factory, window=0.05) as coalescer:
+                self.assertRaises(requests.ConnectionError, coalescer.get_status, dispatch_number=u'1', timeout=10)
+
+        class BrokenAPI(object):
+            def make_status_report_request(self, status_report, method_url):
+                return None
+
+        with StatusRequestCoalescer(BrokenAPI(), self.status_report_factory, window=0.05) as coalescer:
+            self.assertRaises(AttributeError, coalescer.get_status, dispatch_number=u'1', timeout=10)
+
+    def test_same_number_by_dispatch_number(self):
+        def status_response(xml_request):
+            orders = fromstring(xml_request).findall(u'Order')
+            self.batches.append([x.get(u'DispatchNumber') or x.get(u'Number') for x in orders])
+            # Заказы 1001 и 1002 из разных актов с одинаковым номером заказа клиента 42
+            return u''.join(
+                [u'<StatusReport>'] +
+                [u'<Order Number="42" DispatchNumber="{0}"><Status Date="2015-01-01T12:00:00+03:00" Code="1" '
+                 u'Description="" CityCode="44" CityName="" /></Order>'.format(x.get(u'DispatchNumber') or u'1003')
+                 for x in orders] +
+                [u'</StatusReport>']).encode(u'utf8')
+
+        with StubGateway({u'status_report_h.php': status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                with StatusRequestCoalescer(api_client, self.status_report_factory, window=0.2) as coalescer:
+                    results = self._lookup(coalescer, [
+                        {u'dispatch_number': u'1001'}, {u'dispatch_number': u'1002'},
+                        {u'number': u'42', u'date': datetime.date(2015, 1, 1)},
+                    ])
+        self.assertEqual([x.dispatch_number for x in results], [u'1001', u'1002', u'1003'])
+        self.assertEqual(sorted(self.batches[0]), [u'1001', u'1002', u'42'])
+        # Какой из заказов останется в ответе, зависит от порядка запросов; вытесненные перепроверяются по одному
+        self.assertTrue(all(len(x) == 1 for x in self.batches[1:]))
+
+
+class TestStatusReportFanOut(BaseTestCase):
+    def setUp(self):
+        super(TestStatusReportFanOut, self).setUp()
+        self.shards = []
+        self.failures = {}
+
+    def _status_response(self, xml_request):
+        request = fromstring(xml_request)
+        dispatch_numbers = [x.get(u'DispatchNumber') for x in request.findall(u'Order')]
+        self.shards.append(dispatch_numbers)
+        if self.failures.get(dispatch_numbers[0]):
+            self.failures[dispatch_numbers[0]] -= 1
+            return b'<StatusReport>'
+        return u''.join(
+            [u'<StatusReport>'] +
+            [u'<Order Number="n{0}" DispatchNumber="{0}"><Status Date="2015-01-01T12:00:00+03:00" Code="1" '
+             u'Description="" CityCode="44" CityName="" /></Order>'.format(x) for x in dispatch_numbers] +
+            [u'</StatusReport>']
+        ).encode(u'utf8')
+
+    def _status_report(self, count):
+        return self.status_report_factory.factory_status_report(
+            date=datetime.datetime.now(),
+            orders=[self.status_report_factory.factory_order(dispatch_number=unicode(x)) for x in range(count)])
+
+    def test_fan_out(self):
+        self.failures[u'3'] = 1
+        with StubGateway({u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = api_client.make_status_report_request(self._status_report(10), shard_size=3)
+        self.assertEqual(response.status, Response.STATUS_OK)
+        self.assertEqual(sorted(self.shards), sorted([[u'0', u'1', u'2'], [u'3', u'4', u'5'], [u'3', u'4', u'5'],
+                                                      [u'6', u'7', u'8'], [u'9']]))
+        self.assertEqual(len(response.request_element), 4)
+        self.assertEqual(sorted(x.dispatch_number for x in response.data), sorted(unicode(x) for x in range(10)))
+
+    def test_failed_shard(self):
+        self.failures[u'0'] = 2
+        with StubGateway({u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = api_client.make_status_report_request(self._status_report(4), shard_size=2,
+                                                                 shard_retries=1)
+        self.assertEqual(response.status, Response.STATUS_FAIL)
+        self.assertEqual(len(self.shards), 3)
+        self.assertEqual(sorted(x.dispatch_number for x in response.data.failed()), [u'0', u'1'])
+        self.assertEqual(response.data.get_by_dispatch_number(u'0').errors[0].code, CDEKAPI.BATCH_ERROR_CODE)
+        self.assertEqual(response.data.get_by_dispatch_number(u'2').status.code, 1)
+
+    def test_small_report_is_not_sharded(self):
+        with StubGateway({u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = api_client.make_status_report_request(self._status_report(3), shard_size=3)
+        self.assertEqual(self.shards, [[u'0', u'1', u'2']])
+        self.assertEqual(response.request_element.tag, u'StatusReport')
+
+    def test_single_order_and_wrong_retries(self):
+        status_report = self.status_report_factory.factory_status_report(
+            date=datetime.datetime.now(), orders=self.status_report_factory.factory_order(dispatch_number=u'7'))
+        with StubGateway({u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                response = api_client.make_status_report_request(status_report, shard_size=1)
+                self.assertRaises(ValueError, api_client.make_status_report_request, status_report, shard_size=0)
+                self.assertRaises(ValueError, api_client.make_status_report_request, status_report, shard_size=1,
+                                  shard_retries=-1)
+        self.assertEqual(self.shards, [[u'7']])
+        self.assertEqual(response.data[0].dispatch_number, u'7')
+
+
+class TestDeliveryOutbox(BaseTestCase):
+    def setUp(self):
+        super(TestDeliveryOutbox, self).setUp()
+        self.state_directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.state_directory, u'outbox.db')
+        self.sent = []
+        self.bad_numbers = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_directory)
+
+    def _delivery_response(self, xml_request):
+        request = fromstring(xml_request)
+        numbers = [x.get(u'Number') for x in request.findall(u'Order')]
+        self.sent.append((request.get(u'Number'), numbers))
+        return u''.join(
+            [u'<response>'] +
+            [u'<Order Number="{0}" ErrorCode="ERR_INVALID_NUMBER" Msg="bad" />'.format(x) if x in self.bad_numbers else
+             u'<Order Number="{0}" DispatchNumber="d{0}" />'.format(x) for x in numbers] +
+            [u'</response>']
+        ).encode(u'utf8')
+
+    def _status_response(self, xml_request):
+        return u''.join(
+            [u'<StatusReport>'] +
+            [u'<Order Number="{0}" DispatchNumber="d{0}"><Status Date="2015-01-01T12:00:00+03:00" Code="1" '
+             u'Description="" CityCode="44" CityName="" /></Order>'.format(x.get(u'Number'))
+             for x in fromstring(xml_request).findall(u'Order') if x.get(u'Number') == u'order-0'] +
+            [u'</StatusReport>']
+        ).encode(u'utf8')
+
+    def _wait(self, outbox, state, count):
+        deadline = time.time() + 5
+        while outbox.counts().get(state, 0) < count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(outbox.counts().get(state, 0), count)
+
+    def test_thresholds(self):
+        orders = generate_orders(self.request_delivery_factory, 4)
+        with StubGateway({u'new_orders.php': self._delivery_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                with DeliveryOutbox(api_client, self.request_delivery_factory, self.status_report_factory, self.path,
+                                    batch_size=3, max_delay=0.2) as outbox:
+                    self.assertTrue(all(outbox.enqueue(x) for x in orders[:3]))
+                    self.assertFalse(outbox.enqueue(orders[0]))
+                    self._wait(outbox, DeliveryOutbox.STATE_SENT, 3)
+                    self.assertEqual(self.sent, [(u'outbox-1', [u'order-0', u'order-1', u'order-2'])])
+                    outbox.enqueue(orders[3])
+                    self._wait(outbox, DeliveryOutbox.STATE_SENT, 4)
+                    self.assertEqual(self.sent[1], (u'outbox-2', [u'order-3']))
+                    entry = outbox.get(u'order-1')
+        self.assertEqual((entry.state, entry.act_number, entry.response_order.dispatch_number),
+                         (DeliveryOutbox.STATE_SENT, u'outbox-1', u'dorder-1'))
+
+    def test_failed_orders_and_unavailable_gateway(self):
+        orders = generate_orders(self.request_delivery_factory, 2)
+        self.bad_numbers.add(u'order-1')
+        with StubGateway() as gateway:
+            api_host = gateway.api_host
+        with CDEKAPI(account=u'account', password=u'password', api_host=api_host) as api_client:
+            outbox = DeliveryOutbox(api_client, self.request_delivery_factory, self.status_report_factory, self.path,
+                                    start=False)
+            for order in orders:
+                outbox.enqueue(order)
+            self.assertEqual(outbox.flush(), 1)
+            # Неизвестно, получил ли шлюз пачку, поэтому заказы ждут сверки, а не снова стоят в очереди
+            self.assertEqual(outbox.counts(), {DeliveryOutbox.STATE_SENDING: 2})
+            self.assertFalse(outbox.reconcile())
+            self.assertEqual(outbox.counts(), {DeliveryOutbox.STATE_SENDING: 2})
+            outbox.close(flush=False)
+        with StubGateway({u'new_orders.php': self._delivery_response,
+                          u'status_report_h.php': lambda x: b'<StatusReport />'}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                outbox = DeliveryOutbox(api_client, self.request_delivery_factory, self.status_report_factory,
+                                        self.path, retry_delay=0, start=False)
+                self.assertEqual(outbox.flush(), 0)
+                self.assertTrue(outbox.reconcile())
+                self.assertEqual(outbox.flush(), 1)
+                entry = outbox.get(u'order-1')
+                outbox.close()
+        self.assertEqual(self.sent, [(u'outbox-2', [u'order-0', u'order-1'])])
+        self.assertEqual(entry.state, DeliveryOutbox.STATE_FAILED)
+        self.assertEqual(entry.response_order.errors[0].code, u'ERR_INVALID_NUMBER')
+
+    def test_ambiguous_failure_is_reconciled(self):
+        def delivery_response(xml_request):
+            if self.sent:
+                return self._delivery_response(xml_request)
+            request = fromstring(xml_request)
+            self.sent.append((request.get(u'Number'), [x.get(u'Number') for x in request.findall(u'Order')]))
+            # Шлюз зарегистрировал order-0, но ответ оборвался
+            return b'<response><Order Number="order-0"'
+
+        orders = generate_orders(self.request_delivery_factory, 2)
+        with StubGateway({u'new_orders.php': delivery_response,
+                          u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                with DeliveryOutbox(api_client, self.request_delivery_factory, self.status_report_factory, self.path,
+                                    max_delay=0, retry_delay=0.1, start=False) as outbox:
+                    for order in orders:
+                        outbox.enqueue(order)
+                    outbox.start()
+                    self._wait(outbox, DeliveryOutbox.STATE_SENT, 2)
+                    entries = [outbox.get(x.number) for x in orders]
+        self.assertEqual(self.sent, [(u'outbox-1', [u'order-0', u'order-1']), (u'outbox-2', [u'order-1'])])
+        self.assertEqual([(x.act_number, x.response_order.dispatch_number) for x in entries],
+                         [(u'outbox-1', u'dorder-0'), (u'outbox-2', u'dorder-1')])
+
+    def test_unexpected_errors_do_not_stop_sending(self):
+        class FailingOnceAPI(object):
+            def __init__(self, api):
+                self.api = api
+                self.calls = 0
+
+            def make_delivery_request(self, delivery_request, method_url):
+                self.calls += 1
+                if self.calls == 1:
+                    raise RuntimeError(u'unexpected')
+                return self.api.make_delivery_request(delivery_request, method_url)
+
+            def make_status_report_request(self, status_report):
+                return self.api.make_status_report_request(status_report)
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger(u'cdek.outbox')
+        logger.addHandler(handler)
+        orders = generate_orders(self.request_delivery_factory, 3)
+        try:
+            with StubGateway({u'new_orders.php': self._delivery_response,
+                              u'status_report_h.php': lambda x: b'<StatusReport />'}) as gateway:
+                with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                    with DeliveryOutbox(FailingOnceAPI(api_client), self.request_delivery_factory,
+                                        self.status_report_factory, self.path, max_delay=0, retry_delay=0.1,
+                                        start=False) as outbox:
+                        for order in orders[:2]:
+                            outbox.enqueue(order)
+                        outbox.start()
+                        # Пачка, на которой поток упал, сверяется и отправляется снова
+                        self._wait(outbox, DeliveryOutbox.STATE_SENT, 2)
+                        outbox.enqueue(orders[2])
+                        self._wait(outbox, DeliveryOutbox.STATE_SENT, 3)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(self.sent, [(u'outbox-2', [u'order-0', u'order-1']), (u'outbox-3', [u'order-2'])])
+        self.assertEqual(len(records), 1)
+        self.assertIsInstance(records[0].exc_info[1], RuntimeError)
+
+    def test_restart_during_send(self):
+        orders = generate_orders(self.request_delivery_factory, 2)
+        outbox = DeliveryOutbox(None, self.request_delivery_factory, self.status_report_factory, self.path,
+                                start=False)
+        for order in orders:
+            outbox.enqueue(order)
+        # Процесс завершился после того, как пачка была помечена отправляемой
+        outbox._claim_batch()
+        outbox.close(flush=False)
+        with StubGateway({u'new_orders.php': self._delivery_response,
+                          u'status_report_h.php': self._status_response}) as gateway:
+            with CDEKAPI(account=u'account', password=u'password', api_host=gateway.api_host) as api_client:
+                with DeliveryOutbox(api_client, self.request_delivery_factory, self.status_report_factory, self.path,
+                                    max_delay=0) as outbox:
+                    self._wait(outbox, DeliveryOutbox.STATE_SENT, 2)
+                    self.assertEqual(outbox.get(u'order-0').response_order.dispatch_number, u'dorder-0')
+        self.assertEqual(self.sent, [(u'outbox-2', [u'order-1'])])
+
+
+class TestBulkDeliveryPipeline(BaseTestCase):
+    def setUp(self):
+        super(TestBulkDeliveryPipeline, self).setUp()
+        self.factory = CDEKRequestDeliveryObjectsFactory(account=u'account', password=u'password')
+        self.date = datetime.datetime(2015, 1, 1)
+
+    def test_documents(self):
+        orders, packages, items = generate_order_columns(self.factory, 25)
+        built_orders = self.factory.factory_orders_bulk(orders, packages, items)
+        for processes in (0, 2):
+            pipeline = BulkDeliveryPipeline(u'account', u'password', processes=processes, chunk_size=7, batch_size=10)
+            documents = pipeline.build(orders, packages, items, u'act', self.date, pack=True)
+            self.assertEqual([x.number for x in documents], [u'act-1', u'act-2', u'act-3'])
+            for index, document in enumerate(documents):
+                batch_orders = built_orders[index * 10:(index + 1) * 10]
+                self.assertEqual(document.order_numbers, [x.number for x in batch_orders])
+                self.assertEqual(document.document, to_xml_bytes(self.factory.factory_delivery_request(
+                    batch_orders, document.number, self.date), u'DeliveryRequest'))
+                self.assertEqual([to_xml_bytes(unpack_object(x), u'Order') for x in document.packed_orders],
+                                 [to_xml_bytes(x, u'Order') for x in batch_orders])
+
+    def test_pack_object(self):
+        order = self._factory_full_delivery_request().order[0]
+        packed = pack_object(order)
+        self.assertTrue(len(pickle.dumps(packed, 2)) < len(pickle.dumps(order, 2)))
+        self.assertEqual(to_xml_bytes(unpack_object(pickle.loads(pickle.dumps(packed, 2))), u'Order'),
+                         to_xml_bytes(order, u'Order'))
+
+    def test_pack_frozen_objects(self):
+        order = self._factory_full_delivery_request().order[0]
+        order.call_courier = self.factory.factory_call_courier(
+            call=self.factory.factory_call(date=datetime.date(2015, 1, 2), time_beg=datetime.time(10, 0),
+                                           time_end=datetime.time(18, 0), send_city_code=44,
+                                           lunch_beg=datetime.time(13, 0), lunch_end=datetime.time(14, 0),
+                                           frozen=True),
+            send_address=self.factory.factory_send_address(street=u'Тверская', house=u'1', flat=u'2',
+                                                           send_phone=u'+70000000000', sender_name=u'Иванов',
+                                                           frozen=True),
+            frozen=True)
+        order.add_service = self.factory.factory_add_service([30, 36], frozen=True)
+        unpacked = unpack_object(pickle.loads(pickle.dumps(pack_object(order), 2)))
+        self.assertIsInstance(unpacked.call_courier, FrozenXMLableObject)
+        self.assertEqual(unpacked.call_courier, order.call_courier)
+        self.assertEqual(unpacked.add_service.service_code, (30, 36))
+        self.assertEqual(to_xml_bytes(unpacked, u'Order'), to_xml_bytes(order, u'Order'))
+
+    def test_tuple_values_are_not_unpacked(self):
+        add_service = AddServiceRequestObject.create_trusted(service_code=(3, 1))
+        unpacked = unpack_object(pack_object(add_service))
+        self.assertIsInstance(unpacked, AddServiceRequestObject)
+        self.assertEqual(unpacked.service_code, (3, 1))
+
+    def test_errors_are_raised(self):
+        orders, packages, items = generate_order_columns(self.factory, 4)
+        packages[u'order_number'][-1] = u'missing'
+        pipeline = BulkDeliveryPipeline(u'account', u'password', processes=2, chunk_size=2)
+        self.assertRaises(CDEKConfigurationError, pipeline.build, orders, packages, items, u'act', self.date)
+
+    def test_rows_are_validated_across_chunks(self):
+        orders, packages, items = generate_order_columns(self.factory, 4)
+        pipeline = BulkDeliveryPipeline(u'account', u'password', processes=0, chunk_size=2)
+        # Повторяющиеся номера в разных частях factory_orders_bulk не увидел бы
+        numbers = list(orders[u'number'])
+        numbers[3] = numbers[0]
+        self.assertRaises(CDEKConfigurationError, pipeline.build, dict(orders, number=numbers), packages, items,
+                          u'act', self.date)
+        empty_orders = dict((x, []) for x in orders)
+        self.assertRaises(CDEKConfigurationError, pipeline.build, empty_orders, packages, items, u'act', self.date)
+        self.assertEqual(pipeline.build(empty_orders, dict((x, []) for x in packages),
+                                        dict((x, []) for x in items), u'act', self.date), [])
+
+    def test_concurrent_builds(self):
+        columns = [generate_order_columns(self.factory, 5, seed=x) for x in range(4)]
+        results = [None] * len(columns)
+
+        def worker(index):
+            pipeline = BulkDeliveryPipeline(u'account', u'password', processes=0, chunk_size=1)
+            results[index] = pipeline.build(*(columns[index] + (u'act', self.date)))
+
+        threads = [threading.Thread(target=worker, args=(x,)) for x in range(len(columns))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for (orders, packages, items), documents in zip(columns, results):
+            self.assertEqual(documents[0].document, to_xml_bytes(self.factory.factory_delivery_request(
+                self.factory.factory_orders_bulk(orders, packages, items), u'act-1', self.date), u'DeliveryRequest'))
+
 
 class TestApi(BaseTestCase):
     def test_delivery_request(self):
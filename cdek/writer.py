@@ -0,0 +1,146 @@
+# coding=utf-8
+"""
+Сериализация XMLableObject сразу в байты UTF-8, минуя построение дерева ElementTree. Результат совпадает с
+tostring(obj.to_xml_element(tag_name), encoding='UTF-8') с двойными кавычками: атрибуты идут в лексическом порядке,
+пустые элементы записываются как <Tag />. В отличие от замены одинарных кавычек на двойные во всем документе,
+апострофы в значениях атрибутов остаются корректным XML
+"""
+from cdek.base import XMLableObject, FrozenXMLableObject
+
+XML_DECLARATION = u'<?xml version="1.0" encoding="UTF-8"?>\n'
+
+_sorted_fields = {}
+
+
+def escape_attribute(value):
+    """
+    Экранирует значение атрибута так же, как ElementTree
+    :param unicode value:
+    :rtype: unicode
+    """
+    if u'&' in value:
+        value = value.replace(u'&', u'&amp;')
+    if u'<' in value:
+        value = value.replace(u'<', u'&lt;')
+    if u'>' in value:
+        value = value.replace(u'>', u'&gt;')
+    if u'"' in value:
+        value = value.replace(u'"', u'&quot;')
+    if u'\n' in value:
+        value = value.replace(u'\n', u'&#10;')
+    return value
+
+
+def _get_sorted_fields(cls):
+    sorted_fields = _sorted_fields.get(cls)
+    if sorted_fields is None:
+        sorted_fields = _sorted_fields[cls] = tuple(sorted(cls._xml_fields, key=lambda x: x[1]))
+    return sorted_fields
+
+
+class XMLBytesWriter(object):
+    """
+    Накапливает фрагменты документа и отдает его одним куском байт
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write_declaration(self):
+        self._parts.append(XML_DECLARATION)
+
+    def write_raw(self, fragment):
+        """
+        Вставляет уже сериализованный фрагмент
+        :param unicode fragment:
+        """
+        self._parts.append(fragment)
+
+    def write_object(self, xml_object, tag_name):
+        """
+        :param XMLableObject xml_object:
+        :param unicode tag_name:
+        """
+        if isinstance(xml_object, FrozenXMLableObject):
+            self._parts.append(xml_object.get_fragment(tag_name, u'bytes', lambda: _to_fragment(xml_object, tag_name)))
+            return
+        self._write_object(xml_object, tag_name)
+
+    def write_start_tag(self, xml_object, tag_name):
+        """
+        Записывает открывающий тег с атрибутами объекта. Дочерние объекты не записываются: вместо них вставляются
+        готовые фрагменты, например сериализованные в других процессах, см. cdek.bulk
+        :param XMLableObject xml_object:
+        :param unicode tag_name:
+        """
+        self._write_attributes(xml_object, tag_name)
+        self._parts.append(u'>')
+
+    def _write_object(self, xml_object, tag_name):
+        write = self._parts.append
+        if not self._write_attributes(xml_object, tag_name):
+            write(u' />')
+            return
+        write(u'>')
+        for attribute_name, xml_name in xml_object._xml_fields:
+            attribute = getattr(xml_object, attribute_name)
+            if isinstance(attribute, XMLableObject):
+                self.write_object(attribute, xml_name)
+            elif isinstance(attribute, (tuple, list)):
+                for subattribute in attribute:
+                    if isinstance(subattribute, XMLableObject):
+                        self.write_object(subattribute, xml_name)
+        write(u'</' + tag_name + u'>')
+
+    def _write_attributes(self, xml_object, tag_name):
+        # Открывающий тег без закрывающей скобки; возвращает, есть ли у объекта дочерние объекты
+        write = self._parts.append
+        write(u'<' + tag_name)
+        has_children = False
+        for attribute_name, xml_name in _get_sorted_fields(type(xml_object)):
+            attribute = getattr(xml_object, attribute_name)
+            if attribute is None or isinstance(attribute, XMLableObject):
+                has_children = has_children or attribute is not None
+                continue
+            if isinstance(attribute, (tuple, list)):
+                value = None
+                for subattribute in attribute:
+                    if isinstance(subattribute, XMLableObject):
+                        has_children = True
+                    else:
+                        value = unicode(subattribute)
+                if value is None:
+                    continue
+            elif isinstance(attribute, unicode):
+                value = attribute
+            else:
+                value = str(attribute).decode(u'utf8')
+            write(u' ' + xml_name + u'="' + escape_attribute(value) + u'"')
+        return has_children
+
+    def getvalue(self):
+        """
+        :rtype: str
+        """
+        return u''.join(self._parts).encode(u'utf8')
+
+
+def _to_fragment(xml_object, tag_name):
+    writer = XMLBytesWriter()
+    writer._write_object(xml_object, tag_name)
+    return u''.join(writer._parts)
+
+
+def to_xml_bytes(xml_object, tag_name, xml_declaration=True):
+    """
+    Сериализует объект в документ UTF-8
+    :param XMLableObject xml_object:
+    :param unicode tag_name:
+    :param bool xml_declaration: Добавлять ли заголовок <?xml ...?>
+    :rtype: str
+    """
+    writer = XMLBytesWriter()
+    if xml_declaration:
+        writer.write_declaration()
+    writer.write_object(xml_object, tag_name)
+    return writer.getvalue()